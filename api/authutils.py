@@ -8,18 +8,21 @@ subject to copyright by Google.
 
 from __future__ import division, print_function
 
+import copy
 import os
 import json
 
 import endpoints
 from endpoints import users_id_token
 from google.appengine.api import urlfetch
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
 from oauth2client import client
 from httplib2 import Http
-# from oauth2client.appengine import CredentialsNDBModel, StorageByKeyName
+from oauth2client.appengine import CredentialsNDBModel, StorageByKeyName
 from oauth2client.client import Credentials
 
+import cacheutils
+import models
 import strings
 import environment
 
@@ -33,9 +36,16 @@ CALENDAR_API_VERSION = "v3"
 
 SERVICE_ACCOUNT_SCOPES = "https://www.googleapis.com/auth/calendar"
 
+DISCOVERY_DIR = os.path.join(os.path.dirname(__file__), "discovery")
+
 
 _SAVED_TOKEN_DICT = {}
 
+_DISCOVERY_DOCUMENTS = {}
+
+# Access token last stored for each user, so a token is only written once.
+_stored_tokens = cacheutils.LRUCache(1000)
+
 
 if environment.IS_DEV:
     def get_user_id():
@@ -93,14 +103,47 @@ def require_user_id():
     return current_user_id
 
 
-# def _get_cred_store(user_id):
-#     """
-#     Get storage object for a user's credentials.
-#
-#     :type user_id: unicode
-#     :rtype: StorageByKeyName
-#     """
-#     return StorageByKeyName(CredentialsNDBModel, user_id, "credentials")
+def _get_cred_store(user_id):
+    """
+    Get storage object for a user's credentials.
+
+    :type user_id: unicode
+    :rtype: StorageByKeyName
+    """
+    return StorageByKeyName(CredentialsNDBModel, user_id, "credentials")
+
+
+def store_user_credentials(user_id, credentials):
+    """
+    Save a user's credentials for cron jobs and tasks, which run without them.
+
+    Credentials are only written when their access token changes, which is
+    about once an hour for an active user.  The user's whole id is saved
+    along with them, since jobs that find users by key can't get it back
+    from the key.
+
+    :type user_id: unicode
+    :type credentials: Credentials
+    """
+    access_token = getattr(credentials, "access_token", None)
+    if _stored_tokens.get(user_id) != access_token:
+        _get_cred_store(user_id).put(credentials)
+        models.User(key=models.get_user_key(user_id), user_id=user_id).put()
+        _stored_tokens.set(user_id, access_token)
+
+
+def get_stored_credentials(user_id):
+    """
+    Get the credentials a user last made a request with.
+
+    Only the access token is known, not a refresh token, so they stop
+    working about an hour after the user's last request.
+
+    :type user_id: unicode
+    :rtype: Credentials
+    :return: The credentials, or None if none were stored.
+    """
+    return _get_cred_store(user_id).get()
 
 
 # def clear_stored_user_credentials():
@@ -112,11 +155,12 @@ def get_user_credentials():
     """
     Get oauth2 credentials from the endpoints environment.
 
+    They are also stored, for cron jobs and tasks that act for the user.
+
     :rtype: client.AccessTokenCredentials
     """
-    assert get_user_id() is not None
-    # store = _get_cred_store(get_user_id())
-    # credentials = store.get()
+    user_id = get_user_id()
+    assert user_id is not None
     credentials = None
 
     if (credentials is None and "HTTP_AUTHORIZATION" in os.environ and
@@ -125,25 +169,70 @@ def get_user_credentials():
         user_agent = os.environ["HTTP_USER_AGENT"]
         credentials = client.AccessTokenCredentials(token, user_agent)
 
-        # store.put(credentials)
+        store_user_credentials(user_id, credentials)
 
     return credentials
 
 
-def get_service(api_name, api_version, credentials=None):
+def _get_discovery_document(api_name, api_version):
+    """
+    Get the parsed discovery document shipped with the app for an api.
+
+    Documents are read and parsed once per process, then copied for every
+    service built afterwards.
+
+    :type api_name: str
+    :type api_version: str
+    :rtype: dict
+    :return: The parsed document, or None if it is not shipped with the app.
+    """
+    key = (api_name, api_version)
+    if key not in _DISCOVERY_DOCUMENTS:
+        path = os.path.join(DISCOVERY_DIR,
+                            "{}.{}.json".format(api_name, api_version))
+        if os.path.exists(path):
+            with open(path) as document_file:
+                _DISCOVERY_DOCUMENTS[key] = json.load(document_file)
+        else:
+            _DISCOVERY_DOCUMENTS[key] = None
+    return _DISCOVERY_DOCUMENTS[key]
+
+
+def get_service(api_name, api_version, credentials=None, user_id=None):
     """
     Get a resource object for a given api using given credentials.
 
+    The resource is built from a discovery document shipped with the app
+    when there is one, so no discovery request is made, and the document is
+    only parsed once per process.
+
+    Its http object is tagged with the id of the user the credentials belong
+    to, so that API responses can be cached for that user.  Without given
+    credentials, those of the current user are used, along with their id.
+
     :type api_name: str
     :type api_version: str
     :type credentials: Credentials
+    :param unicode user_id: Whose credentials they are, if given, or None
+                            to leave their responses uncached.
     :return: Resource object.
     """
-    credentials = credentials or get_user_credentials()
+    if credentials is None:
+        credentials = get_user_credentials()
+        user_id = get_user_id()
     if credentials is None or credentials.invalid:
         return None
+
+    # Http objects are not thread safe, so each service gets its own
+    http = credentials.authorize(Http())
+    http.user_id = user_id
+    document = _get_discovery_document(api_name, api_version)
+    if document is not None:
+        # The client library changes the document it is given, so each
+        # service is built from its own copy
+        return build_from_document(copy.deepcopy(document), http=http)
     else:
-        return build(api_name, api_version, http=credentials.authorize(Http()))
+        return build(api_name, api_version, http=http)
 
 
 def _get_user_id_from_id_token(jwt):
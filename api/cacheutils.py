@@ -0,0 +1,149 @@
+"""Tools for caching data in process memory and in memcache."""
+
+from __future__ import division, print_function
+
+import collections
+import hashlib
+import threading
+import time
+
+from google.appengine.api import memcache
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+MEMCACHE_KEY_MAX = 250
+
+_MISSING = object()
+
+
+def get_memcache_key(key):
+    """
+    Convert a cache key to a string memcache will accept.
+
+    :type key: str | unicode
+    :rtype: str
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    if len(key) > MEMCACHE_KEY_MAX:
+        key = hashlib.sha1(key).hexdigest()
+    return key
+
+
+class LRUCache(object):
+    """
+    A thread safe, in-process least recently used cache.
+
+    :type max_size: int
+    :type ttl: float
+    """
+
+    def __init__(self, max_size, ttl=None):
+        """
+        :param int max_size: Maximum number of items to keep.
+        :param float ttl: Seconds to keep each item, or None to keep them
+                          until they are pushed out.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get an item, and mark it as recently used.
+
+        :return: The cached value, or default if missing or expired.
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, expires = self._items.pop(key)
+            if expires is not None and expires < time.time():
+                return default
+            self._items[key] = value, expires
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace an item, pushing out the least recently used.
+
+        :param float ttl: Override the cache's default ttl for this item.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value, expires
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class TieredCache(object):
+    """
+    An in-process LRUCache in front of memcache.
+
+    Reads check process memory first and then memcache, and writes go to
+    both.  None cannot be cached, since memcache uses it to signal a miss.
+
+    Deleting an item only clears it from this instance's memory, so other
+    instances may keep serving their copy until its local_ttl runs out.
+
+    :type namespace: str
+    :type ttl: int
+    """
+
+    def __init__(self, namespace, max_size, ttl, local_ttl=None):
+        """
+        :param str namespace: Memcache namespace for this cache's keys.
+        :param int max_size: Maximum number of items to keep in process.
+        :param int ttl: Seconds to keep each item.
+        :param int local_ttl: Seconds to keep each item in process memory
+                              before checking memcache again, or None for
+                              the same as ttl.
+        """
+        self.namespace = namespace
+        self.ttl = ttl
+        self._local = LRUCache(max_size,
+                               ttl if local_ttl is None else local_ttl)
+
+    def get(self, key, default=None):
+        """
+        Get an item from process memory, or failing that, from memcache.
+
+        :return: The cached value, or default if it is not cached.
+        """
+        value = self._local.get(key, _MISSING)
+        if value is _MISSING:
+            value = memcache.get(get_memcache_key(key),
+                                 namespace=self.namespace)
+            if value is None:
+                return default
+            self._local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """Add or replace an item in both process memory and memcache."""
+        assert value is not None
+        self._local.set(key, value)
+        try:
+            memcache.set(get_memcache_key(key), value, time=self.ttl,
+                         namespace=self.namespace)
+        except ValueError:
+            # Too large for memcache, so only this instance keeps it
+            pass
+
+    def delete(self, key):
+        """Remove an item from both process memory and memcache."""
+        self._local.delete(key)
+        memcache.delete(get_memcache_key(key), namespace=self.namespace)
@@ -12,6 +12,7 @@ from ticktockapi import ticktock_api
 import messages
 import models
 import authutils
+import etagutils
 import gapiutils
 import searchutils
 
@@ -31,6 +32,9 @@ class CalendarsAPI(remote.Service):
         """
         Get a list of calendars the user has chosen.
 
+        If ifNoneMatch is the etag of the response the client already has,
+        and it is still current, only the etag is sent back.
+
         :type request: messages.CALENDAR_SEARCH_RESOURCE
         """
         user_id = authutils.require_user_id()
@@ -47,11 +51,14 @@ class CalendarsAPI(remote.Service):
 
         calendars = []
 
-        # Update calendars from NDB and filter out wrong states
+        # Load all of the user's calendar entities in one ancestor query
         user_key = models.get_user_key(user_id)
+        entities = dict((entity.key.string_id(), entity) for entity in
+                        models.Calendar.query(ancestor=user_key))
+
+        # Update calendars from NDB and filter out wrong states
         for calendar in all_calendars:
-            entity = ndb.Key(models.Calendar, calendar.calendarId,
-                             parent=user_key).get()
+            entity = entities.get(calendar.calendarId)
             if entity is not None:
                 calendar.hidden = entity.hidden
             if calendar.hidden is None:
@@ -63,6 +70,12 @@ class CalendarsAPI(remote.Service):
 
             calendars.append(calendar)
 
+        # The calendars come back from the API in a stable order, so they
+        # can be versioned before the work of sorting them
+        etag = etagutils.get_etag(calendars, request.search, request.hidden)
+        if etagutils.is_not_modified(request.ifNoneMatch, etag):
+            return messages.CalendarCollection(etag=etag, notModified=True)
+
         # Sort and search
         if request.search:
             calendars = searchutils.calendar_keyword_alpha_search(
@@ -70,7 +83,7 @@ class CalendarsAPI(remote.Service):
         else:
             calendars = searchutils.calendar_alpha_sort(calendars)
 
-        return messages.CalendarCollection(items=calendars)
+        return messages.CalendarCollection(items=calendars, etag=etag)
 
     @endpoints.method(messages.CALENDAR_ID_RESOURCE,
                       messages.CalendarProperties,
@@ -0,0 +1,64 @@
+"""Tools for versioning API responses, so unchanged ones needn't be resent."""
+
+from __future__ import division, print_function
+
+import hashlib
+from datetime import datetime
+
+from protorpc import messages
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+def _update_hash(digest, value):
+    """
+    Feed a value into a hash, in a form that doesn't depend on memory
+    layout or dict ordering.
+
+    :type digest: hashlib.sha1
+    :param value: A message, list, tuple, or simple value.
+    """
+    if isinstance(value, messages.Message):
+        digest.update("M")
+        for field in sorted(value.all_fields(), key=lambda f: f.number):
+            digest.update("{}=".format(field.number))
+            _update_hash(digest, getattr(value, field.name))
+    elif isinstance(value, (list, tuple, messages.FieldList)):
+        digest.update("L{}:".format(len(value)))
+        for item in value:
+            _update_hash(digest, item)
+    elif isinstance(value, unicode):
+        digest.update("U{}:".format(len(value)))
+        digest.update(value.encode("utf-8"))
+    elif isinstance(value, datetime):
+        digest.update("D" + value.isoformat())
+    else:
+        string = str(value)
+        digest.update("{}{}:".format(type(value).__name__, len(string)))
+        digest.update(string)
+
+
+def get_etag(*values):
+    """
+    Get a stable version tag for some response inputs or items.
+
+    Equal values always give the same tag, across instances and restarts.
+
+    :param values: Messages, lists of messages, or simple values.
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    _update_hash(digest, values)
+    return digest.hexdigest()
+
+
+def is_not_modified(request_etag, etag):
+    """
+    Check if a client already has the version of a response with an etag.
+
+    :param str request_etag: The etag the client sent, if any.
+    :type etag: str
+    :rtype: bool
+    """
+    return bool(request_etag) and request_etag.strip('"') == etag
@@ -2,26 +2,91 @@
 
 from __future__ import division, print_function
 
+import itertools
 import logging
+import math
 import urllib2
+from datetime import datetime
 
 import endpoints
 from google.appengine.ext import ndb
 from protorpc import remote
 import basehash
+import pytz
 
 from ticktockapi import ticktock_api
 import messages
 import models
 import authutils
 import gapiutils
+import preferenceutils
 import searchutils
+import syncutils
 import strings
+import tokenutils
+import cacheutils
+import etagutils
 
 __author__ = "Alexander Otavka"
 __copyright__ = "Copyright (C) 2015 DHS Developers Club"
 
 
+class _VisibleEventStream(object):
+    """
+    Iterate over a calendar mirror's events that pass the hidden filter.
+
+    Yields (event, (calendar id, continuation)) pairs, where the
+    continuation resumes right after the event.  Events are pulled from the
+    mirror and filtered a chunk at a time.
+
+    :type cal_id: str
+    :type pulled: int
+    :type yielded: int
+    :type finished: bool
+    """
+
+    def __init__(self, mirror, time_zone, continuation, preferences,
+                 chunk_size, request_hidden=False):
+        """
+        :type mirror: models.CalendarMirror
+        :type time_zone: str
+        :type continuation: (str, int)
+        :param preferenceutils.Preferences preferences: The calendar's
+            preferences, whose starred events are left out.
+        :type chunk_size: int
+        :param bool request_hidden: Which events to keep, by whether they
+                                    are hidden, or None to keep both.
+        """
+        self.cal_id = mirror.key.string_id()
+        self.pulled = 0
+        self.yielded = 0
+        self.finished = False
+        self._request_hidden = request_hidden
+        self._event_iter = syncutils.iter_events(mirror, time_zone,
+                                                 *continuation,
+                                                 page_max=chunk_size)
+        self._preferences = preferences
+        self._chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            chunk = []
+            continuations = {}
+            for event in itertools.islice(self._event_iter, self._chunk_size):
+                chunk.append(event)
+                continuations[id(event)] = self._event_iter.continuation
+            if not chunk:
+                self.finished = True
+                return
+            self.pulled += len(chunk)
+
+            for event in EventsAPI.filter_and_update_events(
+                    chunk, self._preferences.starred, self._preferences,
+                    self._request_hidden):
+                self.yielded += 1
+                yield event, (self.cal_id, continuations[id(event)])
+
+
 @ticktock_api.api_class(resource_name="events",
                         path="calendars/{calendarId}/events",
                         auth_level=endpoints.AUTH_LEVEL.REQUIRED)
@@ -30,8 +95,64 @@ class EventsAPI(remote.Service):
 
     string_base = basehash.base62()
 
+    # Fraction of events that have survived the hidden and starred filters,
+    # tracked per user, calendar and hidden filter.
+    survival_rates = cacheutils.TieredCache("event_survival_rates", 1000,
+                                            7 * 24 * 60 * 60)
+
+    # How much the latest request counts towards the tracked rate.
+    SURVIVAL_RATE_WEIGHT = 0.5
+
+    # Rates are kept above this, so page sizes stay bounded.
+    SURVIVAL_RATE_MIN = 0.05
+
+    # Next page token of each list response a user was sent, by etag, or ""
+    # for none.  Kept for less than EventCacheGroup.TTL, so the groups
+    # behind the tokens are still touched while a client keeps polling.
+    list_etags = cacheutils.TieredCache("event_list_etags", 1000,
+                                        60 * 60)
+
+    # Etag, next page token or "", and the time its first event ends, of
+    # each stateless list response a user was sent, by the etag of the
+    # request's inputs.
+    stateless_etags = cacheutils.TieredCache("event_stateless_etags", 1000,
+                                             60 * 60)
+
     @staticmethod
-    def get_starred(calendar_key, service, time_zone):
+    def get_survival_key(user_key, request):
+        """
+        Get the key for a list request's survival rate.
+
+        :type user_key: ndb.Key
+        :type request: messages.EVENT_SEARCH_RESOURCE
+        :rtype: str
+        """
+        return u"{}:{}:{}".format(user_key.id(), request.calendarId,
+                                  request.hidden)
+
+    @classmethod
+    def update_survival_rate(cls, survival_key, rate, unfiltered_count,
+                             filtered_count):
+        """
+        Blend the survival rate seen by a request into the tracked rate.
+
+        :type survival_key: str
+        :param float rate: The tracked rate before this request.
+        :param int unfiltered_count: Events pulled by this request.
+        :param int filtered_count: Events left after filtering them.
+        """
+        if not unfiltered_count:
+            return
+        seen_rate = filtered_count / unfiltered_count
+        new_rate = max(cls.SURVIVAL_RATE_MIN,
+                       cls.SURVIVAL_RATE_WEIGHT * seen_rate +
+                       (1 - cls.SURVIVAL_RATE_WEIGHT) * rate)
+        # Skip the memcache write when nothing much changed
+        if abs(new_rate - rate) > 0.01:
+            cls.survival_rates.set(survival_key, new_rate)
+
+    @classmethod
+    def get_starred(cls, calendar_key, service, time_zone):
         """
         Get an array of all starred events in given calendar and the ids.
 
@@ -40,71 +161,133 @@ class EventsAPI(remote.Service):
         :type time_zone: str
         :rtype: (list[messages.EventProperties], list[str])
         """
-        events = []
-        ids = []
-        user_id = calendar_key.parent().string_id()
-        calendar_id = calendar_key.string_id()
-        starred = True
-        starred_query = models.Event.query(models.Event.starred == starred,
-                                           ancestor=calendar_key)
-        for starred_key in starred_query.iter(keys_only=True):
-            try:
-                event = gapiutils.get_event(service, calendar_id,
-                                            starred_key.string_id(), time_zone)
-                event.starred = True
-                event.hidden = False
-                events.append(event)
-                ids.append(starred_key.string_id())
-            except endpoints.NotFoundException:
-                logging.info(strings.logging_delete_unbound_event(
-                        user_id=user_id, calendar_id=calendar_id,
-                        event_id=starred_key.string_id()))
-                starred_key.delete()
-            except gapiutils.OldEventError:
-                pass
-        return events, ids
+        return cls.get_starred_multi([calendar_key], service, time_zone)[0]
+
+    @staticmethod
+    def get_starred_multi(calendar_keys, service, time_zone):
+        """
+        Get the starred events in several calendars, and their ids.
+
+        Only stars that haven't ended, or only seem to have ended recently,
+        are checked with the API, and their end dates are updated with what
+        it says.  The stars of every calendar are checked together.
+
+        :type calendar_keys: list[ndb.Key]
+        :param service: Calendar resource object.
+        :type time_zone: str
+        :return: The events and ids of each calendar, in the same order as
+                 the keys.
+        :rtype: list[(list[messages.EventProperties], list[str])]
+        """
+        now = datetime.utcnow()
+        # Stars saved before end dates were stored are only found here once
+        # garbagecollect.EndDateBackfill, or a sync or collection pass, has
+        # dated them
+        futures = [
+            models.Event.query(
+                models.Event.starred == True,
+                models.Event.end_date >= now - models.Event.GRACE_PERIOD,
+                ancestor=calendar_key).fetch_async()
+            for calendar_key in calendar_keys
+        ]
+        all_entities = [future.get_result() for future in futures]
+
+        # Look up all of the starred events together, in batch requests
+        results = gapiutils.get_event_batch_multi(service, dict(
+            (calendar_key.string_id(),
+             [entity.key.string_id() for entity in entities])
+            for calendar_key, entities in zip(calendar_keys, all_entities)
+        ), time_zone)
+
+        starred = []
+        changed_entities = []
+        deleted_keys = []
+        for calendar_key, entities in zip(calendar_keys, all_entities):
+            events = []
+            ids = []
+            user_id = calendar_key.parent().string_id()
+            calendar_id = calendar_key.string_id()
+            for entity in entities:
+                event_id = entity.key.string_id()
+                event = results[calendar_id][event_id]
+                if isinstance(event, endpoints.NotFoundException):
+                    logging.info(strings.logging_delete_unbound_event(
+                            user_id=user_id, calendar_id=calendar_id,
+                            event_id=event_id))
+                    deleted_keys.append(entity.key)
+                elif isinstance(event, gapiutils.OldEventError):
+                    # Over for good, so the garbage collector can delete it
+                    # without waiting out the grace period
+                    entity.end_date = now - models.Event.GRACE_PERIOD
+                    changed_entities.append(entity)
+                elif isinstance(event, Exception):
+                    raise event
+                else:
+                    end_date = models.Event.get_end_date(event_id, event)
+                    if entity.end_date != end_date:
+                        entity.end_date = end_date
+                        changed_entities.append(entity)
+                    event.starred = True
+                    event.hidden = False
+                    events.append(event)
+                    ids.append(event_id)
+            starred.append((events, ids))
+        ndb.put_multi(changed_entities)
+        ndb.delete_multi(deleted_keys)
+        for calendar_key in set(key.parent() for key in deleted_keys):
+            preferenceutils.refresh_preferences(calendar_key)
+        return starred
+
+    @classmethod
+    def get_cache_key(cls, user_key, page_token):
+        """
+        Get the key of the EventCacheGroup a page token refers to.
+
+        Tokens are the group's string id, or for groups from before groups
+        were keyed by content, their integer id in base 62.
+
+        :type user_key: ndb.Key
+        :type page_token: str
+        :rtype: ndb.Key
+        :raise endpoints.BadRequestException: The token is malformed.
+        """
+        if len(page_token) == models.EventCacheGroup.CONTENT_ID_LENGTH:
+            return ndb.Key(models.EventCacheGroup, page_token,
+                           parent=user_key)
+        try:
+            return ndb.Key(models.EventCacheGroup,
+                           cls.string_base.decode(page_token),
+                           parent=user_key)
+        except (ValueError, KeyError, TypeError):
+            raise endpoints.BadRequestException(strings.ERROR_INVALID_VALUE)
 
     @staticmethod
     def filter_and_update_events(unfiltered_events, starred_event_ids,
-                                 calendar_key, request_hidden):
+                                 preferences, request_hidden):
         """
         Update and prune event list with fields stored in the datastore.
 
+        Hidden state comes from the calendar's cached preference snapshot,
+        rather than from the event entities themselves.
+
         :type unfiltered_events: list[messages.EventProperties]
-        :type starred_event_ids: list[str]
-        :type calendar_key: ndb.Key
+        :type starred_event_ids: collections.Iterable[str]
+        :type preferences: preferenceutils.Preferences
         :type request_hidden: bool
         :rtype: list[messages.EventProperties]
         """
+        starred_event_ids = set(starred_event_ids)
+
         chosen = []
         for event in unfiltered_events:
-            for starred_event_id in starred_event_ids:
-                if (starred_event_id == event.eventId or
-                        starred_event_id == event.recurrenceId):
-                    event.starred = True
-                    break
-            else:
-                event.starred = False
-
+            event.starred = (event.eventId in starred_event_ids or
+                             event.recurrenceId in starred_event_ids)
             if event.starred:
                 # Essentially deletes the event, since it is not added to
                 # chosen.
                 continue
 
-            entity = ndb.Key(models.Event, event.eventId,
-                             parent=calendar_key).get()
-
-            if entity is not None:
-                event.hidden = entity.hidden
-
-            if event.hidden is None and event.recurrenceId is not None:
-                recurrence_entity = ndb.Key(models.Event, event.recurrenceId,
-                                            parent=calendar_key).get()
-                if recurrence_entity is not None:
-                    event.hidden = recurrence_entity.hidden
-
-            if event.hidden is None:
-                event.hidden = False
+            event.hidden = preferenceutils.is_hidden(preferences, event)
 
             if request_hidden is not None and event.hidden != request_hidden:
                 # Essentially deletes the event, since it is not added to
@@ -120,21 +303,36 @@ class EventsAPI(remote.Service):
         """
         Get a list of events for a given calendar.
 
+        If ifNoneMatch is the etag of the response the client already has,
+        and it is still current, only the etag is sent back.
+
         :type request: messages.EVENT_SEARCH_RESOURCE
         """
         user_id = authutils.require_user_id()
 
         request.calendarId = urllib2.unquote(request.calendarId)
+        gapiutils.validate_time_zone(request.timeZone)
 
         user_key = models.get_user_key(user_id)
         service = authutils.get_service(authutils.CALENDAR_API_NAME,
                                         authutils.CALENDAR_API_VERSION)
 
+        # Serve events from the local mirror, after pulling in any changes
+        mirror = syncutils.sync_calendar(
+                service, syncutils.get_mirror_key(user_key, request.calendarId))
+        if mirror.channel_id is None:
+            syncutils.watch_calendar(service, mirror, user_id)
+
         if not request.timeZone:
-            request.timeZone = gapiutils.get_calendar_time_zone(
-                    service, request.calendarId)
-        if request.pageToken:
-            request.pageToken = self.string_base.decode(request.pageToken)
+            request.timeZone = mirror.time_zone
+
+        # Plain listings are paged with signed tokens, so paging costs no
+        # datastore writes.  Searches rank every event pulled together, so
+        # their pages can't be rebuilt from a position, and are cached
+        # instead, as are pages from before signed tokens.
+        if not request.search and (not request.pageToken or
+                                   tokenutils.is_signed(request.pageToken)):
+            return self.list_stateless(request, user_id, service, mirror)
 
         starred_events = []
         """:type: list[messages.EventProperties]"""
@@ -147,23 +345,26 @@ class EventsAPI(remote.Service):
 
         calendar_key = ndb.Key(models.Calendar, request.calendarId,
                                parent=user_key)
+        preferences = preferenceutils.get_preferences(calendar_key)
 
         if request.pageToken:
             # Grab the cache for given page token
-            cache = ndb.Key(models.EventCacheGroup, request.pageToken,
-                            parent=user_key).get()
+            cache = self.get_cache_key(user_key, request.pageToken).get()
             """:type: models.EventCacheGroup"""
 
-            if (cache is None or cache.sequence_hash !=
+            if (cache is None or cache.is_expired() or cache.sequence_hash !=
                     models.EventCacheGroup.get_sequence_hash(request)):
                 raise endpoints.BadRequestException(
                         strings.ERROR_INVALID_VALUE)
+            cache.touch()
 
-            gapi_next_page_token = cache.next_page_token
-            for event_model in cache.items:
-                cached_events.append(event_model.to_message(request.timeZone))
+            if cache.exhausted:
+                continuation = None
+            else:
+                continuation = cache.next_page_token, cache.next_page_offset
+            cached_events = list(cache.iter_events(request.timeZone))
         else:
-            gapi_next_page_token = None
+            continuation = None, 0
 
             # Insert any starred events not included if hidden = False or None.
             if not request.hidden:
@@ -177,81 +378,440 @@ class EventsAPI(remote.Service):
         else:
             extra_starred_ids = []
 
-        events = starred_events[:]
-        """:type: list[messages.EventProperties]"""
-
         if request.search:
             # Initial search, before checking the length
-            events = searchutils.event_keyword_search(events, request.search)
-
-        events += cached_events
-
-        # TODO: handle excluded recurring events better
-        for _ in range(10):
-            if len(events) >= request.maxResults:
-                break
-
-            # Get event list from the google api
-            api_events, gapi_next_page_token = gapiutils.get_events(
-                    service, request.calendarId, request.timeZone,
-                    gapi_next_page_token, request.maxResults)
-
-            api_events = self.filter_and_update_events(
-                    api_events, starred_event_ids, calendar_key, request.hidden)
-
-            if request.search:
-                # Search again after adding more api events
-                api_events = searchutils.event_keyword_search(api_events,
+            starred_events = searchutils.event_keyword_search(starred_events,
                                                               request.search)
 
-            events += api_events
-
-            if gapi_next_page_token is None:
-                break
+        # Runs of events are collected from each source, and the page is
+        # picked out of them at the end.
+        runs = [starred_events, cached_events]
+        """:type: list[list[messages.EventProperties]]"""
+        event_count = len(starred_events) + len(cached_events)
+
+        if continuation is not None:
+            survival_key = self.get_survival_key(user_key, request)
+            survival_rate = self.survival_rates.get(survival_key, 1.0)
+            unfiltered_count = 0
+            filtered_count = 0
+
+            api_event_iter = syncutils.iter_events(mirror, request.timeZone,
+                                                   *continuation)
+
+            # Pull about as many events as should survive filtering to fill
+            # the page, so it usually takes one or two pages.  The page size
+            # can change freely, since the continuation doesn't depend on it.
+            # TODO: handle excluded recurring events better
+            for _ in range(10):
+                if event_count >= request.maxResults:
+                    break
 
-        # Do a final sort after adding all api events
+                pull_count = min(gapiutils.EVENT_PAGE_MAX, int(math.ceil(
+                        (request.maxResults - event_count) / survival_rate)))
+                api_event_iter.page_max = max(request.maxResults, pull_count)
+                api_events = list(itertools.islice(api_event_iter,
+                                                   pull_count))
+                if not api_events:
+                    break
+                unfiltered_count += len(api_events)
+
+                api_events = self.filter_and_update_events(
+                        api_events, starred_event_ids, preferences,
+                        request.hidden)
+                filtered_count += len(api_events)
+
+                if request.search:
+                    # Search again after adding more api events
+                    api_events = searchutils.event_keyword_search(
+                            api_events, request.search)
+
+                runs.append(api_events)
+                event_count += len(api_events)
+
+            continuation = api_event_iter.continuation
+            self.update_survival_rate(survival_key, survival_rate,
+                                      unfiltered_count, filtered_count)
+
+        # Every input to the page is known now.  If the client already has
+        # the response they make, merging and caching can be skipped.
+        etag = etagutils.get_etag(
+                request.search, request.hidden, request.timeZone,
+                request.maxResults, request.calendarId, request.pageToken,
+                runs, continuation, extra_starred_ids)
+        etag_key = u"{}:{}".format(user_id, etag)
+        if etagutils.is_not_modified(request.ifNoneMatch, etag):
+            next_page_token = self.list_etags.get(etag_key)
+            if next_page_token is not None:
+                return messages.EventCollection(
+                    nextPageToken=next_page_token or None,
+                    etag=etag,
+                    notModified=True
+                )
+
+        # Pick the page being returned out of the runs.  The rest is cached
+        # for the next page unsorted, and only sorted if that page is asked
+        # for.
         if request.search:
-            events = searchutils.event_keyword_chron_sort(events,
-                                                          request.search)
+            order = searchutils.event_keyword_chron_order(
+                    list(itertools.chain.from_iterable(runs)), request.search)
         else:
-            events = searchutils.event_chron_sort(events)
-
-        if len(events) >= request.maxResults:
-            # Save extra for later
-            events, extra = (events[:request.maxResults],
-                             events[request.maxResults:])
+            order = searchutils.event_chron_order()
+        events, extra = searchutils.merge_page(runs, order,
+                                               request.maxResults)
 
+        if len(events) >= request.maxResults and (
+                extra or continuation is not None):
             # Make a new cache object
+            if continuation is not None:
+                next_page_token, next_page_offset = continuation
+            else:
+                next_page_token, next_page_offset = None, 0
             new_cache = models.EventCacheGroup(
-                next_page_token=gapi_next_page_token,
+                next_page_token=next_page_token,
+                next_page_offset=next_page_offset,
+                exhausted=continuation is None,
                 extra_starred_ids=extra_starred_ids,
                 parent=user_key
             )
-            assert new_cache.items == []
-            for extra_event in extra:
-                new_cache.items.append(
-                        models.EventCache.from_message(extra_event))
+            new_cache.set_events(extra)
             new_cache.generate_hashes(request)
 
-            # Check for duplicates, save new_cache if not
-            query = models.EventCacheGroup.query(
-                models.EventCacheGroup.unique_hash == new_cache.unique_hash,
-                ancestor=user_key
-            )
-            assert len(query.fetch()) <= 1
-            for key in query.iter(keys_only=True):
-                cache_key = key
-                break
+            # Identical groups have the same key, so only save new_cache if
+            # there isn't one already
+            existing_cache = new_cache.key.get()
+            if existing_cache is not None:
+                existing_cache.touch()
+            else:
+                new_cache.put()
+            next_page_token = new_cache.key.string_id()
+        else:
+            next_page_token = None
+        self.list_etags.set(etag_key, next_page_token or "")
+
+        return messages.EventCollection(
+            items=events,
+            nextPageToken=next_page_token,
+            etag=etag
+        )
+
+    def list_stateless(self, request, user_id, service, mirror):
+        """
+        Get a page of events without a search, paged with signed tokens.
+
+        The token records where the mirror should resume, right after the
+        last of its events on the page, how many starred events have been
+        returned, and the chunk size the mirror was read in.  The next page
+        is rebuilt from there, so nothing is saved between pages, and later
+        pages keep the first page's chunk size.
+
+        A page only changes when the mirror syncs changes, the calendar's
+        preferences change, or one of its events ends, so if none of those
+        has happened since the client's copy was sent, the page isn't
+        rebuilt.
+
+        :type request: messages.EVENT_SEARCH_RESOURCE
+        :type user_id: unicode
+        :param service: Calendar resource object.
+        :type mirror: models.CalendarMirror
+        :rtype: messages.EventCollection
+        """
+        user_key = models.get_user_key(user_id)
+        calendar_key = ndb.Key(models.Calendar, request.calendarId,
+                               parent=user_key)
+
+        # Tokens only work for the same user and request parameters
+        token_context = "{}:{}".format(
+                user_id,
+                models.EventCacheGroup.get_sequence_hash(request).encode("hex"))
+
+        if request.pageToken:
+            state = tokenutils.verify(request.pageToken, token_context)
+            try:
+                continuation = state["mirror"]
+                if continuation is not None:
+                    page_token, offset = continuation
+                    continuation = page_token, int(offset)
+                starred_offset = state["starred"]
+                if starred_offset is not None:
+                    starred_offset = int(starred_offset)
+                # Tokens from before chunk sizes were saved have none
+                chunk_size = state.get("chunk")
+                if chunk_size is not None:
+                    chunk_size = int(chunk_size)
+            except (TypeError, ValueError, KeyError, AttributeError):
+                raise endpoints.BadRequestException(
+                        strings.ERROR_INVALID_VALUE)
+        else:
+            continuation = None, 0
+            # Starred events are only listed if hidden = False or None.
+            starred_offset = None if request.hidden else 0
+            chunk_size = None
+
+        # Everything the page is built from, other than the time
+        inputs_key = None
+        preferences_version = preferenceutils.get_version(calendar_key)
+        if preferences_version is not None:
+            inputs_key = u"{}:{}".format(user_id, etagutils.get_etag(
+                    mirror.sync_token, mirror.horizon, preferences_version,
+                    request.hidden, request.timeZone, request.maxResults,
+                    request.calendarId, request.pageToken))
+            sent = self.stateless_etags.get(inputs_key)
+            if sent is not None:
+                etag, next_page_token, expires = sent
+                if (etagutils.is_not_modified(request.ifNoneMatch, etag) and
+                        (expires is None or expires > datetime.utcnow())):
+                    return messages.EventCollection(
+                        nextPageToken=next_page_token or None,
+                        etag=etag,
+                        notModified=True
+                    )
+
+        survival_key = self.get_survival_key(user_key, request)
+        survival_rate = self.survival_rates.get(survival_key, 1.0)
+
+        if chunk_size is None:
+            chunk_size = max(request.maxResults, min(
+                    gapiutils.EVENT_PAGE_MAX,
+                    int(math.ceil(request.maxResults / survival_rate))))
+
+        # Starred events are listed on their own, so they are always left
+        # out of the mirror's events.
+        preferences = preferenceutils.get_preferences(calendar_key)
+
+        starred_events = []
+        """:type: list[messages.EventProperties]"""
+        if starred_offset is not None:
+            starred_events = searchutils.event_chron_sort(self.get_starred(
+                    calendar_key, service, request.timeZone)[0])
+            starred_events = starred_events[starred_offset:]
+
+        streams = [((event, None) for event in starred_events)]
+        if continuation is not None:
+            mirror_stream = _VisibleEventStream(
+                    mirror, request.timeZone, continuation, preferences,
+                    chunk_size, request.hidden)
+            streams.append(mirror_stream)
+        else:
+            mirror_stream = None
+
+        merged_events = searchutils.merge_tagged(
+                streams, searchutils.event_chron_order())
+        page = list(itertools.islice(merged_events, request.maxResults))
+
+        # Work out where the next page should pick up
+        starred_returned = 0
+        mirror_returned = 0
+        for event, tag in page:
+            if tag is None:
+                starred_returned += 1
+            else:
+                continuation = tag[1]
+                mirror_returned += 1
+
+        if mirror_stream is not None:
+            if (mirror_stream.finished and
+                    mirror_returned == mirror_stream.yielded):
+                continuation = None
+            self.update_survival_rate(survival_key, survival_rate,
+                                      mirror_stream.pulled,
+                                      mirror_stream.yielded)
+
+        if starred_offset is not None:
+            if starred_returned < len(starred_events):
+                starred_offset += starred_returned
             else:
-                cache_key = None
-            if cache_key is None:
-                cache_key = new_cache.put()
-            next_page_token = self.string_base.encode(cache_key.integer_id())
+                starred_offset = None
+
+        if continuation is not None or starred_offset is not None:
+            next_page_token = tokenutils.sign(dict(
+                mirror=continuation,
+                starred=starred_offset,
+                chunk=chunk_size
+            ), token_context)
         else:
             next_page_token = None
 
+        events = [event for event, _ in page]
+        etag = etagutils.get_etag(events, next_page_token)
+        if inputs_key is not None:
+            # The page stays the same until the first of its events ends
+            if events:
+                expires = min(event.endDate for event in events).astimezone(
+                        pytz.utc).replace(tzinfo=None)
+            else:
+                expires = None
+            self.stateless_etags.set(inputs_key, (etag, next_page_token or "",
+                                                  expires))
+        if etagutils.is_not_modified(request.ifNoneMatch, etag):
+            return messages.EventCollection(
+                nextPageToken=next_page_token,
+                etag=etag,
+                notModified=True
+            )
+
         return messages.EventCollection(
             items=events,
+            nextPageToken=next_page_token,
+            etag=etag
+        )
+
+    @staticmethod
+    def encode_upcoming_token(user_id, continuations, starred_offset):
+        """
+        Encode the state of an upcoming events listing as a page token.
+
+        :type user_id: unicode
+        :param dict[str, (str, int)] continuations: Where to resume each
+                                                    calendar that has events
+                                                    left.
+        :param int starred_offset: How many starred events have been
+                                   returned, or None if all of them have.
+        :rtype: str
+        """
+        return tokenutils.sign(dict(
+            calendars=continuations,
+            starred=starred_offset
+        ), u"upcoming:{}".format(user_id).encode("utf-8"))
+
+    @staticmethod
+    def decode_upcoming_token(user_id, page_token):
+        """
+        Decode a page token from encode_upcoming_token.
+
+        :type user_id: unicode
+        :type page_token: str
+        :rtype: (dict[str, (str, int)], int)
+        :raise endpoints.BadRequestException: The token is malformed.
+        """
+        state = tokenutils.verify(
+                page_token, u"upcoming:{}".format(user_id).encode("utf-8"))
+        try:
+            continuations = dict((cal_id, (token, int(offset)))
+                                 for cal_id, (token, offset)
+                                 in state["calendars"].iteritems())
+            starred_offset = state["starred"]
+            if starred_offset is not None:
+                starred_offset = int(starred_offset)
+        except (TypeError, ValueError, KeyError, AttributeError):
+            raise endpoints.BadRequestException(strings.ERROR_INVALID_VALUE)
+        return continuations, starred_offset
+
+    @endpoints.method(messages.UPCOMING_RESOURCE, messages.EventCollection,
+                      http_method="GET", path="/events")
+    def upcoming(self, request):
+        """
+        Get the next events across all of the user's calendars.
+
+        Hidden calendars and hidden events are left out, and starred events
+        come first.  One page token covers every calendar.
+
+        :type request: messages.UPCOMING_RESOURCE
+        """
+        user_id = authutils.require_user_id()
+        gapiutils.validate_time_zone(request.timeZone)
+
+        user_key = models.get_user_key(user_id)
+        service = authutils.get_service(authutils.CALENDAR_API_NAME,
+                                        authutils.CALENDAR_API_VERSION)
+
+        if not request.timeZone:
+            # Time zones are cached by real calendar id, not by the alias
+            request.timeZone = gapiutils.get_calendar_time_zone(
+                    service, gapiutils.get_primary_calendar_id(service))
+
+        if request.pageToken:
+            continuations, starred_offset = self.decode_upcoming_token(
+                    user_id, request.pageToken)
+        else:
+            # Start at the beginning of every calendar that isn't hidden
+            hidden_query = models.Calendar.query(
+                    models.Calendar.hidden == True, ancestor=user_key)
+            hidden_ids = set(key.string_id() for key in
+                             hidden_query.iter(keys_only=True))
+            continuations = dict(
+                (calendar.calendarId, (None, 0))
+                for calendar in gapiutils.get_calendars(service)
+                if calendar.calendarId not in hidden_ids
+            )
+            starred_offset = 0
+
+        # Sync all of the calendars' mirrors together
+        cal_ids = sorted(continuations)
+        mirrors = syncutils.sync_calendars(
+                service, [syncutils.get_mirror_key(user_key, cal_id)
+                          for cal_id in cal_ids])
+        syncutils.watch_calendars(
+                service, [mirror for mirror in mirrors
+                          if mirror is not None and mirror.channel_id is None],
+                user_id)
+
+        # Starred ids are needed on every page to leave starred events out of
+        # the calendars, but the events themselves are only fetched while
+        # there are still some to return.
+        all_preferences = dict(zip(
+                cal_ids, preferenceutils.get_preferences_multi(
+                    [ndb.Key(models.Calendar, cal_id, parent=user_key)
+                     for cal_id in cal_ids])))
+        starred_ids = dict((cal_id, preferences.starred)
+                           for cal_id, preferences
+                           in all_preferences.iteritems()
+                           if preferences.starred)
+
+        starred_events = []
+        """:type: list[messages.EventProperties]"""
+        if starred_offset is not None:
+            for events, _ in self.get_starred_multi(
+                    [ndb.Key(models.Calendar, cal_id, parent=user_key)
+                     for cal_id in sorted(starred_ids)],
+                    service, request.timeZone):
+                starred_events += events
+            starred_events = searchutils.event_chron_sort(
+                    starred_events)[starred_offset:]
+
+        # Calendars that couldn't be synced are left out of this page, but
+        # keep their continuations, so they are tried again on the next
+        streams = [
+            _VisibleEventStream(
+                mirror, request.timeZone, continuations[cal_id],
+                all_preferences[cal_id], request.maxResults)
+            for cal_id, mirror in zip(cal_ids, mirrors) if mirror is not None
+        ]
+
+        # Merge the calendars, only pulling events from each as needed
+        merged_events = searchutils.merge_tagged(
+                [((event, None) for event in starred_events)] + streams,
+                searchutils.event_chron_order())
+        page = list(itertools.islice(merged_events, request.maxResults))
+
+        # Work out where each calendar should pick up on the next page
+        emitted = dict((cal_id, 0) for cal_id in cal_ids)
+        starred_returned = 0
+        for event, tag in page:
+            if tag is None:
+                starred_returned += 1
+            else:
+                cal_id, continuation = tag
+                continuations[cal_id] = continuation
+                emitted[cal_id] += 1
+        for stream in streams:
+            if ((stream.finished and emitted[stream.cal_id] == stream.yielded)
+                    or continuations[stream.cal_id] is None):
+                del continuations[stream.cal_id]
+
+        if starred_offset is not None:
+            if starred_returned < len(starred_events):
+                starred_offset += starred_returned
+            else:
+                starred_offset = None
+
+        if continuations or starred_offset is not None:
+            next_page_token = self.encode_upcoming_token(
+                    user_id, continuations, starred_offset)
+        else:
+            next_page_token = None
+
+        return messages.EventCollection(
+            items=[event for event, _ in page],
             nextPageToken=next_page_token
         )
 
@@ -266,13 +826,24 @@ class EventsAPI(remote.Service):
         user_id = authutils.require_user_id()
 
         request.calendarId = urllib2.unquote(request.calendarId)
+        gapiutils.validate_time_zone(request.timeZone)
 
         service = authutils.get_service(authutils.CALENDAR_API_NAME,
                                         authutils.CALENDAR_API_VERSION)
-        event = gapiutils.get_event(service, request.calendarId,
-                                    request.eventId, request.timeZone)
-
         user_key = models.get_user_key(user_id)
+
+        # Try the calendar's mirror first, if it has one.  Recurring events
+        # are only mirrored as instances, so those always miss.
+        event = None
+        mirror_key = syncutils.get_mirror_key(user_key, request.calendarId)
+        if mirror_key.get() is not None:
+            mirror = syncutils.sync_calendar(service, mirror_key)
+            event = syncutils.get_event(mirror, request.eventId,
+                                        request.timeZone)
+        if event is None:
+            event = gapiutils.get_event(service, request.calendarId,
+                                        request.eventId, request.timeZone)
+
         cal_key = ndb.Key(models.Calendar, request.calendarId, parent=user_key)
         entity = ndb.Key(models.Event, request.eventId, parent=cal_key).get()
 
@@ -297,11 +868,12 @@ class EventsAPI(remote.Service):
         :type event_id: str
         :rtype: models.Event
         """
-        # Validate event's existence
+        # Validate event's existence, and find when it ends.  This takes the
+        # whole event, not just a validation, since its end date and
+        # recurrence id decide when the entity is collected.
         service = authutils.get_service(authutils.CALENDAR_API_NAME,
                                         authutils.CALENDAR_API_VERSION)
-        gapiutils.get_event(service, calendar_id, event_id, "UTC",
-                            validation_only=True)
+        event = gapiutils.get_event(service, calendar_id, event_id, "UTC")
 
         # Get ndb key for calendar
         user_key = models.get_user_key(user_id)
@@ -311,6 +883,7 @@ class EventsAPI(remote.Service):
         entity = ndb.Key(models.Event, event_id, parent=cal_key).get()
         if entity is None:
             entity = models.Event(id=event_id, parent=cal_key)
+        entity.end_date = models.Event.get_end_date(event_id, event)
         return entity
 
     @endpoints.method(messages.EVENT_WRITE_RESOURCE,
@@ -341,6 +914,7 @@ class EventsAPI(remote.Service):
             entity.starred = False
 
         entity.put()
+        preferenceutils.refresh_preferences(entity.key.parent())
         return messages.EventWriteProperties(
                 hidden=entity.hidden,
                 starred=entity.starred)
@@ -368,6 +942,7 @@ class EventsAPI(remote.Service):
         # null, delete the entity.
         if request.hidden is None and request.starred is None:
             entity.key.delete()
+            preferenceutils.refresh_preferences(entity.key.parent())
             return messages.EventWriteProperties()
         else:
             entity.hidden = request.hidden
@@ -376,6 +951,7 @@ class EventsAPI(remote.Service):
                 entity.starred = False
 
             entity.put()
+            preferenceutils.refresh_preferences(entity.key.parent())
             return messages.EventWriteProperties(
                     hidden=entity.hidden,
                     starred=entity.starred)
@@ -2,9 +2,14 @@
 
 from __future__ import division, print_function
 
+import abc
+import collections
+import hashlib
 import httplib
+import itertools
 import logging
-from datetime import datetime, tzinfo
+import threading
+from datetime import datetime, timedelta, tzinfo
 
 from endpoints import api_exceptions
 from googleapiclient.errors import HttpError
@@ -12,7 +17,9 @@ import pytz
 from oauth2client.client import AccessTokenCredentialsError
 
 import messages
+import recurrenceutils
 import strings
+import cacheutils
 
 __author__ = "Alexander Otavka"
 __copyright__ = "Copyright (C) 2015 DHS Developers Club"
@@ -22,6 +29,13 @@ CALENDAR_FIELDS = "id,summary,backgroundColor"
 EVENT_FIELDS = "id,recurringEventId,summary,start,end,htmlLink"
 CALENDAR_LIST_FIELDS = "nextPageToken,items({})".format(CALENDAR_FIELDS)
 EVENT_LIST_FIELDS = "nextPageToken,timeZone,items({})".format(EVENT_FIELDS)
+EVENT_SYNC_FIELDS = ("nextPageToken,nextSyncToken,timeZone,items({},status)"
+                     .format(EVENT_FIELDS))
+SERIES_FIELDS = ("nextPageToken,items({},recurrence,status,originalStartTime)"
+                 .format(EVENT_FIELDS))
+
+# The largest page events.list will return.
+EVENT_PAGE_MAX = 2500
 
 HTTP_ERRORS = {
     httplib.BAD_REQUEST: api_exceptions.BadRequestException,
@@ -36,11 +50,71 @@ HTTP_ERRORS = {
     httplib.INTERNAL_SERVER_ERROR: api_exceptions.InternalServerErrorException
 }
 
+# The Calendar API accepts at most 50 calls in a single batch request.
+BATCH_MAX = 50
+
+# Calendar id that stands for each user's own primary calendar.  Time zones
+# are cached app wide by calendar id, so this one can't be cached.
+PRIMARY_CALENDAR_ID = "primary"
+
+TIME_ZONE_CACHE_SIZE = 1000
+TIME_ZONE_CACHE_TTL = 6 * 60 * 60  # seconds
+
+# Forgetting a time zone only reaches memcache and this instance, so other
+# instances check memcache again after this long.
+TIME_ZONE_LOCAL_TTL = 5 * 60  # seconds
+
+_time_zone_cache = cacheutils.TieredCache("calendar_time_zones",
+                                          TIME_ZONE_CACHE_SIZE,
+                                          TIME_ZONE_CACHE_TTL,
+                                          TIME_ZONE_LOCAL_TTL)
+
+RESPONSE_CACHE_SIZE = 500
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # seconds
+
+_response_cache = cacheutils.TieredCache("api_responses",
+                                         RESPONSE_CACHE_SIZE,
+                                         RESPONSE_CACHE_TTL)
+
+# The response cache's counts are logged after every this many queries.
+RESPONSE_CACHE_STATS_INTERVAL = 1000
+
+SERIES_CACHE_SIZE = 1000
+SERIES_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Recurring events are checked for changes since they were last fetched,
+# less this, in case of clock skew.
+SERIES_SYNC_MARGIN = timedelta(minutes=5)
+
+_series_cache = cacheutils.TieredCache("recurring_series", SERIES_CACHE_SIZE,
+                                       SERIES_CACHE_TTL)
+
+_response_cache_stats = collections.Counter()
+_response_cache_stats_lock = threading.Lock()
+
 
 class OldEventError(api_exceptions.ForbiddenException):
     pass
 
 
+def _get_http_exception(error):
+    """
+    Convert an HttpError from the API client to an endpoints exception.
+
+    :type error: HttpError
+    :rtype: api_exceptions.ServiceException
+    """
+    logging.error(error)
+    if error.resp.status in HTTP_ERRORS:
+        return HTTP_ERRORS[error.resp.status]()
+    else:
+        assert (error.resp.status // 100) in (4, 5)
+        if error.resp.status // 100 == 4:
+            return api_exceptions.BadRequestException()
+        else:
+            return api_exceptions.InternalServerErrorException()
+
+
 def _execute_query(query):
     """
     Execute the query, and raise any errors properly.
@@ -50,18 +124,163 @@ def _execute_query(query):
     try:
         return query.execute()
     except HttpError as e:
-        logging.error(e)
-        if e.resp.status in HTTP_ERRORS:
-            raise HTTP_ERRORS[e.resp.status]
-        else:
-            assert (e.resp.status // 100) in (4, 5)
-            raise HTTP_ERRORS[e.resp.status // 100]
+        raise _get_http_exception(e)
     except AccessTokenCredentialsError:
         # authutils.clear_stored_user_credentials()
         raise api_exceptions.UnauthorizedException("Access token expired or "
                                                    "invalid.")
 
 
+def _count_response(outcome):
+    """
+    Count how a query fared against the response cache in this process.
+
+    "hits" are queries answered with 304 Not Modified and served from the
+    cache, "misses" are queries that downloaded a full response, and
+    "uncached" are queries that could not be made conditional.  The counts
+    are logged every RESPONSE_CACHE_STATS_INTERVAL queries.
+
+    :type outcome: str
+    """
+    with _response_cache_stats_lock:
+        _response_cache_stats[outcome] += 1
+        if (sum(_response_cache_stats.values()) %
+                RESPONSE_CACHE_STATS_INTERVAL):
+            return
+        stats = dict(_response_cache_stats)
+    logging.info(strings.logging_response_cache_stats(
+            hits=stats.get("hits", 0), misses=stats.get("misses", 0),
+            uncached=stats.get("uncached", 0)))
+
+
+def _get_response_cache_key(query):
+    """
+    Get the key a GET query's response is cached under.
+
+    Responses are only shared between queries made for the same user, so
+    one user's data is never served to another.  Users are told apart by
+    the id authutils.get_service tags their services with, rather than by
+    access token, which changes every hour.
+
+    :param query: API query.
+    :return: The cache key, or None if the query can't be cached.
+    :rtype: str
+    """
+    user_id = getattr(query.http, "user_id", None)
+    if query.method != "GET" or not user_id:
+        return None
+    return hashlib.sha1(u"{}\n{}".format(user_id, query.uri)
+                        .encode("utf-8")).hexdigest()
+
+
+def _execute_cached_query(query):
+    """
+    Execute a GET query conditionally, reusing a cached response if it has
+    not changed.
+
+    The response's ETag is cached along with its body, and sent back as
+    If-None-Match the next time the same query is made.  A 304 Not
+    Modified answer is then served from the cache, which saves downloading
+    and parsing the body, and is cheap against the API quota.
+
+    :param query: API query.
+    """
+    key = _get_response_cache_key(query)
+    if key is None:
+        _count_response("uncached")
+        return _execute_query(query)
+
+    cached = _response_cache.get(key)
+    if cached is not None:
+        query.headers["If-None-Match"] = cached[0]
+
+    # Keep the ETag header, which the API client otherwise throws away
+    postproc = query.postproc
+    query.postproc = lambda resp, content: (resp.get("etag"),
+                                            postproc(resp, content))
+
+    try:
+        etag, result = query.execute()
+    except HttpError as e:
+        if cached is not None and e.resp.status == httplib.NOT_MODIFIED:
+            _count_response("hits")
+            return cached[1]
+        raise _get_http_exception(e)
+    except AccessTokenCredentialsError:
+        raise api_exceptions.UnauthorizedException("Access token expired or "
+                                                   "invalid.")
+
+    _count_response("misses")
+    if etag:
+        _response_cache.set(key, (etag, result))
+    return result
+
+
+def validate_time_zone(time_zone):
+    """
+    Check that a time zone from a request is one that can be used.
+
+    :param str time_zone: The time zone, or None to use the calendar's.
+    :raise api_exceptions.BadRequestException: It isn't a known time zone.
+    """
+    if time_zone:
+        try:
+            pytz.timezone(time_zone)
+        except pytz.UnknownTimeZoneError:
+            raise api_exceptions.BadRequestException(
+                    strings.ERROR_INVALID_VALUE)
+
+
+def _execute_batch(service, queries):
+    """
+    Execute several queries using as few batch requests as possible.
+
+    Errors are not raised, but returned in place of the failed query's
+    result, so that one failure does not spoil the whole batch.  A single
+    query is sent on its own, without the overhead of a batch request.
+
+    :param service: Resource object the queries were built from.
+    :type queries: dict[T, googleapiclient.http.HttpRequest]
+    :return: Map from each key in queries to its result or exception.
+    :rtype: dict[T, dict | api_exceptions.ServiceException]
+    """
+    results = {}
+    keys = list(queries)
+
+    if len(keys) == 1:
+        try:
+            results[keys[0]] = queries[keys[0]].execute()
+        except HttpError as e:
+            results[keys[0]] = _get_http_exception(e)
+        except AccessTokenCredentialsError:
+            raise api_exceptions.UnauthorizedException(
+                    "Access token expired or invalid.")
+        return results
+
+    def callback(request_id, response, exception):
+        key = keys[int(request_id)]
+        if exception is None:
+            results[key] = response
+        elif isinstance(exception, HttpError):
+            results[key] = _get_http_exception(exception)
+        else:
+            raise exception
+
+    for start in range(0, len(keys), BATCH_MAX):
+        batch = service.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + BATCH_MAX, len(keys))):
+            batch.add(queries[keys[i]], request_id=str(i))
+        try:
+            batch.execute()
+        except HttpError as e:
+            raise _get_http_exception(e)
+        except AccessTokenCredentialsError:
+            raise api_exceptions.UnauthorizedException(
+                    "Access token expired or invalid.")
+
+    return results
+
+
 def get_calendars(service):
     """
     Return a list of the current user's calendars.
@@ -73,7 +292,7 @@ def get_calendars(service):
     calendars = []
 
     while True:
-        result = _execute_query(service.calendarList().list(
+        result = _execute_cached_query(service.calendarList().list(
             fields=CALENDAR_LIST_FIELDS,
             pageToken=page_token
         ))
@@ -105,7 +324,7 @@ def get_calendar(service, cal_id, validation_only=False):
     :rtype: messages.CalendarProperties
     """
     fields = "kind" if validation_only else CALENDAR_FIELDS
-    result = _execute_query(service.calendarList().get(
+    result = _execute_cached_query(service.calendarList().get(
         fields=fields,
         calendarId=cal_id
     ))
@@ -125,14 +344,69 @@ def get_calendar_time_zone(service, cal_id):
     """
     Get string time zone of calendar.
 
+    Time zones are cached by calendar id, so the API is only called when
+    the cache has neither seen a calendarList.get nor an events.list
+    response for the calendar recently.  The primary calendar alias means
+    a different calendar for each user, so it is never cached.
+
     :param service: Calendar resource object.
     :type cal_id: str
     :rtype: str
     """
-    return _execute_query(service.calendarList().get(
-        fields="timeZone",
-        calendarId=cal_id
-    ))["timeZone"]
+    if cal_id == PRIMARY_CALENDAR_ID:
+        time_zone = None
+    else:
+        time_zone = _time_zone_cache.get(cal_id)
+    if time_zone is None:
+        result = _execute_cached_query(service.calendarList().get(
+            fields="id,timeZone",
+            calendarId=cal_id
+        ))
+        time_zone = result["timeZone"]
+        remember_calendar_time_zone(result["id"], time_zone)
+    return time_zone
+
+
+def get_primary_calendar_id(service):
+    """
+    Get the real id of the current user's primary calendar.
+
+    Its time zone is cached along the way, under that id.
+
+    :param service: Calendar resource object.
+    :rtype: str
+    """
+    result = _execute_cached_query(service.calendarList().get(
+        fields="id,timeZone",
+        calendarId=PRIMARY_CALENDAR_ID
+    ))
+    remember_calendar_time_zone(result["id"], result["timeZone"])
+    return result["id"]
+
+
+def remember_calendar_time_zone(cal_id, time_zone):
+    """
+    Add a calendar time zone from some other API response to the cache.
+
+    :type cal_id: str
+    :type time_zone: str
+    """
+    if cal_id == PRIMARY_CALENDAR_ID:
+        return
+    if time_zone and _time_zone_cache.get(cal_id) != time_zone:
+        _time_zone_cache.set(cal_id, time_zone)
+
+
+def forget_calendar_time_zone(cal_id):
+    """
+    Remove a calendar's time zone from the cache.
+
+    Other instances may keep using their copy for up to
+    TIME_ZONE_LOCAL_TTL seconds.
+
+    :type cal_id: str
+    """
+    _time_zone_cache.delete(cal_id)
 
 
 def datetime_from_string(string, time_zone):
@@ -165,121 +439,387 @@ def datetime_from_date_string(string, time_zone):
     return datetime_object
 
 
-def get_events(service, cal_id, time_zone, page_token, page_max):
+class EventIterator(object):
+    """
+    Lazily iterate over upcoming events, fetching a page at a time.
+
+    A page is only fetched once every event before it has been consumed,
+    and events are only parsed as they are yielded.  At any point, the
+    continuation can be passed to a new iterator to pick up where this one
+    left off.
+
+    Subclasses implement _fetch_page and _parse_item, and _get_position if
+    they can resume right after any item, rather than from an offset into
+    a page.
+
+    :type page_max: int
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, page_token=None, offset=0, page_max=None):
+        """
+        :param str page_token: Token of the page to start on.
+        :param int offset: Number of items to skip on the first page.
+        :param int page_max: Maximum number of items to fetch per page.
+                             Can be changed at any time, and takes effect
+                             from the next page.
+        """
+        self.page_max = page_max
+        self._page_token = page_token or None
+        self._offset = offset
+        self._items = None
+        self._next_page_token = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """
+        Get the next event, fetching the next page if needed.
+
+        :rtype: messages.EventProperties
+        """
+        while True:
+            if self._items is not None and self._offset >= len(self._items):
+                if self._next_page_token is None:
+                    raise StopIteration
+                self._page_token = self._next_page_token
+                self._offset = 0
+                self._items = None
+
+            if self._items is None:
+                self._items, self._next_page_token = self._fetch_page(
+                        self._page_token, self.page_max)
+                continue
+
+            item = self._items[self._offset]
+            self._offset += 1
+            event = self._parse_item(item)
+            if event is not None:
+                return event
+
+    @property
+    def continuation(self):
+        """
+        Where to resume iterating, right after the last event yielded.
+
+        :return: A page token and offset for a new iterator, or None if
+                 there are no events left.
+        :rtype: (str, int)
+        """
+        if self._items is not None and self._offset >= len(self._items):
+            if self._next_page_token is None:
+                return None
+            return self._next_page_token, 0
+        if self._items is not None and self._offset > 0:
+            position = self._get_position(self._items[self._offset - 1])
+            if position is not None:
+                return position, 0
+        return self._page_token, self._offset
+
+    @abc.abstractmethod
+    def _fetch_page(self, page_token, page_max):
+        """
+        Fetch the raw items of a page.
+
+        :type page_token: str
+        :param int page_max: Maximum number of items to fetch.
+        :return: The page's items and the next page's token.
+        :rtype: (list, str)
+        """
+        pass
+
+    @abc.abstractmethod
+    def _parse_item(self, item):
+        """
+        Convert a raw item to an event.
+
+        :return: The event, or None to skip the item.
+        :rtype: messages.EventProperties
+        """
+        pass
+
+    def _get_position(self, item):
+        """
+        Get a page token that starts right after an item.
+
+        Continuations made from these stay right, even if items are added
+        or removed before them, or pages are fetched at another size.
+
+        :return: The page token, or None if pages can only be resumed from
+                 an offset.
+        :rtype: str
+        """
+        return None
+
+
+def _sync_events_query(service, cal_id, sync_token, page_token, time_max):
     """
-    Return a list of events for a given calendar.
+    Build an events.list query for one page of a sync.
 
     :param service: Calendar resource object.
     :type cal_id: str
-    :type time_zone: str
+    :type sync_token: str
     :type page_token: str
-    :type page_max: int
-    :rtype: (list[messages.EventProperties], str)
+    :param datetime time_max: Naive UTC time a full sync stops at, or None.
+    :return: API query.
     """
-    events = []
-    result = _execute_query(service.events().list(
-        fields=EVENT_LIST_FIELDS,
+    if sync_token:
+        # The API refuses timeMin and timeMax along with a sync token
+        time_min = None
+        time_max = None
+    else:
+        time_min = pytz.utc.localize(datetime.utcnow()).isoformat()
+        if time_max is not None:
+            time_max = pytz.utc.localize(time_max).isoformat()
+    return service.events().list(
+        fields=EVENT_SYNC_FIELDS,
         calendarId=cal_id,
         pageToken=page_token,
-        maxResults=page_max,
-        timeMin=pytz.utc.localize(datetime.utcnow()).isoformat(),
-        timeZone=time_zone,
-        singleEvents=True,
-        orderBy="startTime"
-    ))
+        syncToken=sync_token,
+        maxResults=EVENT_PAGE_MAX,
+        timeMin=time_min,
+        timeMax=time_max,
+        timeZone="UTC",
+        singleEvents=True
+    )
 
-    tzinfo_object = pytz.timezone(time_zone or result["timeZone"])
 
-    for item in result["items"]:
-        if "recurringEventId" in item:
-            recurrence_id = item["recurringEventId"]
-        else:
-            recurrence_id = None
+def _finish_sync(service, cal_id, sync_token, result, time_max):
+    """
+    Collect the changes from the first page of a sync, and all later pages.
 
-        if "summary" in item:
-            name = item["summary"]
-        else:
-            name = None
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type sync_token: str
+    :param dict result: The first page of the sync.
+    :type time_max: datetime
+    :rtype: (list[dict], list[str], str, str)
+    """
+    changed = []
+    deleted = []
 
-        assert "start" in item
-        start = item["start"]
-        if "dateTime" in start:
-            start_date = datetime_from_string(start["dateTime"], tzinfo_object)
-        else:
-            start_date = datetime_from_date_string(start["date"], tzinfo_object)
+    while True:
+        for item in result["items"]:
+            if item.get("status") == "cancelled":
+                deleted.append(item["id"])
+            else:
+                changed.append(item)
 
-        assert "end" in item
-        end = item["end"]
-        if "dateTime" in end:
-            end_date = datetime_from_string(end["dateTime"], tzinfo_object)
-        else:
-            end_date = datetime_from_date_string(end["date"], tzinfo_object)
-
-        assert "id" in item
-        assert "htmlLink" in item
-        event = messages.EventProperties(
-            eventId=item["id"],
-            calendarId=cal_id,
-            name=name,
-            startDate=start_date,
-            endDate=end_date,
-            hidden=None,
-            starred=None,
-            link=item["htmlLink"],
-            recurrenceId=recurrence_id
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            break
+        result = _execute_query(_sync_events_query(
+                service, cal_id, sync_token, page_token, time_max))
+
+    remember_calendar_time_zone(cal_id, result["timeZone"])
+    return changed, deleted, result.get("nextSyncToken"), result["timeZone"]
+
+
+def sync_events(service, cal_id, sync_token, time_max=None):
+    """
+    Get all of the changes to a calendar's events since the last sync.
+
+    Without a sync token, all upcoming events are returned, or only those
+    that start before time_max, along with a token for getting changes
+    since then.  Changes after that include events past time_max.
+    Recurring events are expanded into instances.  Times in the returned
+    items are in UTC.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type sync_token: str
+    :param datetime time_max: Naive UTC time a full sync stops at.
+    :return: Changed items, ids of deleted events, the next sync token, and
+             the calendar's time zone.
+    :rtype: (list[dict], list[str], str, str)
+    :raise api_exceptions.GoneException: The sync token has expired, and a
+                                         full sync is needed.
+    """
+    result = _execute_query(_sync_events_query(service, cal_id, sync_token,
+                                               None, time_max))
+    return _finish_sync(service, cal_id, sync_token, result, time_max)
+
+
+def sync_events_batch(service, sync_tokens, time_max=None):
+    """
+    Sync several calendars at once, with the first pages in batch requests.
+
+    Incremental syncs rarely need more than one page, so this usually takes
+    a single round trip for all of the calendars.
+
+    :param service: Calendar resource object.
+    :param dict[str, str] sync_tokens: Map from calendar ids to their sync
+                                       tokens, or None for a full sync.
+    :param datetime time_max: Naive UTC time full syncs stop at.
+    :return: Map from calendar ids to what sync_events would return for
+             them, or the exception it would raise.
+    :rtype: dict[str, (list[dict], list[str], str, str) | Exception]
+    """
+    results = _execute_batch(service, dict(
+        (cal_id, _sync_events_query(service, cal_id, sync_token, None,
+                                    time_max))
+        for cal_id, sync_token in sync_tokens.iteritems()
+    ))
+
+    syncs = {}
+    for cal_id, result in results.iteritems():
+        if isinstance(result, Exception):
+            syncs[cal_id] = result
+            continue
+        try:
+            syncs[cal_id] = _finish_sync(service, cal_id,
+                                         sync_tokens[cal_id], result,
+                                         time_max)
+        except api_exceptions.ServiceException as e:
+            syncs[cal_id] = e
+    return syncs
+
+
+def _watch_events_query(service, cal_id, channel_id, address, token, ttl):
+    """
+    Build an events.watch query for the watch_events family of functions.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type channel_id: str
+    :type address: str
+    :type token: str
+    :type ttl: int
+    :return: API query.
+    """
+    return service.events().watch(
+        calendarId=cal_id,
+        body=dict(
+            id=channel_id,
+            type="web_hook",
+            address=address,
+            token=token,
+            params=dict(ttl=str(ttl))
         )
-        events.append(event)
+    )
 
-    if "nextPageToken" in result:
-        next_page_token = result["nextPageToken"]
-    else:
-        next_page_token = None
 
-    return events, next_page_token
+def _parse_watch_result(result):
+    """
+    Get the resource id and expiration time from an events.watch response.
+
+    :type result: dict
+    :rtype: (str, datetime)
+    """
+    expiration = datetime.utcfromtimestamp(int(result["expiration"]) / 1000)
+    return result["resourceId"], expiration
 
 
-def get_event(service, cal_id, event_id, time_zone, validation_only=False):
+def watch_events(service, cal_id, channel_id, address, token, ttl):
     """
-    Get a specific event by ID.
+    Ask Google to send push notifications when a calendar's events change.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :param str channel_id: Unique id for the new notification channel.
+    :param str address: URL to send notifications to.
+    :param str token: Secret sent back with every notification.
+    :param int ttl: Requested lifetime of the channel, in seconds.
+    :return: The channel's resource id and expiration time.
+    :rtype: (str, datetime)
+    """
+    return _parse_watch_result(_execute_query(_watch_events_query(
+            service, cal_id, channel_id, address, token, ttl)))
+
+
+def watch_events_batch(service, channels, address, ttl):
+    """
+    Open push notification channels for several calendars at once, using
+    batch requests.
+
+    :param service: Calendar resource object.
+    :param dict[str, (str, str)] channels: Map from calendar ids to the id
+                                           and secret token of their new
+                                           channel.
+    :param str address: URL to send notifications to.
+    :param int ttl: Requested lifetime of the channels, in seconds.
+    :return: Map from calendar ids to what watch_events would return for
+             them, or the exception it would raise.
+    :rtype: dict[str, (str, datetime) | api_exceptions.ServiceException]
+    """
+    results = _execute_batch(service, dict(
+        (cal_id, _watch_events_query(service, cal_id, channel_id, address,
+                                     token, ttl))
+        for cal_id, (channel_id, token) in channels.iteritems()
+    ))
+    return dict(
+        (cal_id, result if isinstance(result, Exception)
+         else _parse_watch_result(result))
+        for cal_id, result in results.iteritems()
+    )
+
+
+def stop_channel(service, channel_id, resource_id):
+    """
+    Stop push notifications for a channel.
+
+    :param service: Calendar resource object.
+    :type channel_id: str
+    :type resource_id: str
+    """
+    _execute_query(service.channels().stop(body=dict(
+        id=channel_id,
+        resourceId=resource_id
+    )))
+
+
+def _get_event_query(service, cal_id, event_id, time_zone):
+    """
+    Build an events.get query for the get_event family of functions.
 
     :param service: Calendar resource object.
     :type cal_id: str
     :type event_id: str
     :type time_zone: str
-    :type validation_only: bool
-    :rtype: messages.EventProperties
-    :raise OldEventError: The requested event takes place in the past.
+    :return: API query.
     """
-    result = _execute_query(service.events().get(
-        fields=("end,recurrence" if validation_only
-                else EVENT_FIELDS + ",recurrence"),
+    return service.events().get(
+        fields=EVENT_FIELDS + ",recurrence,iCalUID",
         calendarId=cal_id,
         eventId=event_id,
         timeZone=time_zone
-    ))
+    )
 
-    now = pytz.utc.localize(datetime.utcnow())
 
-    if "recurrence" in result:
-        instances = _execute_query(service.events().instances(
-            fields=("timeZone,items(end)" if validation_only else
-                    EVENT_LIST_FIELDS),
-            calendarId=cal_id,
-            eventId=event_id,
-            timeZone=time_zone,
-            timeMin=now.isoformat(),
-            maxResults=1
-        ))
+def _get_instances_query(service, cal_id, event_id, time_zone, now):
+    """
+    Build an events.instances query for the next instance of an event.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type event_id: str
+    :type time_zone: str
+    :type now: datetime
+    :return: API query.
+    """
+    return service.events().instances(
+        fields=EVENT_LIST_FIELDS,
+        calendarId=cal_id,
+        eventId=event_id,
+        timeZone=time_zone,
+        timeMin=now.isoformat(),
+        maxResults=1
+    )
 
-        if len(instances["items"]):
-            result = instances["items"][0]
-        else:
-            raise OldEventError(strings.error_old_event(event_id))
-        tzinfo_object = pytz.timezone(time_zone or instances["timeZone"])
-    else:
-        tzinfo_object = pytz.timezone(time_zone or
-                                      get_calendar_time_zone(service, cal_id))
 
+def _parse_event(result, cal_id, event_id, tzinfo_object, now):
+    """
+    Build an event message from an events.get or events.instances item.
+
+    :type result: dict
+    :type cal_id: str
+    :type event_id: str
+    :type tzinfo_object: tzinfo
+    :type now: datetime
+    :rtype: messages.EventProperties
+    :raise OldEventError: The event takes place in the past.
+    """
     assert "end" in result
     end = result["end"]
     if "dateTime" in end:
@@ -287,13 +827,9 @@ def get_event(service, cal_id, event_id, time_zone, validation_only=False):
     else:
         end_date = datetime_from_date_string(end["date"], tzinfo_object)
 
-    assert end_date >= now if "instances" in locals() else True
     if end_date < now:
         raise OldEventError(strings.error_old_event(event_id))
 
-    if validation_only:
-        return
-
     if "recurringEventId" in result:
         recurrence_id = result["recurringEventId"]
     else:
@@ -321,3 +857,342 @@ def get_event(service, cal_id, event_id, time_zone, validation_only=False):
         link=result["htmlLink"],
         recurrenceId=recurrence_id
     )
+
+
+def _series_query(service, cal_id, ical_uid, page_token):
+    """
+    Build an events.list query for a recurring event and all of its
+    changed and cancelled instances.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type ical_uid: str
+    :type page_token: str
+    :return: API query.
+    """
+    return service.events().list(
+        fields=SERIES_FIELDS,
+        calendarId=cal_id,
+        iCalUID=ical_uid,
+        singleEvents=False,
+        showDeleted=True,
+        maxResults=EVENT_PAGE_MAX,
+        pageToken=page_token
+    )
+
+
+def _series_changes_query(service, cal_id, updated_min, page_token):
+    """
+    Build an events.list query for recurring events and instances changed
+    since a given time.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type updated_min: datetime
+    :type page_token: str
+    :return: API query.
+    """
+    return service.events().list(
+        fields=SERIES_FIELDS,
+        calendarId=cal_id,
+        updatedMin=pytz.utc.localize(updated_min).isoformat(),
+        singleEvents=False,
+        showDeleted=True,
+        maxResults=EVENT_PAGE_MAX,
+        pageToken=page_token
+    )
+
+
+def _execute_all_pages(result, get_query):
+    """
+    Fetch any remaining pages of a list result, and return all of its items.
+
+    :param dict result: The first page.
+    :param get_query: Build the query for a page from its token.
+    :type get_query: (str) -> googleapiclient.http.HttpRequest
+    :rtype: list[dict]
+    """
+    items = list(result["items"])
+    while result.get("nextPageToken"):
+        result = _execute_query(get_query(result["nextPageToken"]))
+        items += result["items"]
+    return items
+
+
+def _get_series_cache_key(service, cal_id, event_id):
+    """
+    Get the key a recurring event is cached under.
+
+    Series are only shared between requests for the same user, since
+    calendar ids like "primary" and the ids of events users were invited to
+    aren't unique to one user.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type event_id: str
+    :return: The cache key, or None if the service isn't tagged with a user,
+             so the series can't be cached.
+    :rtype: unicode
+    """
+    user_id = getattr(getattr(service, "_http", None), "user_id", None)
+    if not user_id:
+        return None
+    return u"{}:{}:{}".format(user_id, cal_id, event_id)
+
+
+def _apply_series_item(series, item):
+    """
+    Update a cached recurring event with a changed item.
+
+    :param dict series: The cached master, overrides and sync time.
+    :param dict item: The master itself, or one of its instances.
+    :return: False if the master stopped recurring, so the cache can't be
+             used any more.
+    :rtype: bool
+    """
+    if item["id"] == series["master"]["id"]:
+        if item.get("status") == "cancelled":
+            series["deleted"] = True
+        elif "recurrence" not in item:
+            return False
+        else:
+            series["master"] = item
+    elif "originalStartTime" in item:
+        key = recurrenceutils.get_original_key(item["originalStartTime"])
+        if item.get("status") == "cancelled":
+            series["overrides"][key] = None
+        else:
+            series["overrides"][key] = item
+    return True
+
+
+def _sync_series(service, series, synced):
+    """
+    Bring cached recurring events up to date.
+
+    One incremental events.list call per calendar covers all of its cached
+    events, no matter how many there are, and the calls for every calendar
+    are sent together.
+
+    :param service: Calendar resource object.
+    :param dict[(str, str), dict] series: Cached recurring events by
+                                          calendar id and event id.  Events
+                                          that can't be brought up to date
+                                          are removed.
+    :param datetime synced: When this sync started.
+    :return: Errors for events that could not be checked.
+    :rtype: dict[(str, str), api_exceptions.ServiceException]
+    """
+    calendar_keys = collections.defaultdict(list)
+    for key in series:
+        calendar_keys[key[0]].append(key)
+
+    updated_mins = {}
+    for cal_id, keys in calendar_keys.iteritems():
+        updated_mins[cal_id] = min(
+                datetime.strptime(series[key]["synced"], "%Y-%m-%dT%H:%M:%S")
+                for key in keys) - SERIES_SYNC_MARGIN
+
+    def get_query(cal_id, page_token):
+        return _series_changes_query(service, cal_id, updated_mins[cal_id],
+                                     page_token)
+
+    results = _execute_batch(service, dict(
+        (cal_id, get_query(cal_id, None)) for cal_id in calendar_keys
+    ))
+
+    errors = {}
+    for cal_id, result in results.iteritems():
+        if not isinstance(result, Exception):
+            try:
+                items = _execute_all_pages(
+                        result, lambda page_token: get_query(cal_id,
+                                                             page_token))
+            except api_exceptions.ServiceException as e:
+                result = e
+
+        if isinstance(result, api_exceptions.GoneException):
+            # Too long since the last sync, so fetch them again from scratch
+            for key in calendar_keys[cal_id]:
+                del series[key]
+            continue
+        elif isinstance(result, Exception):
+            for key in calendar_keys[cal_id]:
+                errors[key] = result
+                del series[key]
+            continue
+
+        for item in items:
+            key = cal_id, item.get("recurringEventId") or item["id"]
+            if key in series and not _apply_series_item(series[key], item):
+                _series_cache.delete(_get_series_cache_key(service, *key))
+                del series[key]
+
+    for key, record in series.iteritems():
+        record["synced"] = synced.strftime("%Y-%m-%dT%H:%M:%S")
+        _series_cache.set(_get_series_cache_key(service, *key), record)
+    return errors
+
+
+def get_event(service, cal_id, event_id, time_zone):
+    """
+    Get a specific event by ID.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type event_id: str
+    :type time_zone: str
+    :rtype: messages.EventProperties
+    :raise OldEventError: The requested event takes place in the past.
+    """
+    event = get_event_batch(service, cal_id, [event_id], time_zone)[event_id]
+    if isinstance(event, Exception):
+        raise event
+    return event
+
+
+def get_event_batch(service, cal_id, event_ids, time_zone):
+    """
+    Get several events by ID, using batch requests instead of one at a time.
+
+    :param service: Calendar resource object.
+    :type cal_id: str
+    :type event_ids: list[str]
+    :type time_zone: str
+    :return: What get_event_batch_multi returns for the calendar.
+    :rtype: dict[str, messages.EventProperties | Exception]
+    """
+    return get_event_batch_multi(service, {cal_id: event_ids},
+                                 time_zone)[cal_id]
+
+
+def get_event_batch_multi(service, event_ids, time_zone):
+    """
+    Get events from several calendars by ID, sharing batch requests between
+    all of them.
+
+    Recurring events are cached with their changed instances, and their
+    next instance is found locally, with recurrenceutils.  Cached ones are
+    brought up to date with one incremental query per calendar, instead of
+    an events.get and an events.instances call each.  Other events are
+    fetched with events.get calls sent together in batches, and recurring
+    events seen for the first time with one more batch.
+
+    Events that could not be retrieved map to the exception get_event would
+    have raised for them, such as api_exceptions.NotFoundException or
+    OldEventError.
+
+    :param service: Calendar resource object.
+    :param dict[str, list[str]] event_ids: Map from calendar ids to the ids
+                                           of the events to get from them.
+    :type time_zone: str
+    :return: Map from calendar ids to maps from their event ids to the
+             events.
+    :rtype: dict[str, dict[str, messages.EventProperties | Exception]]
+    """
+    now = pytz.utc.localize(datetime.utcnow())
+    keys = [(cal_id, event_id) for cal_id, cal_event_ids
+            in event_ids.iteritems() for event_id in cal_event_ids]
+    events = {}
+
+    series = {}
+    for key in keys:
+        cache_key = _get_series_cache_key(service, *key)
+        if cache_key is None:
+            continue
+        record = _series_cache.get(cache_key)
+        if record is not None:
+            # The cached copy may be shared with other requests
+            series[key] = dict(record, overrides=dict(record["overrides"]))
+    if series:
+        events.update(_sync_series(service, series, datetime.utcnow()))
+
+    results = _execute_batch(service, dict(
+        (key, _get_event_query(service, key[0], key[1], time_zone))
+        for key in keys if key not in series and key not in events
+    ))
+
+    # Fetch the changed instances of recurring events seen for the first time
+    recurring_keys = [key for key, result in results.iteritems()
+                      if not isinstance(result, Exception) and
+                      "recurrence" in result]
+    series_results = _execute_batch(service, dict(
+        (key, _series_query(service, key[0], results[key]["iCalUID"], None))
+        for key in recurring_keys
+    ))
+    synced = datetime.utcnow()
+    for key in recurring_keys:
+        result = series_results[key]
+        if isinstance(result, Exception):
+            events[key] = result
+            continue
+        cal_id, event_id = key
+        record = dict(master=results[key], overrides={},
+                      synced=synced.strftime("%Y-%m-%dT%H:%M:%S"))
+        ical_uid = results[key]["iCalUID"]
+        for item in _execute_all_pages(
+                result, lambda page_token: _series_query(
+                        service, cal_id, ical_uid, page_token)):
+            if item["id"] != event_id:
+                _apply_series_item(record, item)
+        series[key] = record
+        cache_key = _get_series_cache_key(service, cal_id, event_id)
+        if cache_key is not None:
+            _series_cache.set(cache_key, record)
+
+    # Only look up each calendar's time zone once for the whole batch
+    calendar_tzinfos = dict(
+        (cal_id, pytz.timezone(time_zone or
+                               get_calendar_time_zone(service, cal_id)))
+        for cal_id in set(key[0] for key in itertools.chain(series, results))
+    )
+
+    # Expand recurring events locally, or fall back on the API when their
+    # rules can't be
+    unexpanded_keys = []
+    for key, record in series.iteritems():
+        if record.get("deleted"):
+            events[key] = api_exceptions.NotFoundException()
+            continue
+        try:
+            instance = recurrenceutils.get_next_instance(
+                    record["master"], record["overrides"], now,
+                    calendar_tzinfos[key[0]])
+        except recurrenceutils.RecurrenceError as e:
+            logging.warning(e)
+            unexpanded_keys.append(key)
+            continue
+        if instance is None:
+            events[key] = OldEventError(strings.error_old_event(key[1]))
+        else:
+            results[key] = instance
+
+    instances_results = _execute_batch(service, dict(
+        (key, _get_instances_query(service, key[0], key[1], time_zone, now))
+        for key in unexpanded_keys
+    ))
+    for key, instances in instances_results.iteritems():
+        if isinstance(instances, Exception):
+            events[key] = instances
+        elif not len(instances["items"]):
+            events[key] = OldEventError(strings.error_old_event(key[1]))
+        else:
+            results[key] = instances["items"][0]
+
+    for key, result in results.iteritems():
+        if key in events:
+            continue
+        elif isinstance(result, Exception):
+            events[key] = result
+            continue
+
+        try:
+            events[key] = _parse_event(result, key[0], key[1],
+                                       calendar_tzinfos[key[0]], now)
+        except OldEventError as e:
+            events[key] = e
+
+    calendar_events = dict((cal_id, {}) for cal_id in event_ids)
+    for (cal_id, event_id), event in events.iteritems():
+        calendar_events[cal_id][event_id] = event
+    return calendar_events
@@ -2,61 +2,342 @@
 
 from __future__ import division, print_function
 
+import itertools
 import logging
+from datetime import datetime
 
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from oauth2client.appengine import CredentialsNDBModel
 from endpoints import NotFoundException, ServiceException
 import webapp2
 
 import gapiutils
 import authutils
 import models
+import preferenceutils
 import strings
 
 __author__ = "Alexander Otavka"
 __copyright__ = "Copyright (C) 2015 DHS Developers Club"
 
 
+GC_QUEUE = "garbagecollect"
+
+# Events checked by each collection task.
+SHARD_SIZE = 100
+
+# Shards created by each scan task.  App Engine allows five transactional
+# tasks per transaction, and one is needed to continue the scan.
+SHARDS_PER_SCAN = 4
+
+
+@ndb.transactional(retries=10)
+def _finish_shard(shard_key, unbound):
+    """
+    Delete a checked shard and record its results on its run.
+
+    :type shard_key: ndb.Key
+    :type unbound: int
+    :return: The run, if this was its last shard, else None.
+    :rtype: models.GarbageCollectionRun
+    """
+    shard, run = ndb.get_multi([shard_key, shard_key.parent()])
+    if shard is None:
+        # This shard was already finished by an earlier try of its task
+        return None
+
+    run.pending -= 1
+    run.unbound += unbound
+    finished = run.scanned and run.pending == 0
+    if finished:
+        run.finished = datetime.utcnow()
+    run.put()
+    shard_key.delete()
+    return run if finished else None
+
+
+def _log_summary(run):
+    """
+    Log the results of a finished run.
+
+    :type run: models.GarbageCollectionRun
+    """
+    logging.info(strings.logging_garbage_collection_summary(
+            unbound=run.unbound))
+
+
 class GarbageCollector(webapp2.RequestHandler):
     """Respond to chron job by ensuring the event database is clean."""
 
     def get(self):
-        # TODO: implement some kind of expiration for EventCacheGroups
-        unbound_count = 0
-        for user_entity in models.get_user_query().iter(keys_only=True):
-            user_id = user_entity.key.string_id()
-            cred_entity = ndb.Key(CredentialsNDBModel, user_id).get()
-            service = authutils.get_service(authutils.CALENDAR_API_NAME,
-                                            authutils.CALENDAR_API_VERSION,
-                                            cred_entity.credentials)
-            events_query = models.Event.query(ancestor=user_entity.key)
-
-            for event in events_query.iter(keys_only=True):
-                event_id = event.key.string_id()
-                cal_id = event.key.parent().string_id()
+        run_key = models.GarbageCollectionRun().put()
+        taskqueue.add(url="/_ah/garbagecollect/scan", queue_name=GC_QUEUE,
+                      params=dict(run=run_key.urlsafe(), cursor=""))
+        self.response.write(strings.logging_garbage_collection_started(
+                run_id=run_key.id()))
+
+
+class EventScanner(webapp2.RequestHandler):
+    """
+    Split the events into shards, and start a task to check each one.
+
+    Each scan task handles one page of event keys, then continues the scan
+    in a new task from where it left off.
+    """
+
+    def post(self):
+        run_key = ndb.Key(urlsafe=self.request.get("run"))
+        cursor_string = self.request.get("cursor")
+        cursor = Cursor(urlsafe=cursor_string) if cursor_string else None
+
+        keys, next_cursor, more = models.Event.query().fetch_page(
+                SHARD_SIZE * SHARDS_PER_SCAN, keys_only=True,
+                start_cursor=cursor)
+        next_cursor_string = next_cursor.urlsafe() if next_cursor else ""
+
+        @ndb.transactional(retries=10)
+        def start_shards():
+            run = run_key.get()
+            if run.scanned or (run.cursor or "") != cursor_string:
+                # This page was already scanned by an earlier try of this task
+                return None
+
+            shards = [models.GarbageCollectionShard(
+                          parent=run_key,
+                          event_keys=keys[i:i + SHARD_SIZE])
+                      for i in range(0, len(keys), SHARD_SIZE)]
+            shard_keys = ndb.put_multi(shards)
+
+            run.pending += len(shards)
+            run.cursor = next_cursor_string
+            run.scanned = not more
+            finished = run.scanned and run.pending == 0
+            if finished:
+                run.finished = datetime.utcnow()
+            run.put()
+
+            tasks = [taskqueue.Task(url="/_ah/garbagecollect/collect",
+                                    params=dict(shard=shard_key.urlsafe()))
+                     for shard_key in shard_keys]
+            if more:
+                tasks.append(taskqueue.Task(
+                        url="/_ah/garbagecollect/scan",
+                        params=dict(run=run_key.urlsafe(),
+                                    cursor=next_cursor_string)))
+            if tasks:
+                taskqueue.Queue(GC_QUEUE).add(tasks, transactional=True)
+            return run if finished else None
+
+        run = start_shards()
+        if run is not None:
+            _log_summary(run)
+
+
+class ShardCollector(webapp2.RequestHandler):
+    """
+    Delete the events in a shard that no longer exist on Google, and store
+    end dates for the ones that don't have them yet.
+    """
+
+    def post(self):
+        shard_key = ndb.Key(urlsafe=self.request.get("shard"))
+        shard = shard_key.get()
+        if shard is None:
+            return
+
+        unbound_keys = []
+
+        def get_calendar_key(event_key):
+            return event_key.parent()
+
+        def get_user_key(event_key):
+            return event_key.parent().parent()
+
+        event_keys = sorted(shard.event_keys)
+
+        # Entities saved before end dates were stored are dated as never
+        # ending up front, so the starred query finds them whether or not
+        # the API can be reached below.  Listing them checks and corrects
+        # the date.
+        undated = dict((entity.key, entity)
+                       for entity in ndb.get_multi(event_keys)
+                       if entity is not None and entity.end_date is None)
+        for entity in undated.itervalues():
+            entity.end_date = models.Event.NEVER
+
+        # Group the events by user, then by calendar, so each calendar's
+        # events are checked together in batch requests.
+        for user_key, user_event_keys in itertools.groupby(event_keys,
+                                                           get_user_key):
+            # Keys only hold part of the user id, so the whole id is looked
+            # up to find the user's credentials
+            user_event_keys = list(user_event_keys)
+            user = user_key.get()
+            service = None
+            if user is not None:
+                user_id = user.user_id
+                credentials = authutils.get_stored_credentials(user_id)
+                if credentials is not None:
+                    service = authutils.get_service(
+                            authutils.CALENDAR_API_NAME,
+                            authutils.CALENDAR_API_VERSION, credentials,
+                            user_id)
+            if service is None:
+                continue
+
+            for cal_key, cal_event_keys in itertools.groupby(
+                    user_event_keys, get_calendar_key):
+                cal_id = cal_key.string_id()
+                cal_event_keys = list(cal_event_keys)
 
                 try:
-                    gapiutils.get_event(service, cal_id, event_id, "UTC",
-                                        validation_only=True)
-                except NotFoundException:
-                    logging.info(strings.logging_delete_unbound_event(
-                            event_id=event_id, calendar_id=cal_id,
-                            user_id=user_id))
-                    event.key.delete()
-                    unbound_count += 1
-                    continue
-                except gapiutils.OldEventError:
-                    continue
+                    results = gapiutils.get_event_batch(
+                            service, cal_id,
+                            [key.string_id() for key in cal_event_keys],
+                            "UTC")
                 except ServiceException:
                     continue
 
-        logging.info(strings.logging_garbage_collection_summary(
-                unbound=unbound_count))
-        self.response.write(strings.logging_garbage_collection_summary(
-                unbound=unbound_count))
+                for event_key in cal_event_keys:
+                    event_id = event_key.string_id()
+                    event = results[event_id]
+                    if isinstance(event, NotFoundException):
+                        logging.info(strings.logging_delete_unbound_event(
+                                event_id=event_id, calendar_id=cal_id,
+                                user_id=user_id))
+                        unbound_keys.append(event_key)
+                        undated.pop(event_key, None)
+                    elif event_key in undated:
+                        entity = undated[event_key]
+                        if isinstance(event, gapiutils.OldEventError):
+                            # Confirmed over, so no grace period is needed
+                            entity.end_date = (datetime.utcnow() -
+                                               models.Event.GRACE_PERIOD)
+                        elif not isinstance(event, Exception):
+                            entity.end_date = models.Event.get_end_date(
+                                    event_id, event)
+
+        ndb.delete_multi(unbound_keys)
+        ndb.put_multi(undated.values())
+        preferenceutils.invalidate_preferences_multi(
+                list(set(key.parent() for key in unbound_keys)))
+
+        run = _finish_shard(shard_key, len(unbound_keys))
+        if run is not None:
+            _log_summary(run)
+
+
+class CacheCollector(webapp2.RequestHandler):
+    """Respond to chron job by deleting expired event cache groups."""
+
+    BATCH_SIZE = 500
+
+    def get(self):
+        expired_count = 0
+
+        query = models.EventCacheGroup.get_expired_query()
+        cursor = None
+        more = True
+        while more:
+            keys, cursor, more = query.fetch_page(
+                    self.BATCH_SIZE, keys_only=True, start_cursor=cursor)
+            ndb.delete_multi(keys)
+            expired_count += len(keys)
+
+        if self.request.get("legacy"):
+            # Groups from before access times were recorded can't be found by
+            # the expired query, so sweep the whole kind for them.
+            query = models.EventCacheGroup.query()
+            cursor = None
+            more = True
+            while more:
+                groups, cursor, more = query.fetch_page(
+                        self.BATCH_SIZE, start_cursor=cursor)
+                keys = [group.key for group in groups if group.is_expired()]
+                ndb.delete_multi(keys)
+                expired_count += len(keys)
+
+        logging.info(strings.logging_cache_collection_summary(
+                expired=expired_count))
+        self.response.write(strings.logging_cache_collection_summary(
+                expired=expired_count))
+
+
+class EndedEventCollector(webapp2.RequestHandler):
+    """
+    Respond to chron job by deleting the entities of events that are over.
+
+    Ended events are found by their stored end dates, so this never needs
+    to call the Calendar API.  Those dates are kept up to date when mirrors
+    sync, but an event moved in a calendar nobody is listing could still be
+    deleted early, so only events that ended over a grace period ago are.
+    """
+
+    BATCH_SIZE = 500
+
+    def get(self):
+        ended_count = 0
+
+        cutoff = datetime.utcnow() - models.Event.GRACE_PERIOD
+        query = models.Event.query(models.Event.end_date < cutoff)
+        cursor = None
+        more = True
+        while more:
+            keys, cursor, more = query.fetch_page(
+                    self.BATCH_SIZE, keys_only=True, start_cursor=cursor)
+            ndb.delete_multi(keys)
+            preferenceutils.invalidate_preferences_multi(
+                    list(set(key.parent() for key in keys)))
+            ended_count += len(keys)
+
+        logging.info(strings.logging_ended_event_collection_summary(
+                ended=ended_count))
+        self.response.write(strings.logging_ended_event_collection_summary(
+                ended=ended_count))
+
+
+class EndDateBackfill(webapp2.RequestHandler):
+    """
+    Date every event entity saved before end dates were stored as never
+    ending, so the starred query finds them.
+
+    Entities without an end date aren't in its index at all, so they can
+    only be found by going through every entity.  This only needs to run
+    once, after deploying, by visiting its url as an admin.  Each request
+    dates one batch, then continues in a task from where it left off.
+    """
+
+    BATCH_SIZE = 500
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor_string = self.request.get("cursor")
+        cursor = Cursor(urlsafe=cursor_string) if cursor_string else None
+
+        entities, next_cursor, more = models.Event.query().fetch_page(
+                self.BATCH_SIZE, start_cursor=cursor)
+        undated = [entity for entity in entities if entity.end_date is None]
+        for entity in undated:
+            entity.end_date = models.Event.NEVER
+        ndb.put_multi(undated)
+
+        if more and next_cursor is not None:
+            taskqueue.add(url="/_ah/garbagecollect/backfill",
+                          queue_name=GC_QUEUE,
+                          params=dict(cursor=next_cursor.urlsafe()))
+        logging.info(strings.logging_end_date_backfill(dated=len(undated)))
+        self.response.write(strings.logging_end_date_backfill(
+                dated=len(undated)))
 
 
 collectors = webapp2.WSGIApplication([
     ("/_ah/garbagecollect/go", GarbageCollector),
+    ("/_ah/garbagecollect/scan", EventScanner),
+    ("/_ah/garbagecollect/collect", ShardCollector),
+    ("/_ah/garbagecollect/caches", CacheCollector),
+    ("/_ah/garbagecollect/events", EndedEventCollector),
+    ("/_ah/garbagecollect/backfill", EndDateBackfill),
 ])
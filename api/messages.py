@@ -52,9 +52,16 @@ class CalendarCollection(messages.Message):
     """
     Non-pageable array of calendar messages.
 
+    If notModified is set, items is left empty, and the client should keep
+    using the items it already has with the same etag.
+
     :type items: list[Calendar]
+    :type etag: str
+    :type notModified: bool
     """
     items = messages.MessageField(CalendarProperties, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3, default=False)
 
 
 class EventSettings(messages.Message):
@@ -133,16 +140,24 @@ class EventCollection(messages.Message):
     """
     Pageable array of event messages.
 
+    If notModified is set, items is left empty, and the client should keep
+    using the items it already has with the same etag.
+
     :type items: list[Event]
     :type nextPageToken: str
+    :type etag: str
+    :type notModified: bool
     """
     items = messages.MessageField(EventProperties, 1, repeated=True)
     nextPageToken = messages.StringField(2)
+    etag = messages.StringField(3)
+    notModified = messages.BooleanField(4, default=False)
 
 
 _SEARCH_QUERY_FIELDS = dict(
     search=messages.StringField(1, variant=messages.Variant.STRING),
-    hidden=messages.BooleanField(2, variant=messages.Variant.BOOL)
+    hidden=messages.BooleanField(2, variant=messages.Variant.BOOL),
+    ifNoneMatch=messages.StringField(7, variant=messages.Variant.STRING)
 )
 EVENT_SEARCH_RESOURCE = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -154,6 +169,13 @@ EVENT_SEARCH_RESOURCE = endpoints.ResourceContainer(
                                     required=True),
     **_SEARCH_QUERY_FIELDS
 )
+UPCOMING_RESOURCE = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    timeZone=messages.StringField(1, variant=messages.Variant.STRING),
+    maxResults=messages.IntegerField(2, variant=messages.Variant.UINT32,
+                                     default=10),
+    pageToken=messages.StringField(3, variant=messages.Variant.STRING)
+)
 CALENDAR_SEARCH_RESOURCE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     **_SEARCH_QUERY_FIELDS
@@ -2,7 +2,11 @@
 
 from __future__ import division, print_function
 
+import base64
+import calendar
 import hashlib
+import json
+from datetime import datetime, timedelta
 
 from google.appengine.ext import ndb
 import pytz
@@ -31,6 +35,22 @@ def get_user_query():
     return ndb.Query(kind=USER_KIND)
 
 
+class User(ndb.Model):
+    """
+    Data model for a user, under the key from get_user_key.
+
+    User keys only hold part of the user id, so the whole id is saved too,
+    for jobs that find users by key and need to act for them.
+
+    :type user_id: str
+    """
+    user_id = ndb.StringProperty(required=True, indexed=False)
+
+    @classmethod
+    def _get_kind(cls):
+        return USER_KIND
+
+
 class Calendar(ndb.Model):
     """
     Data model for all calendar properties stored in the datastore.
@@ -61,18 +81,154 @@ class Event(ndb.Model):
     """
     Data model for all event properties stored in the datastore.
 
+    The end date is when the event's next occurrence ends, in UTC, so
+    entities for events that are over can be found by query.  Recurring
+    events last as long as they have instances left, so theirs is NEVER
+    until they are found to be over.  Entities saved before end dates were
+    stored have none.
+
+    Stored end dates can go stale if an event is moved, so entities are only
+    deleted GRACE_PERIOD after they seem to have ended, unless the API has
+    confirmed it by then.
+
     :type starred: bool
     :type hidden: bool
     :type settings: EventSettings
+    :type end_date: datetime
     """
+    NEVER = datetime(9999, 12, 31)
+    GRACE_PERIOD = timedelta(days=7)
+
     starred = ndb.BooleanProperty()
     hidden = ndb.BooleanProperty()
     settings = ndb.StructuredProperty(EventSettings)
+    end_date = ndb.DateTimeProperty()
+
+    @classmethod
+    def get_end_date(cls, event_id, event):
+        """
+        Get the end date to store for an event.
+
+        :param str event_id: The id the entity is saved under.
+        :param messages.EventProperties event: The event's next occurrence.
+        :rtype: datetime
+        """
+        if event.recurrenceId is not None and event.recurrenceId == event_id:
+            return cls.NEVER
+        return event.endDate.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+class CalendarMirror(ndb.Model):
+    """
+    Data model for a user's local copy of a Google calendar's events.
+
+    Child of the user key, with the calendar id as its id.  The mirrored
+    events are MirroredEvent children of this entity.
+
+    :type sync_token: str
+    :type time_zone: str
+    :type synced: datetime
+    :type stale: bool
+    :type channel_id: str
+    :type horizon: datetime
+    """
+    sync_token = ndb.StringProperty(indexed=False)
+    time_zone = ndb.StringProperty(indexed=False)
+    synced = ndb.DateTimeProperty(indexed=False)
+    stale = ndb.BooleanProperty(default=False, indexed=False)
+    channel_id = ndb.StringProperty(indexed=False)
+    # Events starting after this were left out of the last full sync, so
+    # only ones that changed since then are mirrored
+    horizon = ndb.DateTimeProperty(indexed=False)
+
+
+class WatchChannel(ndb.Model):
+    """
+    Data model for a push notification channel watching a calendar mirror.
+
+    The channel id is the entity's id.  A channel without a resource id
+    was never opened with Google, and will be retried when it expires.
+
+    :type mirror: ndb.Key
+    :type user_id: str
+    :type token: str
+    :type resource_id: str
+    :type expiration: datetime
+    """
+    mirror = ndb.KeyProperty(required=True, indexed=False)
+    user_id = ndb.StringProperty(required=True, indexed=False)
+    token = ndb.StringProperty(required=True, indexed=False)
+    resource_id = ndb.StringProperty(indexed=False)
+    expiration = ndb.DateTimeProperty(required=True)
+
+
+class MirroredEvent(ndb.Model):
+    """
+    Data model for an upcoming event instance copied from Google.
+
+    Child of a CalendarMirror, with the event id as its id.  Dates are
+    stored in UTC.  The dates of all day events are midnight in the
+    calendar's time zone.
+
+    :type name: str
+    :type start_date: datetime
+    :type end_date: datetime
+    :type all_day: bool
+    :type link: str
+    :type recurrence_id: str
+    """
+    name = ndb.StringProperty(indexed=False)
+    start_date = ndb.DateTimeProperty(required=True)
+    end_date = ndb.DateTimeProperty(required=True)
+    all_day = ndb.BooleanProperty(default=False, indexed=False)
+    link = ndb.StringProperty(required=True, indexed=False)
+    recurrence_id = ndb.StringProperty(indexed=False)
+
+    def _localize(self, date, tzinfo, calendar_tzinfo):
+        """
+        Convert a stored UTC date to given time zone.
+
+        All day events start at midnight in whichever time zone they are
+        shown in, just like the Calendar API returns them.
+
+        :type date: datetime
+        :type tzinfo: tzinfo
+        :type calendar_tzinfo: tzinfo
+        :rtype: datetime
+        """
+        date = pytz.utc.localize(date)
+        if self.all_day:
+            return tzinfo.localize(
+                    date.astimezone(calendar_tzinfo).replace(tzinfo=None))
+        else:
+            return date.astimezone(tzinfo)
+
+    def to_message(self, time_zone, calendar_time_zone):
+        """
+        Convert to messages.EventProperties.
+
+        :param str time_zone: Time zone to show dates in.
+        :param str calendar_time_zone: Time zone of the mirrored calendar.
+        :rtype: messages.EventProperties
+        """
+        tzinfo = pytz.timezone(time_zone)
+        calendar_tzinfo = pytz.timezone(calendar_time_zone)
+        return messages.EventProperties(
+            eventId=self.key.string_id(),
+            calendarId=self.key.parent().string_id(),
+            name=self.name,
+            startDate=self._localize(self.start_date, tzinfo, calendar_tzinfo),
+            endDate=self._localize(self.end_date, tzinfo, calendar_tzinfo),
+            hidden=None,
+            starred=None,
+            link=self.link,
+            recurrenceId=self.recurrence_id
+        )
 
 
 class EventCache(ndb.Model):
     """
-    Data model for a cached event.
+    Data model for a cached event, in groups saved before packed_items.
 
     :type event_id: str
     :type calendar_id: str
@@ -96,25 +252,6 @@ class EventCache(ndb.Model):
     settings = ndb.StructuredProperty(EventSettings, indexed=False)
     recurrence_id = ndb.StringProperty(indexed=False)
 
-    @classmethod
-    def from_message(cls, message):
-        return cls(
-            event_id=message.eventId,
-            calendar_id=message.calendarId,
-            name=message.name,
-            start_date=message.startDate.astimezone(pytz.utc).replace(
-                    tzinfo=None),
-            end_date=message.endDate.astimezone(pytz.utc).replace(tzinfo=None),
-            starred=message.starred,
-            hidden=message.hidden,
-            link=message.link,
-            settings=EventSettings(
-                count_to_start=message.settings.countToStart,
-                count_to_end=message.settings.countToEnd
-            ) if message.settings is not None else None,
-            recurrence_id=message.recurrenceId,
-        )
-
     def to_message(self, time_zone):
         """
         Convert to messages.EventProperties.
@@ -127,12 +264,12 @@ class EventCache(ndb.Model):
             eventId=self.event_id,
             calendarId=self.calendar_id,
             name=self.name,
-            startDate=tzinfo.localize(self.start_date),
-            endDate=tzinfo.localize(self.end_date),
+            startDate=pytz.utc.localize(self.start_date).astimezone(tzinfo),
+            endDate=pytz.utc.localize(self.end_date).astimezone(tzinfo),
             starred=self.starred,
             hidden=self.hidden,
             link=self.link,
-            settings=EventSettings(
+            settings=messages.EventSettings(
                 countToStart=self.settings.count_to_start,
                 countToEnd=self.settings.count_to_end
             ) if self.settings is not None else None,
@@ -150,16 +287,165 @@ class EventCacheGroup(ndb.Model):
     """
     Data model for container of cached event list.
 
-    :type unique_hash: str
+    Groups expire TTL after they were last accessed, and are then deleted by
+    the garbage collector.
+
+    Events are stored in packed_items, a compressed JSON array of packed
+    records, by set_events, and read back with iter_events.  Groups saved
+    before that used the items property, one EventCache per event, and are
+    still read from it until they expire.
+
+    Groups are keyed by a hash of their request and contents, so identical
+    groups are found with a key lookup.  Groups saved before that have
+    integer ids.
+
     :type sequence_hash: str
     :type next_page_token: str
+    :type next_page_offset: int
+    :type exhausted: bool
+    :type packed_items: str
     :type items: list[EventCache]
+    :type created: datetime
+    :type accessed: datetime
     """
-    unique_hash = ndb.BlobProperty(indexed=True)
+    TTL = timedelta(days=1)
+
+    # Access times are only written when they are at least this far behind,
+    # so reading a page doesn't always cost a write.
+    ACCESS_RESOLUTION = timedelta(hours=1)
+
+    # Version of the packed_items layout, stored as its first element.
+    PACKED_FORMAT = 1
+
+    # Bits of a packed record's flags.
+    _STARRED = 1
+    _HIDDEN = 2
+    _HAS_SETTINGS = 4
+    _COUNT_TO_START = 8
+    _COUNT_TO_END = 16
+
+    # Length of the string ids of groups keyed by content.
+    CONTENT_ID_LENGTH = 27
+
     sequence_hash = ndb.BlobProperty(indexed=False)
     next_page_token = ndb.StringProperty(indexed=False)
+    next_page_offset = ndb.IntegerProperty(default=0, indexed=False)
+    exhausted = ndb.BooleanProperty(default=False, indexed=False)
+    packed_items = ndb.BlobProperty(compressed=True)
+    # Deprecated: only set on groups saved before packed_items existed.
     items = ndb.StructuredProperty(EventCache, repeated=True, indexed=False)
     extra_starred_ids = ndb.StringProperty(repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    accessed = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def get_expired_query(cls):
+        """
+        Get a query for all groups that have expired.
+
+        :rtype: ndb.Query
+        """
+        return cls.query(cls.accessed < datetime.utcnow() - cls.TTL)
+
+    def is_expired(self):
+        """
+        Check if this group has expired.
+
+        Groups from before access times were recorded count as expired.
+
+        :rtype: bool
+        """
+        return (self.accessed is None or
+                self.accessed < datetime.utcnow() - self.TTL)
+
+    def touch(self):
+        """Record an access to this group, writing it if needed."""
+        now = datetime.utcnow()
+        if self.accessed is None or now - self.accessed >= \
+                self.ACCESS_RESOLUTION:
+            self.accessed = now
+            self.put()
+
+    def set_events(self, events):
+        """
+        Pack events into packed_items.
+
+        Each event becomes one record:
+        [event id, calendar index, name, start, end, flags, link,
+        recurrence id], with dates as epoch seconds, and calendar ids
+        stored once and referred to by index.
+
+        :type events: list[messages.EventProperties]
+        """
+        calendar_ids = []
+        calendar_indexes = {}
+        records = []
+        for event in events:
+            if event.calendarId not in calendar_indexes:
+                calendar_indexes[event.calendarId] = len(calendar_ids)
+                calendar_ids.append(event.calendarId)
+
+            flags = ((self._STARRED if event.starred else 0) |
+                     (self._HIDDEN if event.hidden else 0))
+            if event.settings is not None:
+                flags |= self._HAS_SETTINGS
+                if event.settings.countToStart:
+                    flags |= self._COUNT_TO_START
+                if event.settings.countToEnd:
+                    flags |= self._COUNT_TO_END
+
+            records.append([
+                event.eventId,
+                calendar_indexes[event.calendarId],
+                event.name,
+                calendar.timegm(event.startDate.utctimetuple()),
+                calendar.timegm(event.endDate.utctimetuple()),
+                flags,
+                event.link,
+                event.recurrenceId
+            ])
+
+        self.packed_items = json.dumps(
+                [self.PACKED_FORMAT, calendar_ids, records],
+                separators=(",", ":"))
+        self.items = []
+
+    def iter_events(self, time_zone):
+        """
+        Lazily unpack the cached events, one message at a time.
+
+        :param str time_zone: Time zone to show dates in.
+        :rtype: collections.Iterator[messages.EventProperties]
+        """
+        if self.packed_items is None:
+            for event_cache in self.items:
+                yield event_cache.to_message(time_zone)
+            return
+
+        packed_format, calendar_ids, records = json.loads(self.packed_items)
+        assert packed_format == self.PACKED_FORMAT
+        tzinfo = pytz.timezone(time_zone)
+        for (event_id, calendar_index, name, start_date, end_date, flags,
+             link, recurrence_id) in records:
+            if flags & self._HAS_SETTINGS:
+                settings = messages.EventSettings(
+                    countToStart=bool(flags & self._COUNT_TO_START),
+                    countToEnd=bool(flags & self._COUNT_TO_END)
+                )
+            else:
+                settings = None
+            yield messages.EventProperties(
+                eventId=event_id,
+                calendarId=calendar_ids[calendar_index],
+                name=name,
+                startDate=datetime.fromtimestamp(start_date, tzinfo),
+                endDate=datetime.fromtimestamp(end_date, tzinfo),
+                starred=bool(flags & self._STARRED),
+                hidden=bool(flags & self._HIDDEN),
+                link=link,
+                settings=settings,
+                recurrenceId=recurrence_id
+            )
 
     @staticmethod
     def _get_hash_from_array(array):
@@ -186,27 +472,89 @@ class EventCacheGroup(ndb.Model):
                 (request.search, request.hidden, request.timeZone,
                  request.maxResults, request.calendarId))
 
-    def _get_unique_hash(self, request):
+    def _get_content_id(self, request):
         """
-        Generate unique hash to find identical items.
+        Generate a string id from the request and items, for finding
+        identical groups.
 
         :type request: messages.EVENT_SEARCH_RESOURCE
         :rtype: str
         """
-        return EventCacheGroup._get_hash_from_array(
+        digest = EventCacheGroup._get_hash_from_array(
                 (request.search, request.hidden, request.timeZone,
                  request.maxResults, request.calendarId,
-                 self.next_page_token) +
+                 self.next_page_token, self.next_page_offset,
+                 self.exhausted, self.packed_items) +
                 tuple(self.items) + tuple(self.extra_starred_ids))
+        content_id = base64.urlsafe_b64encode(digest).rstrip("=")
+        assert len(content_id) == EventCacheGroup.CONTENT_ID_LENGTH
+        return content_id
 
     def generate_hashes(self, request):
         """
-        Set unique_hash and sequence_hash for this entity.
+        Set sequence_hash and the content based key for this entity.
+
+        The entity must have been created with its parent.
 
         :type request: messages.EVENT_SEARCH_RESOURCE
         """
-        self.unique_hash = self._get_unique_hash(request)
         self.sequence_hash = self.get_sequence_hash(request)
+        self.key = ndb.Key(EventCacheGroup, self._get_content_id(request),
+                           parent=self.key.parent())
+
+
+class GarbageCollectionRun(ndb.Model):
+    """
+    Data model for the progress of one garbage collection run.
+
+    :type started: datetime
+    :type finished: datetime
+    :type cursor: str
+    :type scanned: bool
+    :type pending: int
+    :type unbound: int
+    """
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    scanned = ndb.BooleanProperty(default=False, indexed=False)
+    pending = ndb.IntegerProperty(default=0, indexed=False)
+    unbound = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class GarbageCollectionShard(ndb.Model):
+    """
+    Data model for a batch of events waiting to be checked by a run.
+
+    Child of a GarbageCollectionRun, and deleted once it is checked.
+
+    :type event_keys: list[ndb.Key]
+    """
+    event_keys = ndb.KeyProperty(repeated=True, indexed=False)
+
+
+class PublicCalendarList(ndb.Model):
+    """
+    Data model for the shared copy of the list of public calendars.
+
+    There is a single entity, refreshed in the background by cron.
+
+    :type calendars: list[list[str]]
+    :type refreshed: datetime
+    """
+    calendars = ndb.JsonProperty(compressed=True)
+    refreshed = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class SigningKey(ndb.Model):
+    """
+    Data model for an app wide secret key, used to sign tokens.
+
+    The key's purpose is the entity's id.
+
+    :type secret: str
+    """
+    secret = ndb.BlobProperty(required=True)
 
 
 class Settings(ndb.Model):
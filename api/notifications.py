@@ -0,0 +1,93 @@
+"""Receive Calendar API push notifications, and keep their channels open."""
+
+from __future__ import division, print_function
+
+import logging
+from datetime import datetime, timedelta
+
+from google.appengine.ext import ndb
+import webapp2
+
+import authutils
+import models
+import syncutils
+import strings
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+# Channels expiring within this long are renewed by the cron job.
+RENEWAL_MARGIN = timedelta(days=1)
+
+
+class CalendarNotificationReceiver(webapp2.RequestHandler):
+    """Invalidate a calendar mirror when Google says its events changed."""
+
+    def post(self):
+        channel_id = self.request.headers.get("X-Goog-Channel-ID")
+        token = self.request.headers.get("X-Goog-Channel-Token")
+        state = self.request.headers.get("X-Goog-Resource-State")
+
+        channel = None
+        if channel_id:
+            channel = ndb.Key(models.WatchChannel, channel_id).get()
+
+        # Always answer with success, or Google will keep retrying
+        if channel is None or channel.token != token:
+            logging.info(strings.logging_unknown_channel(
+                    channel_id=channel_id))
+            return
+
+        # The first message on every channel is just a "sync" handshake
+        if state != "sync":
+            syncutils.invalidate_mirror(channel.mirror)
+
+
+class ChannelRenewer(webapp2.RequestHandler):
+    """Respond to cron job by reopening channels that are about to expire."""
+
+    def get(self):
+        renewed_count = 0
+        stopped_count = 0
+        expiring_query = models.WatchChannel.query(
+                models.WatchChannel.expiration <
+                datetime.utcnow() + RENEWAL_MARGIN)
+
+        for channel in expiring_query:
+            # Users' credentials are stored on each of their requests, and
+            # only last about an hour after the last one
+            credentials = authutils.get_stored_credentials(channel.user_id)
+            if credentials is not None:
+                service = authutils.get_service(
+                        authutils.CALENDAR_API_NAME,
+                        authutils.CALENDAR_API_VERSION,
+                        credentials, channel.user_id)
+            else:
+                service = None
+
+            syncutils.stop_watching(service, channel)
+
+            mirror = channel.mirror.get()
+            if mirror is None or mirror.channel_id != channel.key.string_id():
+                stopped_count += 1
+            elif service is None:
+                # Without a channel, the mirror falls back to polling, until
+                # the next request for it opens a new one
+                mirror.channel_id = None
+                mirror.put()
+                stopped_count += 1
+            else:
+                syncutils.watch_calendar(service, mirror, channel.user_id)
+                renewed_count += 1
+
+        logging.info(strings.logging_channel_renewal_summary(
+                renewed=renewed_count, stopped=stopped_count))
+        self.response.write(strings.logging_channel_renewal_summary(
+                renewed=renewed_count, stopped=stopped_count))
+
+
+receivers = webapp2.WSGIApplication([
+    (syncutils.NOTIFICATION_PATH, CalendarNotificationReceiver),
+    ("/_ah/notifications/renew", ChannelRenewer),
+])
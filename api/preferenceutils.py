@@ -0,0 +1,227 @@
+"""Cached snapshots of which events a user has starred or hidden."""
+
+from __future__ import division, print_function
+
+import collections
+import time
+
+from google.appengine.api import memcache
+
+import cacheutils
+import models
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+PREFERENCE_NAMESPACE = "event_preferences"
+
+PREFERENCE_CACHE_SIZE = 1000
+
+PREFERENCE_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# The starred and hidden state of every event in a calendar.  starred is a
+# frozenset of the starred event and recurrence ids, and hidden maps event
+# and recurrence ids to whether they are hidden, where that has been set.
+Preferences = collections.namedtuple("Preferences", ["starred", "hidden"])
+
+# Snapshots are kept in memory with the version they were built at, so
+# a copy is only used while it is the newest.
+_local = cacheutils.LRUCache(PREFERENCE_CACHE_SIZE, PREFERENCE_CACHE_TTL)
+
+
+def _get_cache_keys(calendar_key):
+    """
+    Get the memcache keys for a calendar's snapshot and its version.
+
+    :type calendar_key: ndb.Key
+    :rtype: (str, str)
+    """
+    key = cacheutils.get_memcache_key(calendar_key.urlsafe())
+    return "snapshot:" + key, "version:" + key
+
+
+def _build_preferences(calendar_key):
+    """
+    Read a calendar's preferences from its event entities.
+
+    :type calendar_key: ndb.Key
+    :rtype: Preferences
+    """
+    starred = set()
+    hidden = {}
+    for entity in models.Event.query(ancestor=calendar_key):
+        event_id = entity.key.string_id()
+        if entity.starred:
+            starred.add(event_id)
+        if entity.hidden is not None:
+            hidden[event_id] = entity.hidden
+    return Preferences(frozenset(starred), hidden)
+
+
+def _save_preferences(calendar_key, version, preferences):
+    """
+    Save a snapshot to memory and memcache, tagged with its version.
+
+    :type calendar_key: ndb.Key
+    :type version: int
+    :type preferences: Preferences
+    """
+    snapshot_key, _ = _get_cache_keys(calendar_key)
+    _local.set(calendar_key, (version, preferences))
+    try:
+        memcache.set(snapshot_key, (version, preferences),
+                     time=PREFERENCE_CACHE_TTL,
+                     namespace=PREFERENCE_NAMESPACE)
+    except ValueError:
+        # Too large for memcache, so only this instance keeps it
+        pass
+
+
+def _start_version(calendar_key):
+    """
+    Get a calendar's snapshot version, starting one if there is none.
+
+    Starting a version doesn't bump it, so a flushed memcache costs one
+    rebuild per calendar, rather than one for every read after it.
+
+    :type calendar_key: ndb.Key
+    :return: The version, or None if memcache is unavailable.
+    :rtype: int
+    """
+    _, version_key = _get_cache_keys(calendar_key)
+    # Versions start from the clock, so they don't repeat after eviction.
+    # If another request started one first, theirs is kept.
+    memcache.add(version_key, int(time.time() * 1000),
+                 namespace=PREFERENCE_NAMESPACE)
+    return memcache.get(version_key, namespace=PREFERENCE_NAMESPACE)
+
+
+def invalidate_preferences_multi(calendar_keys):
+    """
+    Drop the snapshots of calendars whose event entities were written.
+
+    The version is bumped, so every instance drops its older copy, and the
+    next read rebuilds the snapshot.
+
+    :type calendar_keys: list[ndb.Key]
+    """
+    if not calendar_keys:
+        return
+    memcache.offset_multi(
+            dict((_get_cache_keys(calendar_key)[1], 1)
+                 for calendar_key in calendar_keys),
+            initial_value=int(time.time() * 1000),
+            namespace=PREFERENCE_NAMESPACE)
+
+
+def refresh_preferences(calendar_key):
+    """
+    Rebuild a calendar's snapshot after its event entities were written.
+
+    The version is bumped before the entities are read, so every instance
+    drops its older copy, and a rebuild that raced with a later write can
+    never pass for the newest.  If memcache is unavailable, the snapshot is
+    built without being cached.
+
+    :type calendar_key: ndb.Key
+    :rtype: Preferences
+    """
+    _, version_key = _get_cache_keys(calendar_key)
+    version = memcache.incr(version_key,
+                            initial_value=int(time.time() * 1000),
+                            namespace=PREFERENCE_NAMESPACE)
+    preferences = _build_preferences(calendar_key)
+    if version is not None:
+        _save_preferences(calendar_key, version, preferences)
+    return preferences
+
+
+def get_preferences_multi(calendar_keys):
+    """
+    Get the preferences for several calendars.
+
+    Each calendar's snapshot comes from memory if it is still the newest
+    version, then from memcache, and otherwise from one ancestor query.
+    Snapshots are only good for the request that reads them, so they should
+    be read once per request and passed along.
+
+    :type calendar_keys: list[ndb.Key]
+    :return: The preferences, in the same order as the keys.
+    :rtype: list[Preferences]
+    """
+    version_keys = [_get_cache_keys(calendar_key)[1]
+                    for calendar_key in calendar_keys]
+    versions = memcache.get_multi(version_keys,
+                                  namespace=PREFERENCE_NAMESPACE)
+
+    results = [None] * len(calendar_keys)
+    missing = {}
+    for i, calendar_key in enumerate(calendar_keys):
+        version = versions.get(version_keys[i])
+        cached = _local.get(calendar_key)
+        if (version is not None and cached is not None and
+                cached[0] == version):
+            results[i] = cached[1]
+        else:
+            missing[_get_cache_keys(calendar_key)[0]] = i, version
+
+    if missing:
+        snapshots = memcache.get_multi(missing.keys(),
+                                       namespace=PREFERENCE_NAMESPACE)
+        for snapshot_key, (i, version) in missing.iteritems():
+            calendar_key = calendar_keys[i]
+            if version is None:
+                # Nothing cached can be newest without a version
+                version = _start_version(calendar_key)
+                cached = None
+            else:
+                cached = snapshots.get(snapshot_key)
+            if (version is not None and cached is not None and
+                    cached[0] == version):
+                _local.set(calendar_key, cached)
+                results[i] = cached[1]
+            else:
+                results[i] = _build_preferences(calendar_key)
+                if version is not None:
+                    _save_preferences(calendar_key, version, results[i])
+    return results
+
+
+def get_preferences(calendar_key):
+    """
+    Get the preferences for a calendar.
+
+    :type calendar_key: ndb.Key
+    :rtype: Preferences
+    """
+    return get_preferences_multi([calendar_key])[0]
+
+
+def get_version(calendar_key):
+    """
+    Get the version of a calendar's preferences, which changes whenever
+    they are refreshed or invalidated.
+
+    :type calendar_key: ndb.Key
+    :return: The version, or None if memcache is unavailable.
+    :rtype: int
+    """
+    _, version_key = _get_cache_keys(calendar_key)
+    version = memcache.get(version_key, namespace=PREFERENCE_NAMESPACE)
+    if version is None:
+        version = _start_version(calendar_key)
+    return version
+
+
+def is_hidden(preferences, event):
+    """
+    Check if an event is hidden, on its own or by its recurring event.
+
+    :type preferences: Preferences
+    :type event: messages.EventProperties
+    :rtype: bool
+    """
+    if event.eventId in preferences.hidden:
+        return preferences.hidden[event.eventId]
+    return preferences.hidden.get(event.recurrenceId, False)
@@ -6,13 +6,15 @@ import urllib2
 
 import endpoints
 from protorpc import remote
-from oauth2client.appengine import AppAssertionCredentials
 
 from ticktockapi import ticktock_api
-import authutils
-import messages
 import gapiutils
+import messages
+import models
+import publiccache
 import searchutils
+import strings
+import tokenutils
 
 __author__ = "Alexander Otavka"
 __copyright__ = "Copyright (C) 2015 DHS Developers Club"
@@ -33,14 +35,11 @@ class PublicAPI(remote.Service):
         """
         Get a list of public calendars.
 
+        Served from the shared public cache, which cron keeps fresh.
+
         :type request: messages.CALENDAR_SEARCH_RESOURCE
         """
-        service = authutils.get_service(
-            authutils.CALENDAR_API_NAME,
-            authutils.CALENDAR_API_VERSION,
-            AppAssertionCredentials(authutils.SERVICE_ACCOUNT_SCOPES)
-        )
-        calendars = gapiutils.get_calendars(service)
+        calendars = publiccache.get_calendars()
 
         # Sort and search
         # TODO: sort by number of people following the calendar
@@ -61,25 +60,48 @@ class PublicAPI(remote.Service):
         """
         Get a list of events for a given public calendar.
 
+        Served from the calendar's shared mirror, which cron keeps fresh.
+        Pages are filled up to maxResults, and the page token records where
+        in the mirror to resume, so paging writes nothing.
+
         :type request: messages.EVENT_SEARCH_RESOURCE
         """
         request.calendarId = urllib2.unquote(request.calendarId)
+        gapiutils.validate_time_zone(request.timeZone)
+
+        # Tokens only work with the same request parameters
+        token_context = "public:{}".format(
+                models.EventCacheGroup.get_sequence_hash(request).encode("hex"))
+
+        if request.pageToken:
+            state = tokenutils.verify(request.pageToken, token_context)
+            try:
+                page_token, offset = state["mirror"]
+                continuation = page_token, int(offset)
+            except (TypeError, ValueError, KeyError):
+                raise endpoints.BadRequestException(
+                        strings.ERROR_INVALID_VALUE)
+        else:
+            continuation = None, 0
 
-        service = authutils.get_service(
-            authutils.CALENDAR_API_NAME,
-            authutils.CALENDAR_API_VERSION,
-            AppAssertionCredentials(authutils.SERVICE_ACCOUNT_SCOPES)
-        )
-        events, next_page_token = gapiutils.get_events(
-                service, request.calendarId, request.timeZone,
-                request.pageToken, request.maxResults)
+        events, continuation = publiccache.fill_page(
+                request.calendarId, request.timeZone, continuation,
+                request.maxResults, request.search)
 
         # Sort and search
         search = request.search
         if search:
-            events = searchutils.event_keyword_search(events, search)
             events = searchutils.event_keyword_chron_sort(events, search)
         else:
             events = searchutils.event_chron_sort(events)
 
-        return messages.EventCollection(items=events)
+        if continuation is not None:
+            next_page_token = tokenutils.sign(dict(mirror=continuation),
+                                              token_context)
+        else:
+            next_page_token = None
+
+        return messages.EventCollection(
+            items=events,
+            nextPageToken=next_page_token
+        )
@@ -0,0 +1,292 @@
+"""Shared, app wide cache of public calendars and their events."""
+
+from __future__ import division, print_function
+
+import itertools
+import logging
+from datetime import datetime, timedelta
+
+from endpoints import api_exceptions
+from google.appengine.ext import ndb
+from oauth2client.appengine import AppAssertionCredentials
+from protorpc import protojson
+import pytz
+import webapp2
+
+import authutils
+import cacheutils
+import gapiutils
+import messages
+import models
+import searchutils
+import syncutils
+import strings
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+# Public calendar mirrors are kept under this user id, which can't clash
+# with real users' ids, since those are numbers.
+PUBLIC_USER_ID = "public"
+
+PUBLIC_CALENDAR_LIST_ID = "public"
+
+# How long rendered lists are kept in memory and memcache.  The cron job
+# refreshes the datastore copies about as often.
+PUBLIC_CACHE_TTL = 10 * 60  # seconds
+
+PUBLIC_PAGE_CACHE_SIZE = 1000
+
+# Most pages of mirror events pulled to fill one page of search results.
+PUBLIC_PULL_LIMIT = 10
+
+# Mirrors the cron job doesn't keep fresh are synced on request, once they
+# are this old.
+PUBLIC_MIRROR_MAX_AGE = timedelta(hours=1)
+
+_calendar_list_cache = cacheutils.TieredCache("public_calendars", 1,
+                                              PUBLIC_CACHE_TTL)
+
+# Pages are cached along with the continuation after each of their events.
+_page_cache = cacheutils.TieredCache("public_event_chunks",
+                                     PUBLIC_PAGE_CACHE_SIZE,
+                                     PUBLIC_CACHE_TTL)
+
+
+def get_public_service():
+    """
+    Get a Calendar resource object for the app's service account.
+
+    :return: Calendar resource object.
+    """
+    return authutils.get_service(
+        authutils.CALENDAR_API_NAME,
+        authutils.CALENDAR_API_VERSION,
+        AppAssertionCredentials(authutils.SERVICE_ACCOUNT_SCOPES),
+        PUBLIC_USER_ID
+    )
+
+
+def _get_public_key():
+    """
+    Get the ndb key public calendar mirrors are kept under.
+
+    :rtype: ndb.Key
+    """
+    return ndb.Key(models.USER_KIND, PUBLIC_USER_ID)
+
+
+def get_public_mirror_key(cal_id):
+    """
+    Get the ndb key for the shared mirror of a public calendar.
+
+    :type cal_id: str
+    :rtype: ndb.Key
+    """
+    return syncutils.get_mirror_key(_get_public_key(), cal_id)
+
+
+def _refresh_calendar_list(service):
+    """
+    Fetch the public calendars, and save them to every level of the cache.
+
+    :param service: Calendar resource object.
+    :return: The calendars, as [id, name, color] records.
+    :rtype: list[list[str]]
+    """
+    entity = models.PublicCalendarList(
+        id=PUBLIC_CALENDAR_LIST_ID,
+        calendars=[[calendar.calendarId, calendar.name, calendar.color]
+                   for calendar in gapiutils.get_calendars(service)]
+    )
+    entity.put()
+    _calendar_list_cache.set(PUBLIC_CALENDAR_LIST_ID, entity.calendars)
+    return entity.calendars
+
+
+def _get_calendar_records():
+    """
+    Get the public calendars, from memory, memcache or the datastore.
+
+    The API is only called if the list has never been fetched.
+
+    :return: The calendars, as [id, name, color] records.
+    :rtype: list[list[str]]
+    """
+    records = _calendar_list_cache.get(PUBLIC_CALENDAR_LIST_ID)
+    if records is None:
+        entity = ndb.Key(models.PublicCalendarList,
+                         PUBLIC_CALENDAR_LIST_ID).get()
+        if entity is not None:
+            records = entity.calendars
+            _calendar_list_cache.set(PUBLIC_CALENDAR_LIST_ID, records)
+        else:
+            records = _refresh_calendar_list(get_public_service())
+    return records
+
+
+def get_calendars():
+    """
+    Get the public calendars, from memory, memcache or the datastore.
+
+    :rtype: list[messages.CalendarProperties]
+    """
+    records = _get_calendar_records()
+    return [
+        messages.CalendarProperties(
+            calendarId=cal_id,
+            name=name,
+            color=color,
+            hidden=None
+        )
+        for cal_id, name, color in records
+    ]
+
+
+def get_mirror(cal_id):
+    """
+    Get the shared mirror of a public calendar.
+
+    The mirror is only synced here if it is missing or has gone without
+    being refreshed by cron for a while.  Only calendars on the public list
+    have mirrors, so anonymous requests can't make more of them.
+
+    :type cal_id: str
+    :rtype: models.CalendarMirror
+    :raise api_exceptions.NotFoundException: The calendar isn't public.
+    """
+    if cal_id not in set(record[0] for record in _get_calendar_records()):
+        raise api_exceptions.NotFoundException()
+
+    mirror_key = get_public_mirror_key(cal_id)
+    mirror = mirror_key.get()
+    if (mirror is None or mirror.synced is None or
+            datetime.utcnow() - mirror.synced > PUBLIC_MIRROR_MAX_AGE):
+        mirror = syncutils.sync_calendar(get_public_service(), mirror_key,
+                                         force=True)
+    return mirror
+
+
+def get_events(cal_id, time_zone, page_token, offset, max_results):
+    """
+    Get a page of upcoming events from a public calendar.
+
+    Pages are cached in memory and memcache, and otherwise read from the
+    calendar's shared mirror.  Along with each event is the continuation
+    right after it, from the same read of the mirror, so a page can be cut
+    short at any event.
+
+    :type cal_id: str
+    :type time_zone: str
+    :param str page_token: Mirror page token to start from.
+    :param int offset: Offset into the mirror page to start from.
+    :type max_results: int
+    :return: The events, the continuation after each of them, and the
+             continuation after the last of them, or None if there are no
+             events left.
+    :rtype: (list[messages.EventProperties], list[(str, int)], (str, int))
+    """
+    cache_key = u"{}:{}:{}:{}:{}".format(cal_id, time_zone, page_token,
+                                         offset, max_results)
+    cached = _page_cache.get(cache_key)
+    if cached is not None:
+        encoded_page, event_continuations, continuation = cached
+        events = protojson.decode_message(messages.EventCollection,
+                                          encoded_page).items
+        # Drop anything that ended since the page was cached
+        now = pytz.utc.localize(datetime.utcnow())
+        kept = [(event, event_continuation) for event, event_continuation
+                in zip(events, event_continuations) if event.endDate >= now]
+        return ([event for event, _ in kept],
+                [event_continuation for _, event_continuation in kept],
+                continuation)
+
+    event_iter = syncutils.iter_events(get_mirror(cal_id), time_zone,
+                                       page_token, offset, max_results)
+    events = []
+    event_continuations = []
+    for event in itertools.islice(event_iter, max_results):
+        events.append(event)
+        event_continuations.append(event_iter.continuation)
+    continuation = event_iter.continuation
+    _page_cache.set(cache_key, (
+        protojson.encode_message(messages.EventCollection(items=events)),
+        event_continuations,
+        continuation
+    ))
+    return events, event_continuations, continuation
+
+
+def fill_page(cal_id, time_zone, continuation, max_results, search=None):
+    """
+    Get up to max_results upcoming events from a public calendar, in
+    mirror order, pulling more events until the page is full.
+
+    With a search, only matching events are kept, so a page is only short
+    if the calendar runs out, or PUBLIC_PULL_LIMIT pages were pulled
+    without filling it.
+
+    :type cal_id: str
+    :type time_zone: str
+    :param (str, int) continuation: Where to start in the mirror.
+    :type max_results: int
+    :param str search: Keywords to narrow events by.
+    :return: The events, and the continuation right after the last of
+             them, or None if there are no events left.
+    :rtype: (list[messages.EventProperties], (str, int))
+    """
+    events = []
+    for _ in range(PUBLIC_PULL_LIMIT):
+        needed = max_results - len(events)
+        if continuation is None or needed <= 0:
+            break
+
+        chunk, chunk_continuations, continuation = get_events(
+                cal_id, time_zone, continuation[0], continuation[1],
+                max_results)
+        if search:
+            matches = set(id(event) for event in
+                          searchutils.event_keyword_search(chunk, search))
+            positions = [i for i, event in enumerate(chunk)
+                         if id(event) in matches]
+        else:
+            positions = range(len(chunk))
+
+        if len(positions) > needed:
+            # Resume right after the last event that fits, as read along
+            # with the rest of the chunk
+            positions = positions[:needed]
+            continuation = chunk_continuations[positions[-1]]
+        events += [chunk[i] for i in positions]
+
+    return events, continuation
+
+
+class PublicCacheRefresher(webapp2.RequestHandler):
+    """Respond to cron job by refreshing the shared public calendar data."""
+
+    def get(self):
+        service = get_public_service()
+        records = _refresh_calendar_list(service)
+
+        mirror_keys = [get_public_mirror_key(cal_id)
+                       for cal_id, _, _ in records]
+        syncutils.sync_calendars(service, mirror_keys)
+
+        # Clear the mirrors of calendars that are no longer public
+        listed_keys = set(mirror_keys)
+        for mirror_key in models.CalendarMirror.query(
+                ancestor=_get_public_key()).iter(keys_only=True):
+            if mirror_key not in listed_keys:
+                syncutils.clear_mirror(mirror_key)
+
+        logging.info(strings.logging_public_cache_refresh(
+                calendars=len(mirror_keys)))
+        self.response.write(strings.logging_public_cache_refresh(
+                calendars=len(mirror_keys)))
+
+
+refreshers = webapp2.WSGIApplication([
+    ("/_ah/publiccache/refresh", PublicCacheRefresher),
+])
@@ -0,0 +1,298 @@
+"""Tools for finding the instances of recurring events without the API."""
+
+from __future__ import division, print_function
+
+import base64
+import re
+import urllib
+import urlparse
+from datetime import datetime, timedelta
+
+from dateutil import rrule
+import pytz
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+ICAL_DATE_FORMAT = "%Y%m%d"
+ICAL_DATETIME_FORMAT = "%Y%m%dT%H%M%S"
+
+# Most overridden occurrences skipped while looking for the next instance.
+OVERRIDE_SKIP_MAX = 1000
+
+_UNTIL_PATTERN = re.compile(r"UNTIL=(\d{8}T\d{6})Z")
+
+
+class RecurrenceError(ValueError):
+    """The recurrence rules of an event could not be expanded."""
+    pass
+
+
+def _parse_rfc3339(string):
+    """
+    Parse an RFC 3339 date-time string from the API, with its offset.
+
+    :type string: str
+    :rtype: datetime
+    :return: The time, in UTC.
+    """
+    date = datetime.strptime(string[:19], "%Y-%m-%dT%H:%M:%S")
+    offset = string[19:]
+    if offset.startswith("."):
+        offset = offset.lstrip(".0123456789")
+    if offset not in ("", "Z", "z"):
+        sign = -1 if offset[0] == "-" else 1
+        hours, minutes = offset[1:].split(":")
+        date -= sign * timedelta(hours=int(hours), minutes=int(minutes))
+    return pytz.utc.localize(date)
+
+
+def get_original_key(item_date):
+    """
+    Get the key an instance is known by, from its originalStartTime.
+
+    Keys are the same as the suffixes of instance ids.
+
+    :param dict item_date: A start or originalStartTime field.
+    :rtype: str
+    """
+    if "dateTime" in item_date:
+        return (_parse_rfc3339(item_date["dateTime"])
+                .strftime(ICAL_DATETIME_FORMAT) + "Z")
+    return item_date["date"].replace("-", "")
+
+
+def _get_item_start(item, tzinfo):
+    """
+    Get when an item starts, with all day items starting at midnight.
+
+    :type item: dict
+    :type tzinfo: tzinfo
+    :rtype: datetime
+    """
+    if "dateTime" in item["start"]:
+        return _parse_rfc3339(item["start"]["dateTime"])
+    return tzinfo.localize(datetime.strptime(item["start"]["date"],
+                                             "%Y-%m-%d"))
+
+
+def _get_item_end(item, tzinfo):
+    """
+    Get when an item ends, with all day items ending at midnight.
+
+    :type item: dict
+    :type tzinfo: tzinfo
+    :rtype: datetime
+    """
+    if "dateTime" in item["end"]:
+        return _parse_rfc3339(item["end"]["dateTime"])
+    return tzinfo.localize(datetime.strptime(item["end"]["date"],
+                                             "%Y-%m-%d"))
+
+
+def _to_local(date, tzinfo):
+    """
+    Convert an aware datetime to naive local time in a time zone.
+
+    :type date: datetime
+    :type tzinfo: tzinfo
+    :rtype: datetime
+    """
+    return date.astimezone(tzinfo).replace(tzinfo=None)
+
+
+def _parse_ical_date(string, tzid, series_tzinfo):
+    """
+    Parse an RDATE or EXDATE value to naive local time in the series' zone.
+
+    :type string: str
+    :param str tzid: The value's TZID parameter, if any.
+    :type series_tzinfo: tzinfo
+    :rtype: datetime
+    """
+    if len(string) == 8:
+        return datetime.strptime(string, ICAL_DATE_FORMAT)
+    if string.upper().endswith("Z"):
+        date = pytz.utc.localize(datetime.strptime(string[:-1],
+                                                   ICAL_DATETIME_FORMAT))
+        return _to_local(date, series_tzinfo)
+    date = datetime.strptime(string, ICAL_DATETIME_FORMAT)
+    if tzid is not None:
+        date = _to_local(pytz.timezone(tzid).localize(date), series_tzinfo)
+    return date
+
+
+def _parse_recurrence(lines, dtstart, series_tzinfo):
+    """
+    Build a rule set from the recurrence field of an event.
+
+    Everything is expanded in naive local time, so occurrences keep their
+    wall clock time across daylight saving changes.
+
+    :param list[str] lines: RRULE, EXRULE, RDATE and EXDATE lines.
+    :param datetime dtstart: Naive local start of the series.
+    :type series_tzinfo: tzinfo
+    :rtype: rrule.rruleset
+    """
+    def local_until(match):
+        until = pytz.utc.localize(datetime.strptime(match.group(1),
+                                                    ICAL_DATETIME_FORMAT))
+        return "UNTIL=" + _to_local(until, series_tzinfo).strftime(
+                ICAL_DATETIME_FORMAT)
+
+    rule_set = rrule.rruleset()
+    for line in lines:
+        head, _, value = line.partition(":")
+        parts = head.split(";")
+        name = parts[0].upper()
+        params = dict((param_name.upper(), param_value)
+                      for param_name, _, param_value in
+                      (param.partition("=") for param in parts[1:]))
+        if name in ("RRULE", "EXRULE"):
+            rule = rrule.rrulestr(_UNTIL_PATTERN.sub(local_until, value),
+                                  dtstart=dtstart)
+            if name == "RRULE":
+                rule_set.rrule(rule)
+            else:
+                rule_set.exrule(rule)
+        elif name in ("RDATE", "EXDATE"):
+            for string in value.split(","):
+                date = _parse_ical_date(string.strip(), params.get("TZID"),
+                                        series_tzinfo)
+                if name == "RDATE":
+                    rule_set.rdate(date)
+                else:
+                    rule_set.exdate(date)
+        else:
+            raise RecurrenceError(line)
+    return rule_set
+
+
+def _get_instance_link(link, instance_id):
+    """
+    Get the link to an instance from the link to its recurring event.
+
+    Calendar links name the event with an "eid", which is the event id and
+    calendar id, base 64 encoded.
+
+    :type link: str
+    :type instance_id: str
+    :rtype: str
+    """
+    try:
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(link)
+        params = urlparse.parse_qs(query)
+        eid = params["eid"][0]
+        decoded = base64.urlsafe_b64decode(str(eid) + "=" * (-len(eid) % 4))
+        calendar_part = decoded.split(" ", 1)[1]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return link
+    params["eid"] = [base64.urlsafe_b64encode(
+            "{} {}".format(instance_id, calendar_part)).rstrip("=")]
+    return urlparse.urlunsplit((scheme, netloc, path,
+                                urllib.urlencode(params, doseq=True),
+                                fragment))
+
+
+def _render_dates(item, tzinfo):
+    """
+    Copy an item, with its timed dates written in a given time zone, the
+    way the API writes them when asked for that time zone.
+
+    :type item: dict
+    :type tzinfo: tzinfo
+    :rtype: dict
+    """
+    item = dict(item)
+    for field in ("start", "end"):
+        if "dateTime" in item[field]:
+            item[field] = dict(item[field], dateTime=_parse_rfc3339(
+                    item[field]["dateTime"]).astimezone(tzinfo).isoformat())
+    return item
+
+
+def get_next_instance(master, overrides, now, tzinfo):
+    """
+    Find the next instance of a recurring event that hasn't ended.
+
+    :param dict master: The recurring event, from events.get, including its
+                        recurrence field.
+    :param dict[str, dict] overrides: Modified instances, by the key of
+                                      their original start, or None for
+                                      cancelled instances.
+    :param datetime now: The current time.
+    :param tzinfo tzinfo: Time zone to write the instance's dates in, which
+                          is also the series' zone if it doesn't have one.
+    :return: The instance, in the same form as an events.instances item,
+             or None if the series is over.
+    :rtype: dict
+    :raise RecurrenceError: The recurrence rules couldn't be expanded.
+    """
+    try:
+        start = master["start"]
+        series_tzinfo = pytz.timezone(start.get("timeZone") or tzinfo.zone)
+        all_day = "dateTime" not in start
+        if all_day:
+            dtstart = datetime.strptime(start["date"], "%Y-%m-%d")
+            duration = (datetime.strptime(master["end"]["date"], "%Y-%m-%d") -
+                        dtstart)
+        else:
+            aware_start = _parse_rfc3339(start["dateTime"])
+            dtstart = _to_local(aware_start, series_tzinfo)
+            duration = _parse_rfc3339(master["end"]["dateTime"]) - aware_start
+        rule_set = _parse_recurrence(master["recurrence"], dtstart,
+                                     series_tzinfo)
+
+        # Earliest occurrence that hasn't ended, and wasn't changed
+        occurrence = rule_set.after(_to_local(now, series_tzinfo) - duration,
+                                    inc=True)
+        key = None
+        for _ in range(OVERRIDE_SKIP_MAX):
+            if occurrence is None:
+                break
+            if all_day:
+                key = occurrence.strftime(ICAL_DATE_FORMAT)
+            else:
+                key = (series_tzinfo.localize(occurrence)
+                       .astimezone(pytz.utc)
+                       .strftime(ICAL_DATETIME_FORMAT) + "Z")
+            if key not in overrides:
+                break
+            occurrence = rule_set.after(occurrence)
+        else:
+            occurrence = None
+    except (KeyError, TypeError, ValueError, pytz.UnknownTimeZoneError) as e:
+        raise RecurrenceError(e)
+
+    candidates = []
+    if occurrence is not None:
+        instance = dict(master)
+        del instance["recurrence"]
+        instance["id"] = "{}_{}".format(master["id"], key)
+        instance["recurringEventId"] = master["id"]
+        if "htmlLink" in master:
+            instance["htmlLink"] = _get_instance_link(master["htmlLink"],
+                                                      instance["id"])
+        if all_day:
+            instance["start"] = dict(date=occurrence.strftime("%Y-%m-%d"))
+            instance["end"] = dict(
+                    date=(occurrence + duration).strftime("%Y-%m-%d"))
+        else:
+            instance["start"] = dict(start, dateTime=series_tzinfo.localize(
+                    occurrence).isoformat())
+            instance["end"] = dict(master["end"], dateTime=(
+                    series_tzinfo.localize(occurrence + duration)
+                    .isoformat()))
+        candidates.append(instance)
+
+    # Changed instances may have moved anywhere, so all of them are checked
+    candidates += [override for override in overrides.itervalues()
+                   if override is not None and
+                   _get_item_end(override, tzinfo) >= now]
+
+    if not candidates:
+        return None
+    instance = min(candidates,
+                   key=lambda item: _get_item_start(item, series_tzinfo))
+    return _render_dates(instance, tzinfo)
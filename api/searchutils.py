@@ -2,67 +2,150 @@
 
 from __future__ import division, print_function
 
+import bisect
+import collections
+import heapq
 import locale
-from functools import cmp_to_key
+import re
 
 from messages import EventProperties, CalendarProperties
+import cacheutils
 
 __author__ = "Alexander Otavka"
 __copyright__ = "Copyright (C) 2015 DHS Developers Club"
 
 
+# Words, along with apostrophes inside them and trailing pluses and
+# sharps, so "O'Neil" and "C++" are each one term.
+_TERM_PATTERN = re.compile(u"\\w+(?:['\u2019]\\w+)*[+#]*", re.UNICODE)
+
+COLLATION_CACHE_SIZE = 10000
+
+_collation_keys = cacheutils.LRUCache(COLLATION_CACHE_SIZE)
+
+
 class NullSearchError(Exception):
     def __init__(self):
         super(NullSearchError, self).__init__(
                 "Insufficient matches found for data item.")
 
 
-def _get_event_kw_score(event, keywords, narrow):
+def tokenize(string):
     """
-    Get a relevance score for an event based on keyword matches.
+    Split a string into lower case search terms.
 
-    :type event: EventProperties
-    :type keywords: str
-    :param bool narrow: If true, throw NullSearchError for insufficient keyword
-                        matches.
-    :rtype: float
-    :raise NullSearchError: If narrow is True and insufficient keyword matches
-                            are found.
+    :type string: str
+    :rtype: list[str]
     """
-    # TODO: make search algorithm less bad
-    event_string_data = event.name.lower()
-    search_set = set(keywords.split())
-    matches = 0.0
-    for keyword in search_set:
-        if keyword.lower() in event_string_data:
-            matches += 1.0
-    if narrow and (not matches or matches < len(search_set) // 2):
-        raise NullSearchError()
-    return matches
+    if not string:
+        return []
+    return _TERM_PATTERN.findall(string.lower())
 
 
-def _get_calendar_kw_score(calendar, keywords, narrow):
+class SearchIndex(object):
     """
-    Get a relevance score for a calendar based on keyword matches.
+    An inverted index from the terms in items' names to the items.
 
-    :param CalendarProperties calendar: Event to be scored.
-    :param str keywords: Search terms separated by spaces.
-    :param bool narrow:
-        If true, throw NullSearchError for insufficient keyword matches.
+    A keyword matches every term that starts with it, so "meet" finds
+    "meeting".  The distinct terms of the indexed names are kept sorted, so
+    the terms a keyword matches are found with a binary search, rather
+    than by checking every term.
+
+    :type items: list[T]
+    """
 
-    :rtype: int
-    :raise NullSearchError:
-        If narrow=True and insufficient keyword matches are found.
+    def __init__(self, items, get_name):
+        """
+        :param list[T] items: Items to index.
+        :param (T) -> str get_name: Get the searchable name of an item.
+        """
+        self.items = items
+        self._postings = collections.defaultdict(set)
+        """:type: dict[str, set[int]]"""
+        for position, item in enumerate(items):
+            for term in tokenize(get_name(item)):
+                self._postings[term].add(position)
+        self._terms = sorted(self._postings)
+
+    def _get_positions(self, keyword):
+        """
+        Get the positions of all items with a term starting with keyword.
+
+        :type keyword: str
+        :rtype: set[int]
+        """
+        positions = set()
+        for i in xrange(bisect.bisect_left(self._terms, keyword),
+                        len(self._terms)):
+            term = self._terms[i]
+            if not term.startswith(keyword):
+                break
+            positions |= self._postings[term]
+        return positions
+
+    def score(self, keywords):
+        """
+        Count how many of the keywords each item matches.
+
+        :param str keywords: Search terms separated by spaces.
+        :return: Map from item positions to match counts, leaving out items
+                 with no matches, and the number of distinct keywords.
+        :rtype: (dict[int, int], int)
+        """
+        search_set = set(tokenize(keywords))
+        matches = collections.Counter()
+        for keyword in search_set:
+            for position in self._get_positions(keyword):
+                matches[position] += 1
+        return matches, len(search_set)
+
+
+def get_collation_key(name):
+    """
+    Get a key that sorts names in case insensitive locale order.
+
+    Keys are plain strings, so comparing them is cheap, and they are cached
+    by name, so each name is only transformed once.
+
+    :type name: str
+    :rtype: str
+    """
+    name = name or ""
+    key = _collation_keys.get(name)
+    if key is None:
+        lower_name = name.lower()
+        if isinstance(lower_name, unicode):
+            lower_name = lower_name.encode("utf-8")
+        key = locale.strxfrm(lower_name)
+        _collation_keys.set(name, key)
+    return key
+
+
+def _get_kw_score(items, get_name, keywords, narrow):
+    """
+    Build a relevance scoring function for items based on keyword matches.
+
+    All of the items are indexed up front, so scoring each one is a lookup.
+
+    :param list[T] items: Every item that will be scored.
+    :param (T) -> str get_name: Get the searchable name of an item.
+    :param str keywords: Search terms separated by spaces.
+    :param bool narrow: If true, the function throws NullSearchError for
+                        insufficient keyword matches.
+    :rtype: (T) -> int
     """
-    calendar_string_data = calendar.name
-    search_set = set(keywords.split())
-    matches = 0
-    for keyword in search_set:
-        if keyword in calendar_string_data:
-            matches += 1
-    if narrow and matches < len(search_set) // 2:
-        raise NullSearchError()
-    return matches
+    matches, keyword_count = SearchIndex(items, get_name).score(keywords)
+    scores = dict((id(items[position]), count)
+                  for position, count in matches.iteritems())
+
+    def score(item):
+        item_matches = scores.get(id(item), 0)
+        if narrow and (not item_matches or
+                       item_matches < keyword_count // 2):
+            raise NullSearchError()
+        return item_matches
+
+    return score
 
 
 def event_starred(e):
@@ -74,7 +157,7 @@ def event_start_date(e):
 
 
 def event_alpha_score(e):
-    return cmp_to_key(locale.strcoll)(e.name.lower())
+    return get_collation_key(e.name)
 
 
 def event_id_score(e):
@@ -84,16 +167,24 @@ def event_id_score(e):
     return e.eventId
 
 
-def event_kw_score(kw, narrow):
-    return lambda e: _get_event_kw_score(e, kw, narrow)
+def event_name(e):
+    return e.name
+
+
+def event_kw_score(event_list, kw, narrow):
+    return _get_kw_score(event_list, event_name, kw, narrow)
+
 
+def calendar_name(c):
+    return c.name
 
-def calendar_kw_score(kw, narrow):
-    return lambda c: _get_calendar_kw_score(c, kw, narrow)
+
+def calendar_kw_score(calendar_list, kw, narrow):
+    return _get_kw_score(calendar_list, calendar_name, kw, narrow)
 
 
 def calendar_alpha_score(c):
-    return cmp_to_key(locale.strcoll)(c.name.lower())
+    return get_collation_key(c.name)
 
 
 def calendar_id_score(c):
@@ -103,28 +194,95 @@ def calendar_id_score(c):
     return c.calendarId
 
 
-def search(search_list, order):
+def _get_sort_keys(search_list, order, start=0):
     """
-    Search and sort search_list based on tuple of order functions.
+    Compute the sort key of every item that isn't narrowed out of a search.
+
+    Each key ends with the item's position and then the item, so ties never
+    fall through to comparing items.
 
     :type search_list: list[T]
     :type order: list[(T) -> object]
-    :rtype: list[T]
+    :param int start: Position of the first item.
+    :rtype: list[tuple]
     """
-    if not search_list:
-        return []
-    sorted_list = []
-    for i in search_list:
+    keys = []
+    for position, i in enumerate(search_list, start):
         try:
             # noinspection PyCallingNonCallable
-            sorted_list.append(tuple(score(i) for score in order) + (i,))
+            keys.append(tuple(score(i) for score in order) + (position, i))
         except NullSearchError:
             continue
-    sorted_list = sorted(sorted_list)
-    if sorted_list:
-        return list(zip(*sorted_list)[-1])
-    else:
-        return []
+    return keys
+
+
+def search(search_list, order):
+    """
+    Search and sort search_list based on tuple of order functions.
+
+    :type search_list: list[T]
+    :type order: list[(T) -> object]
+    :rtype: list[T]
+    """
+    keys = _get_sort_keys(search_list, order)
+    keys.sort()
+    return [key[-1] for key in keys]
+
+
+def merge_page(runs, order, limit):
+    """
+    Pick out the first page of items from several runs, in order.
+
+    Only the page is sorted, with a heap of at most limit items, so the
+    cost grows with the size of the page rather than the number of items.
+    The rest of the items are left as they were, so they are only sorted
+    if they are ever needed.
+
+    :type runs: list[list[T]]
+    :type order: list[(T) -> object]
+    :type limit: int
+    :return: The first limit items in order, and the rest of the items that
+             match, in the order of the runs, one run after another.
+    :rtype: (list[T], list[T])
+    """
+    keys = []
+    start = 0
+    for run in runs:
+        keys += _get_sort_keys(run, order, start)
+        start += len(run)
+    page = heapq.nsmallest(limit, keys)
+
+    # Keys hold the items' positions, which tell the page's items apart
+    taken = set(key[-2] for key in page)
+    rest = [key[-1] for key in keys if key[-2] not in taken]
+    return [key[-1] for key in page], rest
+
+
+def merge_tagged(iterators, order):
+    """
+    Lazily merge iterators of (item, tag) pairs into one sequence.
+
+    Unlike merge_page, which picks a page out of lists of items, this
+    never holds more than the next item of each iterator.  Each iterator
+    must already yield its items in order, and is only pulled from as its
+    items are needed.  Tags are passed through untouched.
+
+    :type iterators: list[collections.Iterator[(T, object)]]
+    :type order: list[(T) -> object]
+    :rtype: collections.Iterator[(T, object)]
+    """
+    def get_keys(iterator, index):
+        for position, (item, tag) in enumerate(iterator):
+            try:
+                # noinspection PyCallingNonCallable
+                yield (tuple(score(item) for score in order) +
+                       (index, position, item, tag))
+            except NullSearchError:
+                continue
+
+    for key in heapq.merge(*[get_keys(iterator, index)
+                             for index, iterator in enumerate(iterators)]):
+        yield key[-2], key[-1]
 
 
 def event_keyword_search(event_list, keywords):
@@ -135,7 +293,19 @@ def event_keyword_search(event_list, keywords):
     :type keywords: str
     :rtype: list[EventProperties]
     """
-    return search(event_list, [event_kw_score(keywords, True)])
+    return search(event_list, [event_kw_score(event_list, keywords, True)])
+
+
+def event_keyword_chron_order(event_list, keywords):
+    """
+    Get the order functions for event_keyword_chron_sort.
+
+    :type event_list: list[EventProperties]
+    :type keywords: str
+    :rtype: list[(EventProperties) -> object]
+    """
+    return [event_starred, event_kw_score(event_list, keywords, False),
+            event_start_date, event_alpha_score, event_id_score]
 
 
 def event_keyword_chron_sort(event_list, keywords):
@@ -146,9 +316,17 @@ def event_keyword_chron_sort(event_list, keywords):
     :type keywords: str
     :rtype: list[EventProperties]
     """
-    return search(event_list, [event_starred, event_kw_score(keywords, False),
-                               event_start_date, event_alpha_score,
-                               event_id_score])
+    return search(event_list, event_keyword_chron_order(event_list, keywords))
+
+
+def event_chron_order():
+    """
+    Get the order functions for event_chron_sort.
+
+    :rtype: list[(EventProperties) -> object]
+    """
+    return [event_starred, event_start_date, event_alpha_score,
+            event_id_score]
 
 
 def event_chron_sort(event_list):
@@ -158,8 +336,7 @@ def event_chron_sort(event_list):
     :type event_list: list[EventProperties]
     :rtype: list[EventProperties]
     """
-    return search(event_list, [event_starred, event_start_date,
-                               event_alpha_score, event_id_score])
+    return search(event_list, event_chron_order())
 
 
 def calendar_keyword_alpha_search(calendar_list, keywords):
@@ -170,8 +347,9 @@ def calendar_keyword_alpha_search(calendar_list, keywords):
     :type keywords: str
     :rtype: list[CalendarProperties]
     """
-    return search(calendar_list, [calendar_kw_score(keywords, True),
-                                  calendar_alpha_score, calendar_id_score])
+    return search(calendar_list,
+                  [calendar_kw_score(calendar_list, keywords, True),
+                   calendar_alpha_score, calendar_id_score])
 
 
 def calendar_alpha_sort(calendar_list):
@@ -25,6 +25,60 @@ def logging_delete_unbound_event(event_id, calendar_id, user_id):
             .format(event_id, calendar_id, user_id))
 
 
+def logging_garbage_collection_started(run_id):
+    return "Started garbage collection run with run_id = '{}'.".format(run_id)
+
+
 def logging_garbage_collection_summary(unbound):
     return ("Deleted {} unbound entities."
             .format(unbound))
+
+
+def logging_cache_collection_summary(expired):
+    return ("Deleted {} expired EventCacheGroup entities."
+            .format(expired))
+
+
+def logging_ended_event_collection_summary(ended):
+    return ("Deleted {} Event entities for events that are over."
+            .format(ended))
+
+
+def logging_end_date_backfill(dated):
+    return ("Dated {} Event entities saved without end dates."
+            .format(dated))
+
+
+def logging_unknown_channel(channel_id):
+    return ("Ignored: notification for unknown channel with channel_id = "
+            "'{}'.".format(channel_id))
+
+
+def logging_invalidate_mirror(calendar_id, user_key):
+    return ("Invalidated: CalendarMirror entity with calendar_id = '{}' and "
+            "user_key = '{}'.".format(calendar_id, user_key))
+
+
+def logging_watch_failed(calendar_id, error):
+    return ("Failed to watch calendar with calendar_id = '{}': {}"
+            .format(calendar_id, error))
+
+
+def logging_sync_failed(calendar_id, error):
+    return ("Failed to sync calendar with calendar_id = '{}': {}"
+            .format(calendar_id, error))
+
+
+def logging_response_cache_stats(hits, misses, uncached):
+    return ("Conditional API queries so far: {} not modified, {} modified, "
+            "{} uncached.".format(hits, misses, uncached))
+
+
+def logging_channel_renewal_summary(renewed, stopped):
+    return ("Renewed {} channels and stopped {} channels."
+            .format(renewed, stopped))
+
+
+def logging_public_cache_refresh(calendars):
+    return ("Refreshed the public calendar list and {} public calendar "
+            "mirrors.".format(calendars))
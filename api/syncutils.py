@@ -0,0 +1,533 @@
+"""Tools for keeping a local mirror of a user's calendars in the datastore."""
+
+from __future__ import division, print_function
+
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from endpoints import api_exceptions
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.api import app_identity, datastore_errors
+import pytz
+
+import models
+import gapiutils
+import strings
+import environment
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+# Minimum time between incremental syncs of a calendar, unless it is stale.
+SYNC_INTERVAL = timedelta(minutes=1)
+
+# Full syncs only fetch events that start within this long, so the first
+# sync of a calendar, which happens during a request, takes a bounded
+# number of pages.  Mirrors start over once their horizon is nearer than
+# FULL_SYNC_MARGIN, and events past it aren't listed.
+FULL_SYNC_HORIZON = timedelta(days=365)
+FULL_SYNC_MARGIN = timedelta(days=180)
+
+NOTIFICATION_PATH = "/_ah/notifications/calendar"
+
+# Requested lifetime of push notification channels.
+CHANNEL_TTL = timedelta(days=7)
+
+# Channels that could not be opened are retried after this long.
+CHANNEL_RETRY_INTERVAL = timedelta(hours=6)
+
+# Mirror page tokens are a start date, in microseconds since EPOCH, and an
+# event id, joined by this.  It can't appear in datastore cursors.
+POSITION_SEPARATOR = ":"
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_mirror_key(user_key, cal_id):
+    """
+    Get the ndb key for a user's mirror of a calendar.
+
+    :type user_key: ndb.Key
+    :type cal_id: str
+    :rtype: ndb.Key
+    """
+    return ndb.Key(models.CalendarMirror, cal_id, parent=user_key)
+
+
+def _date_from_item_date(item_date, calendar_tzinfo):
+    """
+    Get a naive UTC datetime from the start or end field of an API item.
+
+    :type item_date: dict
+    :type calendar_tzinfo: tzinfo
+    :rtype: datetime
+    """
+    if "dateTime" in item_date:
+        date = gapiutils.datetime_from_string(item_date["dateTime"],
+                                              pytz.utc)
+    else:
+        date = gapiutils.datetime_from_date_string(item_date["date"],
+                                                   calendar_tzinfo)
+    return date.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def _event_from_item(item, mirror_key, calendar_tzinfo):
+    """
+    Build a MirroredEvent from an item returned by gapiutils.sync_events.
+
+    :type item: dict
+    :type mirror_key: ndb.Key
+    :type calendar_tzinfo: tzinfo
+    :rtype: models.MirroredEvent
+    """
+    assert "id" in item
+    assert "start" in item
+    assert "end" in item
+    assert "htmlLink" in item
+    return models.MirroredEvent(
+        id=item["id"],
+        parent=mirror_key,
+        name=item.get("summary"),
+        start_date=_date_from_item_date(item["start"], calendar_tzinfo),
+        end_date=_date_from_item_date(item["end"], calendar_tzinfo),
+        all_day="dateTime" not in item["start"],
+        link=item["htmlLink"],
+        recurrence_id=item.get("recurringEventId")
+    )
+
+
+def _prune_ended_events(mirror_key, now):
+    """
+    Delete mirrored events that have already ended.
+
+    :type mirror_key: ndb.Key
+    :type now: datetime
+    """
+    ended_query = models.MirroredEvent.query(
+            models.MirroredEvent.end_date < now, ancestor=mirror_key)
+    ndb.delete_multi(ended_query.fetch(keys_only=True))
+
+
+def _refresh_end_dates(mirror_key, mirrored_events):
+    """
+    Update the stored end dates of event entities whose events changed.
+
+    This keeps moved events from being collected as if they had ended, and
+    dates entities saved before end dates were stored.
+
+    :type mirror_key: ndb.Key
+    :type mirrored_events: list[models.MirroredEvent]
+    """
+    calendar_key = ndb.Key(models.Calendar, mirror_key.string_id(),
+                           parent=mirror_key.parent())
+    entities = ndb.get_multi([
+        ndb.Key(models.Event, mirrored_event.key.string_id(),
+                parent=calendar_key)
+        for mirrored_event in mirrored_events
+    ])
+    moved = []
+    for entity, mirrored_event in zip(entities, mirrored_events):
+        if (entity is not None and entity.end_date != models.Event.NEVER and
+                entity.end_date != mirrored_event.end_date):
+            entity.end_date = mirrored_event.end_date
+            moved.append(entity)
+    ndb.put_multi(moved)
+
+
+def invalidate_mirror(mirror_key):
+    """
+    Mark a mirror stale, so the next request for it syncs with Google.
+
+    The calendar's cached time zone is dropped as well.
+
+    :type mirror_key: ndb.Key
+    """
+    gapiutils.forget_calendar_time_zone(mirror_key.string_id())
+    mirror = mirror_key.get()
+    if mirror is not None and not mirror.stale:
+        logging.info(strings.logging_invalidate_mirror(
+                calendar_id=mirror_key.string_id(),
+                user_key=mirror_key.parent()))
+        mirror.stale = True
+        mirror.put()
+
+
+def watch_calendars(service, mirrors, user_id):
+    """
+    Open push notification channels that invalidate mirrors on changes.
+
+    All of the channels are opened together, with batch requests.  On the
+    dev server, Google can't reach the app, so the channels are only
+    recorded locally, which is enough to post test notifications to them.
+
+    :param service: Calendar resource object.
+    :type mirrors: list[models.CalendarMirror]
+    :type user_id: unicode
+    :return: The channels, in the same order as their mirrors.
+    :rtype: list[models.WatchChannel]
+    """
+    channels = [
+        models.WatchChannel(
+            id=uuid.uuid4().hex,
+            mirror=mirror.key,
+            user_id=user_id,
+            token=os.urandom(16).encode("hex"),
+            expiration=datetime.utcnow() + CHANNEL_TTL
+        )
+        for mirror in mirrors
+    ]
+    if not channels:
+        return channels
+
+    if not environment.IS_DEV:
+        address = "https://{}{}".format(
+                app_identity.get_default_version_hostname(), NOTIFICATION_PATH)
+        results = gapiutils.watch_events_batch(service, dict(
+            (mirror.key.string_id(), (channel.key.string_id(), channel.token))
+            for mirror, channel in zip(mirrors, channels)
+        ), address, int(CHANNEL_TTL.total_seconds()))
+
+        for mirror, channel in zip(mirrors, channels):
+            result = results[mirror.key.string_id()]
+            if isinstance(result, api_exceptions.ServiceException):
+                # The mirror still works without notifications, it just polls
+                logging.warning(strings.logging_watch_failed(
+                        calendar_id=mirror.key.string_id(), error=result))
+                channel.expiration = (datetime.utcnow() +
+                                      CHANNEL_RETRY_INTERVAL)
+            else:
+                channel.resource_id, channel.expiration = result
+
+    for mirror, channel in zip(mirrors, channels):
+        mirror.channel_id = channel.key.string_id()
+    ndb.put_multi(channels + mirrors)
+    return channels
+
+
+def watch_calendar(service, mirror, user_id):
+    """
+    Open a push notification channel that invalidates a mirror on changes.
+
+    :param service: Calendar resource object.
+    :type mirror: models.CalendarMirror
+    :type user_id: unicode
+    :rtype: models.WatchChannel
+    """
+    return watch_calendars(service, [mirror], user_id)[0]
+
+
+def stop_watching(service, channel):
+    """
+    Close a push notification channel and delete its entity.
+
+    :param service: Calendar resource object, or None if the user's
+                    credentials are gone, in which case the channel is
+                    left to expire on its own.
+    :type channel: models.WatchChannel
+    """
+    if service is not None and channel.resource_id is not None:
+        try:
+            gapiutils.stop_channel(service, channel.key.string_id(),
+                                   channel.resource_id)
+        except api_exceptions.ServiceException:
+            pass
+    channel.key.delete()
+
+
+def clear_mirror(mirror_key):
+    """
+    Delete all of a mirror's events and its sync state.
+
+    :type mirror_key: ndb.Key
+    """
+    events_query = models.MirroredEvent.query(ancestor=mirror_key)
+    ndb.delete_multi(events_query.fetch(keys_only=True))
+    mirror_key.delete()
+
+
+def _is_fresh(mirror, now):
+    """
+    Check if a mirror was synced recently enough to skip syncing it.
+
+    :type mirror: models.CalendarMirror
+    :type now: datetime
+    :rtype: bool
+    """
+    return (not mirror.stale and mirror.sync_token is not None and
+            mirror.synced is not None and now - mirror.synced < SYNC_INTERVAL)
+
+
+def _needs_full_sync(mirror, now):
+    """
+    Check if a mirror's horizon is near enough that it should start over.
+
+    :type mirror: models.CalendarMirror
+    :type now: datetime
+    :rtype: bool
+    """
+    return (mirror.sync_token is not None and mirror.horizon is not None and
+            mirror.horizon - now < FULL_SYNC_MARGIN)
+
+
+def _apply_sync(mirror, sync, now):
+    """
+    Save the changes from gapiutils.sync_events to a mirror.
+
+    :type mirror: models.CalendarMirror
+    :type sync: (list[dict], list[str], str, str)
+    :type now: datetime
+    """
+    changed, deleted, sync_token, time_zone = sync
+
+    if mirror.sync_token is None:
+        mirror.horizon = now + FULL_SYNC_HORIZON
+
+    calendar_tzinfo = pytz.timezone(time_zone)
+    mirrored_events = [_event_from_item(item, mirror.key, calendar_tzinfo)
+                       for item in changed]
+    ndb.put_multi(mirrored_events)
+    _refresh_end_dates(mirror.key, mirrored_events)
+    ndb.delete_multi([ndb.Key(models.MirroredEvent, event_id,
+                              parent=mirror.key)
+                      for event_id in deleted])
+    _prune_ended_events(mirror.key, now)
+
+    mirror.sync_token = sync_token
+    mirror.time_zone = time_zone
+    mirror.synced = now
+    mirror.stale = False
+    mirror.put()
+
+
+def sync_calendar(service, mirror_key, force=False):
+    """
+    Bring a calendar mirror up to date with Google, creating it if needed.
+
+    Only the changes since the last sync are fetched, and no more than once
+    per SYNC_INTERVAL, unless the mirror has been marked stale.
+
+    :param service: Calendar resource object.
+    :type mirror_key: ndb.Key
+    :param bool force: Sync even if the mirror was synced recently.
+    :rtype: models.CalendarMirror
+    """
+    cal_id = mirror_key.string_id()
+    now = datetime.utcnow()
+
+    mirror = mirror_key.get()
+    if mirror is None:
+        mirror = models.CalendarMirror(key=mirror_key)
+    elif not force and _is_fresh(mirror, now):
+        return mirror
+
+    sync = None
+    if not _needs_full_sync(mirror, now):
+        try:
+            sync = gapiutils.sync_events(service, cal_id, mirror.sync_token,
+                                         now + FULL_SYNC_HORIZON)
+        except api_exceptions.GoneException:
+            pass
+    if sync is None:
+        # The sync token expired, or the horizon is getting near, so start
+        # over from scratch
+        clear_mirror(mirror_key)
+        mirror = models.CalendarMirror(key=mirror_key,
+                                       channel_id=mirror.channel_id)
+        sync = gapiutils.sync_events(service, cal_id, None,
+                                     now + FULL_SYNC_HORIZON)
+
+    _apply_sync(mirror, sync, now)
+    return mirror
+
+
+def sync_calendars(service, mirror_keys):
+    """
+    Bring several calendar mirrors up to date at once.
+
+    Works like sync_calendar, but all of the mirrors that need syncing are
+    synced together with batch requests.  A calendar that fails to sync
+    doesn't fail the rest: the error is logged, and its mirror is left as
+    it was, or None if it has never been synced.
+
+    :param service: Calendar resource object.
+    :type mirror_keys: list[ndb.Key]
+    :return: The mirrors, in the same order as their keys.
+    :rtype: list[models.CalendarMirror]
+    :raise api_exceptions.UnauthorizedException: The user's credentials
+                                                 were refused.
+    """
+    now = datetime.utcnow()
+
+    mirrors = [mirror or models.CalendarMirror(key=mirror_key)
+               for mirror_key, mirror in zip(mirror_keys,
+                                             ndb.get_multi(mirror_keys))]
+    indexes = dict((mirror.key.string_id(), i)
+                   for i, mirror in enumerate(mirrors))
+    stale_mirrors = dict((mirror.key.string_id(), mirror)
+                         for mirror in mirrors if not _is_fresh(mirror, now))
+
+    syncs = gapiutils.sync_events_batch(service, dict(
+        (cal_id, mirror.sync_token)
+        for cal_id, mirror in stale_mirrors.iteritems()
+        if not _needs_full_sync(mirror, now)
+    ), now + FULL_SYNC_HORIZON)
+    # Mirrors near their horizon start over on their own, just like ones
+    # whose sync tokens expired
+    for cal_id, mirror in stale_mirrors.iteritems():
+        if _needs_full_sync(mirror, now):
+            syncs[cal_id] = api_exceptions.GoneException()
+
+    for cal_id, sync in syncs.iteritems():
+        mirror = stale_mirrors[cal_id]
+        if isinstance(sync, api_exceptions.GoneException):
+            # Fall back to a full sync on its own, which clears the mirror
+            try:
+                mirrors[indexes[cal_id]] = sync_calendar(service, mirror.key,
+                                                         force=True)
+                continue
+            except api_exceptions.ServiceException as e:
+                sync = e
+                mirror.synced = None
+
+        if isinstance(sync, api_exceptions.UnauthorizedException):
+            raise sync
+        elif isinstance(sync, Exception):
+            logging.warning(strings.logging_sync_failed(calendar_id=cal_id,
+                                                        error=sync))
+            if mirror.synced is None:
+                mirrors[indexes[cal_id]] = None
+        else:
+            _apply_sync(mirror, sync, now)
+
+    return mirrors
+
+
+class _MirrorEventIterator(gapiutils.EventIterator):
+    """
+    Iterator over the upcoming events in a calendar mirror.
+
+    Page tokens are positions, the start date and id of the event to start
+    right after, so events synced in or pruned between requests don't shift
+    where a continuation resumes.  Datastore cursors, from before positions
+    were used, are still accepted.
+    """
+
+    def __init__(self, mirror, time_zone, page_token, offset, page_max):
+        super(_MirrorEventIterator, self).__init__(page_token, offset,
+                                                   page_max)
+        self._mirror = mirror
+        self._time_zone = time_zone or mirror.time_zone
+        self._now = datetime.utcnow()
+
+    def _fetch_page(self, page_token, page_max):
+        try:
+            if page_token and POSITION_SEPARATOR in page_token:
+                entities, more = self._fetch_after(page_token, page_max)
+            else:
+                start_cursor = (Cursor(urlsafe=page_token) if page_token
+                                else None)
+                query = models.MirroredEvent.query(
+                        ancestor=self._mirror.key).order(
+                        models.MirroredEvent.start_date)
+                entities, _, more = query.fetch_page(
+                        page_max, start_cursor=start_cursor)
+        except (ValueError, OverflowError, datastore_errors.BadValueError,
+                datastore_errors.BadRequestError):
+            raise api_exceptions.BadRequestException(
+                    strings.ERROR_INVALID_VALUE)
+
+        if more and entities:
+            next_page_token = self._get_position(entities[-1])
+        else:
+            next_page_token = None
+        return entities, next_page_token
+
+    def _fetch_after(self, position, page_max):
+        """
+        Fetch a page of events that come right after a position.
+
+        Events that start at the same time as the position's event, but
+        have later ids, are fetched alongside the ones that start later.
+
+        :type position: str
+        :type page_max: int
+        :return: The events, and whether there may be more after them.
+        :rtype: (list[models.MirroredEvent], bool)
+        """
+        timestamp, _, event_id = position.partition(POSITION_SEPARATOR)
+        start_date = EPOCH + timedelta(microseconds=int(timestamp))
+
+        tied_query = models.MirroredEvent.query(
+                models.MirroredEvent.start_date == start_date,
+                models.MirroredEvent.key > ndb.Key(
+                        models.MirroredEvent, event_id,
+                        parent=self._mirror.key),
+                ancestor=self._mirror.key).order(models.MirroredEvent.key)
+        later_query = models.MirroredEvent.query(
+                models.MirroredEvent.start_date > start_date,
+                ancestor=self._mirror.key).order(
+                models.MirroredEvent.start_date, models.MirroredEvent.key)
+        tied_future = tied_query.fetch_page_async(page_max)
+        later_future = later_query.fetch_page_async(page_max)
+        tied, _, tied_more = tied_future.get_result()
+        later, _, later_more = later_future.get_result()
+
+        entities = tied + later
+        more = tied_more or later_more or len(entities) > page_max
+        return entities[:page_max], more
+
+    def _parse_item(self, entity):
+        # Some events may have ended since the last time the mirror was
+        # pruned.  They are skipped rather than dropped from the page, so
+        # continuations still move past them.
+        if entity.end_date < self._now:
+            return None
+        # Past the horizon, only events that changed are mirrored, so none
+        # are listed
+        if (self._mirror.horizon is not None and
+                entity.start_date > self._mirror.horizon):
+            return None
+        return entity.to_message(self._time_zone, self._mirror.time_zone)
+
+    def _get_position(self, entity):
+        delta = entity.start_date - EPOCH
+        timestamp = ((delta.days * 24 * 60 * 60 + delta.seconds) * 10 ** 6 +
+                     delta.microseconds)
+        return "{}{}{}".format(timestamp, POSITION_SEPARATOR,
+                               entity.key.string_id())
+
+
+def iter_events(mirror, time_zone, page_token=None, offset=0, page_max=None):
+    """
+    Lazily iterate over the upcoming events in a calendar mirror, in order
+    of start date.
+
+    :type mirror: models.CalendarMirror
+    :type time_zone: str
+    :param str page_token: Page token from a continuation, to resume from.
+    :param int offset: Offset from a continuation, to resume from.
+    :param int page_max: Maximum number of events to fetch per page.
+    :rtype: gapiutils.EventIterator
+    """
+    return _MirrorEventIterator(mirror, time_zone, page_token, offset,
+                                page_max)
+
+
+def get_event(mirror, event_id, time_zone):
+    """
+    Get a specific upcoming event instance from a calendar mirror.
+
+    :type mirror: models.CalendarMirror
+    :type event_id: str
+    :type time_zone: str
+    :rtype: messages.EventProperties
+    :return: The event, or None if it is not in the mirror.
+    """
+    entity = ndb.Key(models.MirroredEvent, event_id, parent=mirror.key).get()
+    if entity is None or entity.end_date < datetime.utcnow():
+        return None
+    return entity.to_message(time_zone or mirror.time_zone, mirror.time_zone)
@@ -0,0 +1,114 @@
+"""Tools for making page tokens that carry their own state."""
+
+from __future__ import division, print_function
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+
+import endpoints
+
+import models
+import strings
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+SIGNING_KEY_ID = "page_tokens"
+
+# Bytes of the HMAC kept in each token.
+SIGNATURE_LENGTH = 16
+
+_SEPARATOR = "."
+
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+
+def _get_secret():
+    """
+    Get the secret used to sign page tokens, creating it the first time.
+
+    :rtype: str
+    """
+    with _secrets_lock:
+        if SIGNING_KEY_ID not in _secrets:
+            signing_key = models.SigningKey.get_or_insert(
+                    SIGNING_KEY_ID, secret=os.urandom(32))
+            _secrets[SIGNING_KEY_ID] = signing_key.secret
+        return _secrets[SIGNING_KEY_ID]
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+
+def _b64decode(string):
+    return base64.urlsafe_b64decode(str(string) + "=" * (-len(string) % 4))
+
+
+def _equals(a, b):
+    """Compare two strings in time that doesn't depend on where they differ."""
+    if len(a) != len(b):
+        return False
+    difference = 0
+    for x, y in zip(a, b):
+        difference |= ord(x) ^ ord(y)
+    return difference == 0
+
+
+def _get_signature(payload, context):
+    return hmac.new(_get_secret(), context + _SEPARATOR + payload,
+                    hashlib.sha256).digest()[:SIGNATURE_LENGTH]
+
+
+def is_signed(token):
+    """
+    Check if a page token looks like it came from sign, rather than being
+    an id of some stored state.
+
+    :type token: str
+    :rtype: bool
+    """
+    return _SEPARATOR in token
+
+
+def sign(state, context):
+    """
+    Encode some state as a tamper proof page token.
+
+    :param state: Anything that can be serialized as JSON.
+    :param str context: What the token is for, such as a hash of the
+                        request.  Tokens only verify with the same context,
+                        but the context is not stored in the token.
+    :rtype: str
+    """
+    payload = _b64encode(json.dumps(state, separators=(",", ":")))
+    return payload + _SEPARATOR + _b64encode(_get_signature(payload,
+                                                            context))
+
+
+def verify(token, context):
+    """
+    Decode the state in a page token from sign.
+
+    :type token: str
+    :param str context: The context the token was signed with.
+    :return: The state.
+    :raise endpoints.BadRequestException: The token is malformed, was
+                                          tampered with, or is for another
+                                          context.
+    """
+    try:
+        payload, signature = str(token).split(_SEPARATOR)
+        valid = _equals(_b64decode(signature),
+                        _get_signature(payload, context))
+        if valid:
+            return json.loads(_b64decode(payload))
+    except (TypeError, ValueError, UnicodeError):
+        pass
+    raise endpoints.BadRequestException(strings.ERROR_INVALID_VALUE)
@@ -0,0 +1,39 @@
+"""Unit tests for the TickTock API."""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import unittest
+
+try:
+    import dev_appserver
+except ImportError:
+    pass
+else:
+    # Put the libraries bundled with the App Engine SDK on the path
+    dev_appserver.fix_sys_path()
+
+from google.appengine.ext import ndb, testbed
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+# Libraries installed in lib are found the same way appengine_config does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "lib"))
+
+
+class AppEngineTestCase(unittest.TestCase):
+    """Test case with the datastore and memcache stubbed out."""
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
@@ -0,0 +1,119 @@
+"""Tests for api.cacheutils."""
+
+from __future__ import division, print_function
+
+import unittest
+
+from google.appengine.api import memcache
+
+from api import cacheutils
+from tests import AppEngineTestCase
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+class GetMemcacheKeyTest(unittest.TestCase):
+
+    def test_short_keys_are_kept(self):
+        self.assertEqual(cacheutils.get_memcache_key("calendar"), "calendar")
+
+    def test_unicode_keys_are_encoded(self):
+        key = cacheutils.get_memcache_key(u"caf\xe9")
+        self.assertIsInstance(key, str)
+        self.assertEqual(key, "caf\xc3\xa9")
+
+    def test_long_keys_are_hashed(self):
+        long_key = "x" * (cacheutils.MEMCACHE_KEY_MAX + 1)
+        key = cacheutils.get_memcache_key(long_key)
+        self.assertLessEqual(len(key), cacheutils.MEMCACHE_KEY_MAX)
+        self.assertEqual(key, cacheutils.get_memcache_key(long_key))
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_missing(self):
+        cache = cacheutils.LRUCache(2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a", 0), 0)
+
+    def test_set_and_get(self):
+        cache = cacheutils.LRUCache(2)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("a", 2)
+        self.assertEqual(cache.get("a"), 2)
+
+    def test_least_recently_used_is_pushed_out(self):
+        cache = cacheutils.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Reading a makes b the least recently used
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_expired_items_are_missing(self):
+        cache = cacheutils.LRUCache(2, ttl=60)
+        cache.set("a", 1, ttl=-1)
+        cache.set("b", 2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+
+    def test_delete_and_clear(self):
+        cache = cacheutils.LRUCache(3)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        cache.delete("missing")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+
+
+class TieredCacheTest(AppEngineTestCase):
+
+    NAMESPACE = "test_cache"
+
+    def test_get_missing(self):
+        cache = cacheutils.TieredCache(self.NAMESPACE, 10, 60)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a", 0), 0)
+
+    def test_set_writes_to_memcache(self):
+        cache = cacheutils.TieredCache(self.NAMESPACE, 10, 60)
+        cache.set("a", 1)
+        self.assertEqual(memcache.get("a", namespace=self.NAMESPACE), 1)
+
+    def test_other_instances_read_from_memcache(self):
+        cacheutils.TieredCache(self.NAMESPACE, 10, 60).set("a", 1)
+        other = cacheutils.TieredCache(self.NAMESPACE, 10, 60)
+        self.assertEqual(other.get("a"), 1)
+        # It is kept in process memory after that
+        memcache.flush_all()
+        self.assertEqual(other.get("a"), 1)
+
+    def test_local_copies_expire_first(self):
+        cache = cacheutils.TieredCache(self.NAMESPACE, 10, 60, local_ttl=-1)
+        cache.set("a", 1)
+        # Another instance replaces the item
+        memcache.set("a", 2, namespace=self.NAMESPACE)
+        self.assertEqual(cache.get("a"), 2)
+
+    def test_delete(self):
+        cache = cacheutils.TieredCache(self.NAMESPACE, 10, 60)
+        cache.set("a", 1)
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(memcache.get("a", namespace=self.NAMESPACE))
+
+    def test_none_cannot_be_cached(self):
+        cache = cacheutils.TieredCache(self.NAMESPACE, 10, 60)
+        self.assertRaises(AssertionError, cache.set, "a", None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Tests for api.preferenceutils."""
+
+from __future__ import division, print_function
+
+import collections
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from api import models
+from api import preferenceutils
+from tests import AppEngineTestCase
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+# Has the fields is_hidden uses
+Event = collections.namedtuple("Event", ["eventId", "recurrenceId"])
+
+
+class PreferencesTest(AppEngineTestCase):
+
+    def setUp(self):
+        super(PreferencesTest, self).setUp()
+        preferenceutils._local.clear()
+        self.calendar_key = ndb.Key(models.Calendar, "cal@example.com",
+                                    parent=models.get_user_key("12345"))
+        self.other_calendar_key = ndb.Key(models.Calendar, "other",
+                                          parent=models.get_user_key("12345"))
+        ndb.put_multi([
+            models.Event(id="star", parent=self.calendar_key, starred=True),
+            models.Event(id="hide", parent=self.calendar_key, hidden=True),
+            models.Event(id="show", parent=self.calendar_key, hidden=False),
+            models.Event(id="other", parent=self.other_calendar_key,
+                         starred=True),
+        ])
+
+        # Count the snapshots built from the datastore
+        self.builds = 0
+        build_preferences = preferenceutils._build_preferences
+
+        def counted_build(calendar_key):
+            self.builds += 1
+            return build_preferences(calendar_key)
+
+        preferenceutils._build_preferences = counted_build
+        self.addCleanup(setattr, preferenceutils, "_build_preferences",
+                        build_preferences)
+
+    def star(self, event_id):
+        models.Event(id=event_id, parent=self.calendar_key,
+                     starred=True).put()
+
+    def test_built_from_entities(self):
+        preferences = preferenceutils.get_preferences(self.calendar_key)
+        self.assertEqual(preferences.starred, frozenset(["star"]))
+        self.assertEqual(preferences.hidden, {"hide": True, "show": False})
+
+    def test_multi_keeps_order(self):
+        results = preferenceutils.get_preferences_multi(
+                [self.other_calendar_key, self.calendar_key])
+        self.assertEqual(results[0].starred, frozenset(["other"]))
+        self.assertEqual(results[1].starred, frozenset(["star"]))
+
+    def test_snapshots_are_reused(self):
+        preferenceutils.get_preferences(self.calendar_key)
+        preferenceutils.get_preferences(self.calendar_key)
+        self.assertEqual(self.builds, 1)
+
+    def test_other_instances_read_from_memcache(self):
+        preferenceutils.get_preferences(self.calendar_key)
+        preferenceutils._local.clear()
+        preferences = preferenceutils.get_preferences(self.calendar_key)
+        self.assertEqual(preferences.starred, frozenset(["star"]))
+        self.assertEqual(self.builds, 1)
+
+    def test_refresh_after_writes(self):
+        preferenceutils.get_preferences(self.calendar_key)
+        self.star("new")
+        preferenceutils.refresh_preferences(self.calendar_key)
+        preferences = preferenceutils.get_preferences(self.calendar_key)
+        self.assertEqual(preferences.starred, frozenset(["star", "new"]))
+        self.assertEqual(self.builds, 2)
+
+    def test_refresh_drops_copies_in_other_instances(self):
+        preferenceutils.get_preferences(self.calendar_key)
+        local_copy = preferenceutils._local.get(self.calendar_key)
+        self.star("new")
+        preferenceutils.refresh_preferences(self.calendar_key)
+        # Another instance still holds the older copy in memory
+        preferenceutils._local.set(self.calendar_key, local_copy)
+        preferences = preferenceutils.get_preferences(self.calendar_key)
+        self.assertIn("new", preferences.starred)
+
+    def test_invalidate(self):
+        preferenceutils.get_preferences(self.calendar_key)
+        self.star("new")
+        preferenceutils.invalidate_preferences_multi([self.calendar_key])
+        preferences = preferenceutils.get_preferences(self.calendar_key)
+        self.assertIn("new", preferences.starred)
+        self.assertEqual(self.builds, 2)
+        preferenceutils.invalidate_preferences_multi([])
+
+    def test_flushed_memcache_only_rebuilds_once(self):
+        preferenceutils.get_preferences(self.calendar_key)
+        memcache.flush_all()
+        preferenceutils.get_preferences(self.calendar_key)
+        preferenceutils.get_preferences(self.calendar_key)
+        self.assertEqual(self.builds, 2)
+
+    def test_version_changes_with_preferences(self):
+        version = preferenceutils.get_version(self.calendar_key)
+        self.assertEqual(preferenceutils.get_version(self.calendar_key),
+                         version)
+        self.star("new")
+        preferenceutils.refresh_preferences(self.calendar_key)
+        self.assertNotEqual(preferenceutils.get_version(self.calendar_key),
+                            version)
+
+    def test_is_hidden(self):
+        preferences = preferenceutils.Preferences(
+                frozenset(), {"series": True, "series_1": False})
+        self.assertTrue(preferenceutils.is_hidden(
+                preferences, Event("series_2", "series")))
+        # An instance's own setting wins over its recurring event's
+        self.assertFalse(preferenceutils.is_hidden(
+                preferences, Event("series_1", "series")))
+        self.assertFalse(preferenceutils.is_hidden(
+                preferences, Event("single", None)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+"""Tests for api.recurrenceutils."""
+
+from __future__ import division, print_function
+
+import base64
+import unittest
+import urlparse
+from datetime import datetime
+
+import pytz
+
+from api import recurrenceutils
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+CHICAGO = pytz.timezone("America/Chicago")
+
+
+def utc(*args):
+    return pytz.utc.localize(datetime(*args))
+
+
+def make_link(event_id):
+    eid = base64.urlsafe_b64encode(
+            "{} cal@example.com".format(event_id)).rstrip("=")
+    return "https://www.google.com/calendar/event?eid=" + eid
+
+
+def get_link_event_id(link):
+    eid = urlparse.parse_qs(urlparse.urlsplit(link).query)["eid"][0]
+    decoded = base64.urlsafe_b64decode(str(eid) + "=" * (-len(eid) % 4))
+    return decoded.split(" ", 1)[0]
+
+
+class GetOriginalKeyTest(unittest.TestCase):
+
+    def test_timed(self):
+        self.assertEqual(recurrenceutils.get_original_key(
+                {"dateTime": "2015-09-15T08:00:00-05:00"}),
+                "20150915T130000Z")
+
+    def test_fractional_seconds(self):
+        self.assertEqual(recurrenceutils.get_original_key(
+                {"dateTime": "2015-09-15T13:00:00.000Z"}),
+                "20150915T130000Z")
+
+    def test_all_day(self):
+        self.assertEqual(recurrenceutils.get_original_key(
+                {"date": "2015-09-05"}), "20150905")
+
+
+class GetNextInstanceTest(unittest.TestCase):
+
+    def make_weekly(self, *recurrence):
+        # Tuesdays at 8:00 in Chicago, starting September 1st, 2015
+        return {
+            "id": "weekly",
+            "summary": "Club meeting",
+            "htmlLink": make_link("weekly"),
+            "start": {"dateTime": "2015-09-01T08:00:00-05:00",
+                      "timeZone": "America/Chicago"},
+            "end": {"dateTime": "2015-09-01T09:00:00-05:00",
+                    "timeZone": "America/Chicago"},
+            "recurrence": list(recurrence) or ["RRULE:FREQ=WEEKLY"],
+        }
+
+    def test_next_instance(self):
+        instance = recurrenceutils.get_next_instance(
+                self.make_weekly(), {}, utc(2015, 9, 10), CHICAGO)
+        self.assertEqual(instance["id"], "weekly_20150915T130000Z")
+        self.assertEqual(instance["recurringEventId"], "weekly")
+        self.assertEqual(instance["summary"], "Club meeting")
+        self.assertNotIn("recurrence", instance)
+        self.assertEqual(instance["start"]["dateTime"],
+                         "2015-09-15T08:00:00-05:00")
+        self.assertEqual(instance["end"]["dateTime"],
+                         "2015-09-15T09:00:00-05:00")
+        self.assertEqual(get_link_event_id(instance["htmlLink"]),
+                         "weekly_20150915T130000Z")
+
+    def test_instance_in_progress(self):
+        instance = recurrenceutils.get_next_instance(
+                self.make_weekly(), {}, utc(2015, 9, 15, 13, 30), CHICAGO)
+        self.assertEqual(instance["id"], "weekly_20150915T130000Z")
+
+    def test_dates_in_another_time_zone(self):
+        instance = recurrenceutils.get_next_instance(
+                self.make_weekly(), {}, utc(2015, 9, 10), pytz.utc)
+        self.assertEqual(instance["start"]["dateTime"],
+                         "2015-09-15T13:00:00+00:00")
+
+    def test_wall_clock_time_is_kept_across_daylight_saving(self):
+        instance = recurrenceutils.get_next_instance(
+                self.make_weekly(), {}, utc(2015, 11, 2), CHICAGO)
+        self.assertEqual(instance["id"], "weekly_20151103T140000Z")
+        self.assertEqual(instance["start"]["dateTime"],
+                         "2015-11-03T08:00:00-06:00")
+
+    def test_cancelled_instances_are_skipped(self):
+        instance = recurrenceutils.get_next_instance(
+                self.make_weekly(), {"20150915T130000Z": None},
+                utc(2015, 9, 10), CHICAGO)
+        self.assertEqual(instance["id"], "weekly_20150922T130000Z")
+
+    def test_moved_instances(self):
+        moved = {
+            "id": "weekly_20150915T130000Z",
+            "recurringEventId": "weekly",
+            "start": {"dateTime": "2015-09-16T10:00:00-05:00"},
+            "end": {"dateTime": "2015-09-16T11:00:00-05:00"},
+        }
+        instance = recurrenceutils.get_next_instance(
+                self.make_weekly(), {"20150915T130000Z": moved},
+                utc(2015, 9, 10), CHICAGO)
+        self.assertEqual(instance["id"], "weekly_20150915T130000Z")
+        self.assertEqual(instance["start"]["dateTime"],
+                         "2015-09-16T10:00:00-05:00")
+
+    def test_excluded_dates(self):
+        instance = recurrenceutils.get_next_instance(
+                self.make_weekly("RRULE:FREQ=WEEKLY",
+                                 "EXDATE;TZID=America/Chicago:"
+                                 "20150915T080000"),
+                {}, utc(2015, 9, 10), CHICAGO)
+        self.assertEqual(instance["id"], "weekly_20150922T130000Z")
+
+    def test_series_is_over(self):
+        self.assertIsNone(recurrenceutils.get_next_instance(
+                self.make_weekly("RRULE:FREQ=WEEKLY;UNTIL=20150908T130000Z"),
+                {}, utc(2015, 9, 10), CHICAGO))
+
+    def test_all_day(self):
+        master = {
+            "id": "daily",
+            "start": {"date": "2015-09-01"},
+            "end": {"date": "2015-09-02"},
+            "recurrence": ["RRULE:FREQ=DAILY;COUNT=10"],
+        }
+        instance = recurrenceutils.get_next_instance(
+                master, {}, utc(2015, 9, 5, 12), CHICAGO)
+        self.assertEqual(instance["id"], "daily_20150905")
+        self.assertEqual(instance["start"], {"date": "2015-09-05"})
+        self.assertEqual(instance["end"], {"date": "2015-09-06"})
+
+    def test_bad_recurrence(self):
+        self.assertRaises(recurrenceutils.RecurrenceError,
+                          recurrenceutils.get_next_instance,
+                          self.make_weekly("NOT A RULE"), {},
+                          utc(2015, 9, 10), CHICAGO)
+        master = self.make_weekly()
+        del master["end"]
+        self.assertRaises(recurrenceutils.RecurrenceError,
+                          recurrenceutils.get_next_instance, master, {},
+                          utc(2015, 9, 10), CHICAGO)
+
+
+if __name__ == "__main__":
+    unittest.main()
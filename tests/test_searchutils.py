@@ -0,0 +1,216 @@
+"""Tests for api.searchutils."""
+
+from __future__ import division, print_function
+
+import collections
+import unittest
+from datetime import datetime, timedelta
+
+from api import searchutils
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+# Has the fields the event scoring functions use
+Event = collections.namedtuple("Event",
+                               ["eventId", "name", "startDate", "starred"])
+
+START = datetime(2015, 9, 1)
+
+
+def make_event(event_id, name, hours=0, starred=False):
+    return Event(event_id, name, START + timedelta(hours=hours), starred)
+
+
+def get_ids(events):
+    return [event.eventId for event in events]
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(searchutils.tokenize(None), [])
+        self.assertEqual(searchutils.tokenize(""), [])
+
+    def test_splits_and_lowers(self):
+        self.assertEqual(searchutils.tokenize("Football Game: Drake-HHS"),
+                         ["football", "game", "drake", "hhs"])
+
+    def test_keeps_apostrophes_and_pluses(self):
+        self.assertEqual(searchutils.tokenize("Mr. O'Neil's C++ class"),
+                         ["mr", "o'neil's", "c++", "class"])
+        self.assertEqual(searchutils.tokenize(u"O\u2019Neil, C#"),
+                         [u"o\u2019neil", u"c#"])
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def test_keywords_match_the_start_of_terms(self):
+        index = searchutils.SearchIndex(
+                ["Club meeting", "Band practice", "Meet the teachers"],
+                lambda name: name)
+        matches, keyword_count = index.score("meet")
+        self.assertEqual(dict(matches), {0: 1, 2: 1})
+        self.assertEqual(keyword_count, 1)
+        matches, _ = index.score("eting")
+        self.assertEqual(dict(matches), {})
+
+    def test_symbols_narrow_keywords(self):
+        index = searchutils.SearchIndex(
+                ["C++ club", "Chess club", "O'Neil retirement", "Open house"],
+                lambda name: name)
+        matches, keyword_count = index.score("c++")
+        self.assertEqual(dict(matches), {0: 1})
+        self.assertEqual(keyword_count, 1)
+        matches, keyword_count = index.score("o'neil")
+        self.assertEqual(dict(matches), {2: 1})
+        self.assertEqual(keyword_count, 1)
+
+    def test_matches_are_counted_per_distinct_keyword(self):
+        index = searchutils.SearchIndex(["Band practice", "Band concert"],
+                                        lambda name: name)
+        matches, keyword_count = index.score("band practice band")
+        self.assertEqual(dict(matches), {0: 2, 1: 1})
+        self.assertEqual(keyword_count, 2)
+
+    def test_nameless_items(self):
+        index = searchutils.SearchIndex([None], lambda name: name)
+        matches, _ = index.score("anything")
+        self.assertEqual(dict(matches), {})
+
+
+class CollationKeyTest(unittest.TestCase):
+
+    def test_case_insensitive(self):
+        self.assertEqual(searchutils.get_collation_key("Band"),
+                         searchutils.get_collation_key("band"))
+
+    def test_orders_names(self):
+        self.assertLess(searchutils.get_collation_key("apple"),
+                        searchutils.get_collation_key("Banana"))
+
+    def test_nameless_sorts_first(self):
+        self.assertEqual(searchutils.get_collation_key(None),
+                         searchutils.get_collation_key(""))
+        self.assertLess(searchutils.get_collation_key(None),
+                        searchutils.get_collation_key("a"))
+
+    def test_unicode_names(self):
+        self.assertEqual(searchutils.get_collation_key(u"Caf\xe9"),
+                         searchutils.get_collation_key(u"caf\xe9"))
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = [
+            make_event("c", "Concert", hours=3),
+            make_event("a", "assembly", hours=1),
+            make_event("s", "Spirit week", hours=2, starred=True),
+            make_event("b", "Band practice", hours=1),
+            make_event("n", None, hours=5),
+        ]
+
+    def test_chron_sort(self):
+        self.assertEqual(get_ids(searchutils.event_chron_sort(self.events)),
+                         ["s", "a", "b", "c", "n"])
+
+    def test_ties_keep_list_order(self):
+        # Identical keys are broken by position, never by comparing items
+        events = [make_event("x", "Same"), make_event("x", "Same")]
+        self.assertEqual(searchutils.search(events, [lambda e: 0]), events)
+
+    def test_keyword_search_narrows(self):
+        events = searchutils.event_keyword_search(self.events, "band")
+        self.assertEqual(get_ids(events), ["b"])
+
+    def test_keyword_search_needs_half_of_the_keywords(self):
+        events = searchutils.event_keyword_search(
+                self.events, "band concert assembly week")
+        self.assertEqual(get_ids(events), [])
+        events = searchutils.event_keyword_search(self.events,
+                                                  "band practice")
+        self.assertEqual(get_ids(events), ["b"])
+
+    def test_keyword_chron_sort_keeps_everything(self):
+        events = searchutils.event_keyword_chron_sort(self.events, "band")
+        self.assertEqual(sorted(get_ids(events)), ["a", "b", "c", "n", "s"])
+        self.assertEqual(events[0].eventId, "s")
+
+
+class MergePageTest(unittest.TestCase):
+
+    def test_page_is_in_order(self):
+        runs = [[make_event("a", "A", hours=1), make_event("c", "C", hours=3)],
+                [make_event("b", "B", hours=2), make_event("d", "D", hours=4)]]
+        page, rest = searchutils.merge_page(
+                runs, searchutils.event_chron_order(), 3)
+        self.assertEqual(get_ids(page), ["a", "b", "c"])
+        self.assertEqual(get_ids(rest), ["d"])
+
+    def test_runs_need_not_be_sorted(self):
+        runs = [[make_event("c", "C", hours=3), make_event("a", "A", hours=1),
+                 make_event("b", "B", hours=2)]]
+        page, rest = searchutils.merge_page(
+                runs, searchutils.event_chron_order(), 1)
+        self.assertEqual(get_ids(page), ["a"])
+        self.assertEqual(get_ids(rest), ["c", "b"])
+
+    def test_rest_keeps_the_order_of_the_runs(self):
+        runs = [[make_event(str(hours), "", hours=hours)
+                 for hours in range(start, 10, 3)]
+                for start in range(3)]
+        page, rest = searchutils.merge_page(
+                runs, searchutils.event_chron_order(), 4)
+        self.assertEqual(get_ids(page), ["0", "1", "2", "3"])
+        # What is left of each run, one run after another
+        self.assertEqual(get_ids(rest), ["6", "9", "4", "7", "5", "8"])
+
+    def test_everything_fits(self):
+        runs = [[], [make_event("a", "A")], []]
+        page, rest = searchutils.merge_page(
+                runs, searchutils.event_chron_order(), 5)
+        self.assertEqual(get_ids(page), ["a"])
+        self.assertEqual(rest, [])
+
+    def test_narrowed_items_are_left_out(self):
+        events = [make_event("b", "Band practice"), make_event("c", "Concert")]
+        order = [searchutils.event_kw_score(events, "band", True)]
+        page, rest = searchutils.merge_page([events], order, 5)
+        self.assertEqual(get_ids(page), ["b"])
+        self.assertEqual(rest, [])
+
+    def test_narrowed_items_keep_their_positions(self):
+        runs = [[make_event("c", "Concert"), make_event("b", "Band practice")],
+                [make_event("d", "Band day", hours=1)]]
+        order = [searchutils.event_kw_score(runs[0] + runs[1], "band", True),
+                 searchutils.event_start_date]
+        page, rest = searchutils.merge_page(runs, order, 1)
+        self.assertEqual(get_ids(page), ["b"])
+        self.assertEqual(get_ids(rest), ["d"])
+
+
+class MergeTaggedTest(unittest.TestCase):
+
+    def test_merges_lazily_and_keeps_tags(self):
+        pulled = []
+
+        def stream(tag, hours_list):
+            for hours in hours_list:
+                pulled.append((tag, hours))
+                yield make_event(str(hours), "", hours=hours), tag
+
+        merged = searchutils.merge_tagged(
+                [stream("x", [1, 4, 5]), stream("y", [2, 3, 6])],
+                searchutils.event_chron_order())
+        first = [next(merged) for _ in range(3)]
+        self.assertEqual([(event.eventId, tag) for event, tag in first],
+                         [("1", "x"), ("2", "y"), ("3", "y")])
+        # Streams are only pulled from as their items are needed
+        self.assertNotIn(("x", 5), pulled)
+        self.assertNotIn(("y", 6), pulled)
+
+
+if __name__ == "__main__":
+    unittest.main()
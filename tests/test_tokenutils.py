@@ -0,0 +1,66 @@
+"""Tests for api.tokenutils."""
+
+from __future__ import division, print_function
+
+import unittest
+
+import endpoints
+
+from api import tokenutils
+from tests import AppEngineTestCase
+
+__author__ = "Alexander Otavka"
+__copyright__ = "Copyright (C) 2015 DHS Developers Club"
+
+
+class TokenTest(AppEngineTestCase):
+
+    STATE = {"mirror": ["1441065600000000:event", 0], "starred": None,
+             "chunk": 25}
+
+    def setUp(self):
+        super(TokenTest, self).setUp()
+        # The secret is kept in memory, but each test has its own datastore
+        tokenutils._secrets.clear()
+
+    def test_round_trip(self):
+        token = tokenutils.sign(self.STATE, "context")
+        self.assertEqual(tokenutils.verify(token, "context"), self.STATE)
+
+    def test_tokens_are_signed(self):
+        self.assertTrue(tokenutils.is_signed(tokenutils.sign(self.STATE,
+                                                             "context")))
+        # Ids of stored state, like cache group ids, aren't
+        self.assertFalse(tokenutils.is_signed("a1B2c3"))
+
+    def test_unicode_tokens(self):
+        token = unicode(tokenutils.sign(self.STATE, "context"))
+        self.assertEqual(tokenutils.verify(token, "context"), self.STATE)
+
+    def test_other_context(self):
+        token = tokenutils.sign(self.STATE, "context")
+        self.assertRaises(endpoints.BadRequestException, tokenutils.verify,
+                          token, "other context")
+
+    def test_tampered_payload(self):
+        token = tokenutils.sign(self.STATE, "context")
+        _, signature = token.split(".")
+        forged = tokenutils.sign(dict(self.STATE, chunk=1000), "forged")
+        payload, _ = forged.split(".")
+        self.assertRaises(endpoints.BadRequestException, tokenutils.verify,
+                          payload + "." + signature, "context")
+
+    def test_malformed_tokens(self):
+        for token in ["", ".", "abc", "a.b.c", "!!!.???", u"\u2603.abc"]:
+            self.assertRaises(endpoints.BadRequestException,
+                              tokenutils.verify, token, "context")
+
+    def test_secret_is_kept(self):
+        token = tokenutils.sign(self.STATE, "context")
+        # A new process reads the same secret back from the datastore
+        tokenutils._secrets.clear()
+        self.assertEqual(tokenutils.verify(token, "context"), self.STATE)
+
+
+if __name__ == "__main__":
+    unittest.main()